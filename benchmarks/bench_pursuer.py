@@ -0,0 +1,438 @@
+# End-to-end benchmark for Pursuer against the local mock ArliAI server.
+#
+# headless  ChatSession -> StreamingEngine -> SSEParser, the path both the
+#           window and --cli use: time to first token, tokens/sec, and lag of
+#           the engine's event loop while streaming.
+# tk        The real ChatApp window and markdown renderer: time to first
+#           rendered token, tokens/sec rendered and Tk event loop lag. Needs a
+#           display; --xvfb starts a virtual one.
+# history   Startup history load and context build time against journal size.
+#
+# Every mode runs in its own process, so the peak RSS reported for a mode is
+# that mode's alone. Results can be written as JSON and compared to an earlier
+# run with --baseline.
+#
+#   python benchmarks/bench_pursuer.py [--mode all|headless|tk|history] [--requests 20]
+#       [--concurrency 1] [--token-rate 0] [--error-rate 0] [--xvfb] [--json]
+#       [--output results.json] [--baseline old.json]
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+from mock_arliai import WORDS, add_arguments, server_from_args
+from pursuer_core import ApiError, ChatJournal, ChatSession, NetworkError, merge_settings
+
+LAG_INTERVAL = 0.005
+
+
+def summary(values, scale=1.0):
+    # mean and percentiles, scaled (e.g. 1000 for seconds -> ms)
+    if not values:
+        return None
+    values = sorted(v * scale for v in values)
+
+    def pick(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {"mean": sum(values) / len(values), "p50": pick(0.50), "p95": pick(0.95), "max": values[-1], "count": len(values)}
+
+
+def peak_rss():
+    # Bytes, or None where the resource module does not exist (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def bench_settings(args, url):
+    settings = merge_settings({})
+    settings.update({"api_url": url, "max_tokens": args.tokens, "history_fsync": "never", "render_fps": args.render_fps})
+    return settings
+
+
+def error_kind(e):
+    if isinstance(e, ApiError):
+        return str(e.status)
+    return type(e).__name__
+
+
+def run_headless(args):
+    server = server_from_args(args).start()
+    session = ChatSession(bench_settings(args, server.url), "bench", history_file=None)
+    records = []
+    lags = []
+
+    async def probe(stop):
+        # How late the engine loop wakes up: parsing and callbacks all run on it
+        while not stop.is_set():
+            expected = time.perf_counter() + LAG_INTERVAL
+            await asyncio.sleep(LAG_INTERVAL)
+            lags.append(max(0.0, time.perf_counter() - expected))
+
+    async def one(i, slots):
+        async with slots:
+            deltas = []
+            messages = [{"role": "system", "content": session.settings["system_prompt"]},
+                        {"role": "user", "content": f"Question {i}"}]
+            started = time.perf_counter()
+            error = None
+            try:
+                await session.stream_reply(messages, lambda text: deltas.append(time.perf_counter()))
+            except (ApiError, NetworkError) as e:
+                error = error_kind(e)
+            finished = time.perf_counter()
+            record = {"error": error, "total": finished - started, "deltas": len(deltas)}
+            if deltas:
+                record["ttft"] = deltas[0] - started
+                if error is None and deltas[-1] > deltas[0]:
+                    record["tokens_per_sec"] = args.tokens / (deltas[-1] - deltas[0])
+            records.append(record)
+
+    async def run_all():
+        slots = asyncio.Semaphore(args.concurrency)
+        stop = asyncio.Event()
+        lag_task = asyncio.ensure_future(probe(stop))
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i, slots) for i in range(args.requests)))
+        wall = time.perf_counter() - started
+        stop.set()
+        await lag_task
+        return wall
+
+    try:
+        wall = session.engine.submit(run_all()).result()
+        engine_stats = session.engine.stats()
+    finally:
+        session.close()
+        server.stop()
+
+    ok = [r for r in records if r["error"] is None]
+    errors = {}
+    for r in records:
+        if r["error"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "requests": len(records),
+        "ok": len(ok),
+        "errors": errors,
+        "wall_s": wall,
+        "ttft_ms": summary([r["ttft"] for r in ok if "ttft" in r], 1000),
+        "request_ms": summary([r["total"] for r in ok], 1000),
+        "tokens_per_sec": summary([r["tokens_per_sec"] for r in ok if "tokens_per_sec" in r]),
+        "aggregate_tokens_per_sec": len(ok) * args.tokens / wall if wall else None,
+        "loop_lag_ms": summary(lags, 1000),
+        "engine": engine_stats,
+        "server": server.stats(),
+        "peak_rss": peak_rss(),
+    }
+
+
+def make_records(turns, seed):
+    rng = random.Random(seed)
+    records = []
+    for i in range(turns):
+        if i % 2 == 0:
+            records.append({"role": "user", "content": "".join(rng.choice(WORDS) for _ in range(15))})
+        else:
+            records.append({"role": "assistant", "content": "".join(rng.choice(WORDS) for _ in range(120))})
+    return records
+
+
+def run_history(args):
+    results = []
+    workdir = tempfile.mkdtemp(prefix="pursuer-bench-")
+    try:
+        for turns in args.history_turns:
+            path = os.path.join(workdir, f"history-{turns}.jsonl")
+            records = make_records(turns, args.seed)
+            ChatJournal.write_all(path, records, fsync="never")
+
+            settings = bench_settings(args, "http://127.0.0.1:1/")
+            session = ChatSession(settings, "bench", history_file=path)
+            started = time.perf_counter()
+            session.open_history()
+            open_time = time.perf_counter() - started
+
+            build_times = []
+            for i in range(args.repeat):
+                started = time.perf_counter()
+                session.conversation.build_messages(settings["system_prompt"], f"Question {i}")
+                build_times.append(time.perf_counter() - started)
+            messages = session.conversation.build_messages(settings["system_prompt"], "Question")
+            session.close()
+
+            # Reading everything, as the old transcript loader had to
+            started = time.perf_counter()
+            everything = ChatJournal.read(path)
+            read_all_time = time.perf_counter() - started
+
+            results.append({
+                "turns": turns,
+                "journal_bytes": os.path.getsize(path),
+                "open_history_ms": open_time * 1000,
+                "build_messages_ms": summary(build_times, 1000),
+                "read_all_ms": read_all_time * 1000,
+                "messages_sent": len(messages),
+                "records_read": len(everything),
+            })
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"sizes": results, "peak_rss": peak_rss()}
+
+
+def load_app_module():
+    spec = importlib.util.spec_from_file_location("pursuer_ai", os.path.join(ROOT, "pursuer-ai.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_tk(args):
+    if sys.platform.startswith("linux") and not os.environ.get("DISPLAY"):
+        return {"skipped": "no display (set DISPLAY or use --xvfb)"}
+    server = server_from_args(args).start()
+    workdir = tempfile.mkdtemp(prefix="pursuer-bench-")
+    cwd = os.getcwd()
+    try:
+        # ChatApp reads and writes its files in the working directory
+        os.chdir(workdir)
+        with open("settings.txt", "w", encoding="utf-8") as f:
+            json.dump(bench_settings(args, server.url), f)
+        with open("api_key.txt", "w") as f:
+            f.write("bench")
+
+        import tkinter as tk
+        module = load_app_module()
+        root = tk.Tk()
+        app = module.ChatApp(root)
+        # Reads the API key and history now rather than after the first paint
+        app.finish_startup()
+
+        records = []
+        lags = []
+        renders = []
+        state = {"sent": 0, "started": None, "renders_from": 0}
+
+        renderer = app.tab.renderer
+        feed = renderer.feed
+
+        def timed_feed(text):
+            renders.append(time.perf_counter())
+            feed(text)
+
+        renderer.feed = timed_feed
+
+        def tick(expected):
+            now = time.perf_counter()
+            lags.append(max(0.0, now - expected))
+            root.after(int(LAG_INTERVAL * 1000), tick, now + LAG_INTERVAL)
+
+        def finish_request():
+            # Failed requests are reported in the chat like any other text
+            seen = renders[state["renders_from"]:]
+            record = {"total": time.perf_counter() - state["started"], "renders": len(seen)}
+            if seen:
+                record["ttft"] = seen[0] - state["started"]
+                if seen[-1] > seen[0]:
+                    record["tokens_per_sec"] = args.tokens / (seen[-1] - seen[0])
+            records.append(record)
+
+        def drive():
+            if app.tab.pending:
+                root.after(1, drive)
+                return
+            if state["started"] is not None:
+                finish_request()
+            if state["sent"] == args.requests:
+                app.on_close()
+                return
+            app.input_field.delete(0, tk.END)
+            app.input_field.insert(0, f"Question {state['sent']}")
+            state["sent"] += 1
+            state["renders_from"] = len(renders)
+            state["started"] = time.perf_counter()
+            app.send_message()
+            root.after(1, drive)
+
+        started = time.perf_counter()
+        root.after(int(LAG_INTERVAL * 1000), tick, time.perf_counter() + LAG_INTERVAL)
+        root.after(200, drive)
+        root.mainloop()
+        wall = time.perf_counter() - started
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "requests": len(records),
+        "ok": len(records),
+        "wall_s": wall,
+        "ttft_ms": summary([r["ttft"] for r in records if "ttft" in r], 1000),
+        "request_ms": summary([r["total"] for r in records], 1000),
+        "rendered_tokens_per_sec": summary([r["tokens_per_sec"] for r in records if "tokens_per_sec" in r]),
+        "ui_lag_ms": summary(lags, 1000),
+        "render_batches": len(renders),
+        "peak_rss": peak_rss(),
+    }
+
+
+MODES = {"headless": run_headless, "history": run_history, "tk": run_tk}
+
+
+def start_xvfb():
+    # A virtual X display for the tk mode; returns (process, display) or (None, reason)
+    binary = shutil.which("Xvfb")
+    if binary is None:
+        return None, "Xvfb not found"
+    for number in range(99, 120):
+        if os.path.exists(f"/tmp/.X{number}-lock"):
+            continue
+        process = subprocess.Popen([binary, f":{number}", "-screen", "0", "1280x800x24", "-nolisten", "tcp"],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(50):
+            if os.path.exists(f"/tmp/.X11-unix/X{number}"):
+                return process, f":{number}"
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+        process.kill()
+    return None, "could not start Xvfb"
+
+
+def flatten(data, prefix=""):
+    out = {}
+    if isinstance(data, dict):
+        for key, value in data.items():
+            out.update(flatten(value, f"{prefix}{key}."))
+    elif isinstance(data, list):
+        for i, value in enumerate(data):
+            out.update(flatten(value, f"{prefix}{i}."))
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        out[prefix[:-1]] = data
+    return out
+
+
+def compare(baseline, report):
+    old = flatten({mode: baseline.get(mode) for mode in MODES})
+    new = flatten({mode: report.get(mode) for mode in MODES})
+    print(f"{'metric':<48} {'baseline':>12} {'now':>12} {'change':>8}")
+    for key in sorted(old.keys() & new.keys()):
+        if key.endswith(".count"):
+            continue
+        change = f"{(new[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else ""
+        print(f"{key:<48} {old[key]:>12.4g} {new[key]:>12.4g} {change:>8}")
+
+
+def print_report(report):
+    config = report["config"]
+    print(f"Mock server: {config['tokens']} tokens/answer, rate {config['token_rate'] or 'unlimited'}, "
+          f"chunk {config['chunk_size'] or 'per event'}, latency {config['latency']}s, error rate {config['error_rate']}")
+    for mode in MODES:
+        result = report.get(mode)
+        if result is None:
+            continue
+        if "skipped" in result or "failed" in result:
+            print(f"{mode}: {result.get('skipped') or result.get('failed')}")
+            continue
+        rss = f", peak RSS {result['peak_rss'] / 1e6:.0f} MB" if result.get("peak_rss") else ""
+        if mode == "history":
+            print(f"history{rss}")
+            for size in result["sizes"]:
+                print(f"  {size['turns']:>7} turns {size['journal_bytes'] / 1e6:>8.1f} MB  open {size['open_history_ms']:>8.2f} ms  "
+                      f"build p50 {size['build_messages_ms']['p50']:>7.3f} ms  read all {size['read_all_ms']:>9.1f} ms")
+            continue
+        rate = result.get("tokens_per_sec") or result.get("rendered_tokens_per_sec")
+        lag = result.get("loop_lag_ms") or result.get("ui_lag_ms")
+        print(f"{mode}: {result['ok']}/{result['requests']} ok in {result['wall_s']:.2f}s{rss}")
+        if result["ttft_ms"]:
+            print(f"  time to first token  p50 {result['ttft_ms']['p50']:.1f} ms  p95 {result['ttft_ms']['p95']:.1f} ms")
+        if rate:
+            print(f"  tokens/sec           p50 {rate['p50']:,.0f}  mean {rate['mean']:,.0f}")
+        if lag:
+            print(f"  event loop lag       p50 {lag['p50']:.2f} ms  p95 {lag['p95']:.2f} ms  max {lag['max']:.2f} ms")
+        if result.get("errors"):
+            print(f"  errors               {result['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Pursuer against a local mock ArliAI server")
+    parser.add_argument("--mode", choices=["all"] + list(MODES), default="all")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1, help="parallel requests in headless mode")
+    parser.add_argument("--render-fps", type=int, default=30)
+    parser.add_argument("--history-turns", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--xvfb", action="store_true", help="run the tk mode on a virtual X display")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--child", choices=list(MODES), help=argparse.SUPPRESS)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(MODES[args.child](args)))
+        return
+
+    modes = list(MODES) if args.mode == "all" else [args.mode]
+    env = dict(os.environ)
+    xvfb = None
+    if args.xvfb and "tk" in modes:
+        xvfb, display = start_xvfb()
+        if xvfb is not None:
+            env["DISPLAY"] = display
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("json", "output", "baseline", "child", "xvfb", "mode")},
+    }
+    try:
+        for mode in modes:
+            if mode == "tk" and args.xvfb and xvfb is None:
+                report[mode] = {"skipped": display}
+                continue
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--child", mode],
+                                   capture_output=True, text=True, env=env)
+            lines = child.stdout.strip().splitlines()
+            if child.returncode != 0 or not lines:
+                report[mode] = {"failed": (child.stderr.strip().splitlines() or ["no output"])[-1]}
+            else:
+                report[mode] = json.loads(lines[-1])
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Micro-benchmark for the streaming response parser.
+#
+# Compares SSEParser with the loop Pursuer used before it: requests'
+# iter_lines() followed by decode, startswith and json.loads on every line.
+# The stream is a synthetic chat completion shaped like ArliAI's output,
+# cut into chunks the way it arrives off the socket.
+#
+#   python benchmarks/bench_sse.py [--events N] [--chunk-size BYTES] [--json]
+
+import argparse
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from pursuer_core import SSEParser
+
+
+def make_stream(events):
+    words = ["The", " quick", " brown", " fox", " jumps", " over", " the", " lazy", " dog", ".", "\n", " `code`", " **bold**"]
+    out = []
+    for i in range(events):
+        event = {
+            "id": "chatcmpl-0123456789abcdef",
+            "object": "chat.completion.chunk",
+            "created": 1726000000,
+            "model": "Meta-Llama-3.1-8B-Instruct",
+            "choices": [{"index": 0, "delta": {"content": words[i % len(words)]}, "logprobs": None, "finish_reason": None}],
+        }
+        out.append(b"data: " + json.dumps(event).encode("utf-8") + b"\n\n")
+    out.append(b"data: [DONE]\n\n")
+    return b"".join(out)
+
+
+def chunked(stream, chunk_size):
+    return [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+
+def iter_lines(chunks):
+    # Same algorithm as requests.Response.iter_lines()
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        yield from lines
+    if pending is not None:
+        yield pending
+
+
+def legacy_parse(chunks):
+    # The loop from make_api_request before SSEParser
+    full_response = ""
+    for line in iter_lines(chunks):
+        if line:
+            decoded_line = line.decode('utf-8')
+            if decoded_line.startswith("data: "):
+                if decoded_line.strip() == "data: [DONE]":
+                    break
+                try:
+                    json_data = json.loads(decoded_line[6:])
+                    if 'choices' in json_data and json_data['choices']:
+                        delta = json_data['choices'][0].get('delta', {})
+                        if 'content' in delta:
+                            full_response += delta['content']
+                except json.JSONDecodeError:
+                    continue
+    return full_response
+
+
+def sse_parse(parser_class, chunks):
+    parser = parser_class()
+    full_response = ""
+    for chunk in chunks:
+        contents = parser.contents(chunk)
+        if contents:
+            full_response += "".join(contents)
+        if parser.done:
+            break
+    return full_response
+
+
+def measure(fn, chunks, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(chunks)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SSE stream parser")
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--chunk-size", type=int, nargs="+", default=[64, 512, 4096])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    stream = make_stream(args.events)
+    results = []
+    for chunk_size in args.chunk_size:
+        chunks = chunked(stream, chunk_size)
+        legacy_time, legacy_text = measure(legacy_parse, chunks, args.repeat)
+        sse_time, sse_text = measure(lambda c: sse_parse(SSEParser, c), chunks, args.repeat)
+        if legacy_text != sse_text:
+            raise SystemExit(f"Parsers disagree at chunk size {chunk_size}")
+        results.append({
+            "chunk_size": chunk_size,
+            "chunks": len(chunks),
+            "events": args.events,
+            "legacy_chunks_per_sec": len(chunks) / legacy_time,
+            "sse_chunks_per_sec": len(chunks) / sse_time,
+            "legacy_events_per_sec": args.events / legacy_time,
+            "sse_events_per_sec": args.events / sse_time,
+            "speedup": legacy_time / sse_time,
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.events} events, {len(stream) / 1e6:.1f} MB")
+    print(f"{'chunk':>7} {'chunks':>8} {'legacy chunks/s':>16} {'SSEParser chunks/s':>19} {'speedup':>8}")
+    for r in results:
+        print(f"{r['chunk_size']:>7} {r['chunks']:>8} {r['legacy_chunks_per_sec']:>16,.0f} {r['sse_chunks_per_sec']:>19,.0f} {r['speedup']:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+# Local stand-in for api.arliai.com/v1/chat/completions.
+#
+# Speaks just enough HTTP/1.1 (keep-alive, chunked transfer encoding) to stream
+# OpenAI-style SSE answers the way ArliAI does. Token rate, SSE event size,
+# socket chunk size, response latency and error injection are all adjustable,
+# and the answers come from a seeded generator so runs can be compared.
+#
+#   python benchmarks/mock_arliai.py [--port 8000] [--tokens 200] [--token-rate 50] ...
+#   python pursuer-ai.py --cli --api-url http://127.0.0.1:8000/v1/chat/completions "hello"
+#
+# The benchmarks start it in-process with MockArliServer(...).start().
+
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+
+ERROR_KINDS = ("429", "503", "drop")
+
+# Markdown-heavy vocabulary so the render path has spans, links and code
+WORDS = [
+    "The", " quick", " brown", " fox", " jumps", " over", " the", " lazy", " dog", ".", "\n\n",
+    " `code`", " **bold**", " *italic*", " ~~old~~", " [link](https://example.com)", "\n- item", "\n1. step",
+    "\n```python\nprint('hi')\n```\n", " and", " then", ",", " a", " longer", " sentence", "\n# Heading\n",
+]
+
+
+class MockArliServer:
+    def __init__(self, host="127.0.0.1", port=0, tokens=200, token_rate=0.0, tokens_per_event=1, chunk_size=0,
+                 latency=0.0, error_rate=0.0, errors=ERROR_KINDS, retry_after=0.1, seed=0):
+        # token_rate is tokens per second (0 sends as fast as possible).
+        # chunk_size is the number of bytes per socket write, so events get
+        # split or batched the way they are on a real connection (0 writes
+        # each event on its own). error_rate is the chance that a request
+        # fails with one of `errors`: "429" and "503" answer with that status,
+        # "drop" closes the connection halfway through the stream.
+        self.host = host
+        self.port = port
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.tokens_per_event = max(1, tokens_per_event)
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errors = tuple(errors)
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.connections = 0
+        self.injected = {kind: 0 for kind in ERROR_KINDS}
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/v1/chat/completions"
+
+    def start(self):
+        # Serves on a background thread; returns once the port is bound
+        ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name="MockArliServer", daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(2.0)
+        self.loop = None
+
+    def stats(self):
+        return {"requests": self.requests, "connections": self.connections, "injected": dict(self.injected)}
+
+    def answer(self, tokens=None):
+        # The token list for one answer; also used by benchmarks to know what to expect
+        return [self.random.choice(WORDS) for _ in range(tokens or self.tokens)]
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.requests += 1
+                if not await self._respond(writer, request_line, body):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, request_line, body):
+        # Returns False when the connection should be closed
+        method, path = request_line.decode("latin-1").split()[:2]
+        if method != "POST" or path != "/v1/chat/completions":
+            await self._send_error(writer, 404, b'{"error": "not found"}')
+            return True
+        try:
+            request = json.loads(body)
+        except ValueError:
+            await self._send_error(writer, 400, b'{"error": "invalid json"}')
+            return True
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        error = None
+        if self.errors and self.error_rate and self.random.random() < self.error_rate:
+            error = self.random.choice(self.errors)
+            self.injected[error] += 1
+        if error == "429":
+            await self._send_error(writer, 429, b'{"error": "rate limited"}', {"Retry-After": f"{self.retry_after:g}"})
+            return True
+        if error == "503":
+            await self._send_error(writer, 503, b'{"error": "overloaded"}')
+            return True
+
+        tokens = self.answer(min(self.tokens, request.get("max_tokens") or self.tokens))
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        pending = bytearray()
+        started = time.perf_counter()
+        for start in range(0, len(tokens), self.tokens_per_event):
+            if error == "drop" and start >= len(tokens) // 2:
+                writer.write(self._chunk(bytes(pending)))
+                await writer.drain()
+                return False
+            if self.token_rate:
+                delay = started + start / self.token_rate - time.perf_counter()
+                if delay > 0:
+                    # Whatever is ready goes out before waiting for the next token
+                    await self._flush(writer, pending, final=True)
+                    await asyncio.sleep(delay)
+            pending += self._event(request.get("model", ""), "".join(tokens[start:start + self.tokens_per_event]))
+            if not self.chunk_size or len(pending) >= self.chunk_size:
+                await self._flush(writer, pending)
+        pending += b"data: [DONE]\n\n"
+        await self._flush(writer, pending, final=True)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return True
+
+    async def _flush(self, writer, pending, final=False):
+        # Writes whole chunk_size pieces (and the rest when final), so event
+        # boundaries and socket writes do not line up
+        size = self.chunk_size or len(pending)
+        while pending and (len(pending) >= size or final or not self.chunk_size):
+            piece = bytes(pending[:size])
+            del pending[:size]
+            writer.write(self._chunk(piece))
+        await writer.drain()
+
+    def _event(self, model, content):
+        event = {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": content}, "logprobs": None, "finish_reason": None}],
+        }
+        return b"data: " + json.dumps(event).encode("utf-8") + b"\n\n"
+
+    def _chunk(self, data):
+        return b"%x\r\n%s\r\n" % (len(data), data) if data else b""
+
+    async def _send_error(self, writer, status, body, headers=None):
+        reason = {400: "Bad Request", 404: "Not Found", 429: "Too Many Requests", 503: "Service Unavailable"}[status]
+        extra = "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\n{extra}\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+
+def add_arguments(parser):
+    parser.add_argument("--tokens", type=int, default=200, help="tokens per answer")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="tokens per second, 0 for no limit")
+    parser.add_argument("--tokens-per-event", type=int, default=1, help="tokens in each SSE event")
+    parser.add_argument("--chunk-size", type=int, default=0, help="bytes per socket write, 0 for one event per write")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the response headers")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="chance that a request fails")
+    parser.add_argument("--errors", default=",".join(ERROR_KINDS), help="comma separated kinds of failure: 429, 503, drop")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def server_from_args(args, port=0):
+    return MockArliServer(port=port, tokens=args.tokens, token_rate=args.token_rate, tokens_per_event=args.tokens_per_event,
+                          chunk_size=args.chunk_size, latency=args.latency, error_rate=args.error_rate,
+                          errors=[kind for kind in args.errors.split(",") if kind], seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock ArliAI chat completions server")
+    parser.add_argument("--port", type=int, default=8000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    for kind in args.errors.split(","):
+        if kind and kind not in ERROR_KINDS:
+            parser.error(f"unknown error kind: {kind}")
+
+    server = server_from_args(args, args.port).start()
+    print(f"Serving on {server.url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    print(json.dumps(server.stats()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,800 @@
 # Pursuer AI Assistant Chat Program Version 1.0 Public Release 1
-# Uses Requests Library
+# Uses only the Python standard library
 # Created by alby13 - https://www.singularityon.com
 
-import os
+import sys
+import time
+
+# For --startup-profile, which measures from here to the first paint
+SCRIPT_STARTED = time.time()
+
+# Command line mode never needs the window, so it is started before tkinter
+# is imported: python pursuer-ai.py --cli "your question"
+if __name__ == "__main__" and "--cli" in sys.argv[1:]:
+    from pursuer_core import main
+    sys.exit(main([arg for arg in sys.argv[1:] if arg != "--cli"]))
+
+# python pursuer-ai.py --startup-profile [--budget MS] starts the window in a
+# child process and reports how long it took to appear
+if __name__ == "__main__" and "--startup-profile" in sys.argv[1:]:
+    from pursuer_core import profile_startup
+    sys.exit(profile_startup(__file__, sys.argv[1:]))
+
+import asyncio
+import bisect
+import json
 import logging
+import queue
 import threading
 import tkinter as tk
 from tkinter import scrolledtext, ttk, messagebox
 from tkinter import font as tkfont
+import os
 import re
-from datetime import datetime
-import requests
-import json
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-import webbrowser
-
-# Configure error logging
-log_file = "error_log.txt"
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
-
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.WARNING)
-
-class CustomHandler(logging.Handler):
-    def emit(self, record):
-        current_time = datetime.now().strftime('%H:%M:%S')
-        print(f"Log file updated at {current_time}.")
-
-logger.addHandler(CustomHandler())
+from collections import deque
+from pursuer_core import (AVAILABLE_MODELS, CHAT_HISTORY_FILE, DEFAULT_SETTINGS, LEGACY_HISTORY_FILE, RESPONSE_CACHE_MODES, SETTINGS_FILE,
+                          HIGHLIGHT_KINDS, STARTUP_PROFILE_ENV, STARTUP_PROFILE_MARK, ApiError, ChatSession, NetworkError, RequestMetrics,
+                          RequestScheduler, ResponseCache, SettingsStore, StreamingEngine, describe_error, load_api_key, log_error,
+                          highlight_code, merge_settings, save_api_key, setup_logging)
+
+# Colors of the highlighted parts of code blocks, shown in the code_<kind> tags
+HIGHLIGHT_COLORS = {"keyword": "#C678DD", "builtin": "#56B6C2", "function": "#61AFEF", "string": "#E5C07B",
+                    "number": "#D19A66", "comment": "#7F848E"}
+
+class CodeBlock:
+    # A fenced code block in a chat display, highlighted while it streams in.
+    # Its text starts at `mark`; `ranges` are the highlight ranges of its
+    # first `lexed` characters, as last lexed (`full` when lexed from the
+    # start), and `applied` those tagged so far.
+    def __init__(self, widget, mark, language):
+        self.widget = widget
+        self.mark = mark
+        self.language = language
+        self.parts = []
+        self.length = 0
+        self.ranges = ()
+        self.line_starts = [0]
+        self.lexed = 0
+        self.full = False
+        self.kept = 0
+        self.applied = []
+        # A lexing job is queued or running / a batch of tags is queued
+        self.busy = False
+        self.applying = False
+        # The closing fence has been seen / the block is done or deleted
+        self.closed = False
+        self.dropped = False
+
+    def add(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+
+class CodeHighlighter:
+    # Highlights code blocks as they stream in. Lexing (highlight_code in
+    # pursuer_core, with Pygments when it is installed) runs on a worker
+    # thread, one job per block at a time, and each job only lexes again from
+    # the last line the earlier text should not depend on; once the block is
+    # closed it is lexed once more from the start. The Tk thread applies
+    # the ranges that changed since the last pass, at most BATCH of them per
+    # pump tick, so a long block never holds up the text being written.
+    BATCH = 500
+
+    def __init__(self, run_on_ui):
+        self.run_on_ui = run_on_ui
+        self.jobs = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name="CodeHighlighter", daemon=True)
+        self.thread.start()
+
+    def update(self, block):
+        # Called when text was added to the block and when it is closed
+        if block.busy or block.dropped:
+            return
+        if block.lexed == block.length and (block.full or not block.closed):
+            self._finish(block)
+            return
+        block.busy = True
+        text = "".join(block.parts)
+        block.parts = [text]
+        if block.closed:
+            # An unfinished string or comment can throw a restart off
+            self.jobs.put((block, text, (), 0, True))
+        else:
+            self.jobs.put((block, text, block.ranges, block.lexed, False))
+
+    def _run(self):
+        while True:
+            block, text, ranges, lexed, full = self.jobs.get()
+            try:
+                start = self.restart_point(text, ranges, lexed)
+                kept = bisect.bisect_left(ranges, (start,))
+                ranges = ranges[:kept] + tuple((a + start, b + start, kind)
+                                               for a, b, kind in highlight_code(text[start:], block.language))
+                line_starts = [0]
+                line_starts.extend(match.end() for match in re.finditer("\n", text))
+            except Exception as e:
+                logging.error(f"Could not highlight a code block: {str(e)}")
+                ranges = kept = line_starts = None
+            self.run_on_ui(self._lexed, block, ranges, kept, line_starts, len(text), full)
+
+    @staticmethod
+    def restart_point(text, ranges, lexed):
+        # Where lexing can start again without changing anything before it:
+        # the start of the last unindented line lexed before that is not
+        # inside a string or comment
+        pos = text.rfind("\n", 0, lexed)
+        while pos >= 0:
+            line = pos + 1
+            if line < len(text) and not text[line].isspace():
+                i = bisect.bisect_left(ranges, (line,))
+                if i == 0 or ranges[i - 1][1] <= line:
+                    return line
+            pos = text.rfind("\n", 0, pos)
+        return 0
+
+    def _lexed(self, block, ranges, kept, line_starts, length, full):
+        block.busy = False
+        if block.dropped:
+            return
+        if ranges is None:
+            # Left as plain code
+            self._finish(block)
+            return
+        block.ranges, block.line_starts, block.lexed, block.full = ranges, line_starts, length, full
+        block.kept = min(block.kept, kept)
+        # A batch already queued picks up the new ranges
+        if not block.applying:
+            self.apply(block)
+        if block.lexed < block.length or (block.closed and not block.full):
+            self.update(block)
+
+    def apply(self, block):
+        # Retags from the first range that changed, BATCH ranges at a time
+        block.applying = False
+        if block.dropped:
+            return
+        ranges, applied = block.ranges, block.applied
+        i = min(block.kept, len(applied), len(ranges))
+        while i < len(applied) and i < len(ranges) and applied[i] == ranges[i]:
+            i += 1
+        widget = block.widget
+        origin = tuple(map(int, widget.index(block.mark).split(".")))
+        if i < len(applied):
+            start = applied[i][0] if i == len(ranges) else min(applied[i][0], ranges[i][0])
+            first = self.index(block, origin, start)
+            last = self.index(block, origin, max(applied[-1][1], start))
+            for kind in HIGHLIGHT_KINDS:
+                widget.tag_remove(f"code_{kind}", first, last)
+        batch = ranges[i:i + self.BATCH]
+        by_kind = {}
+        for start, end, kind in batch:
+            by_kind.setdefault(kind, []).extend((self.index(block, origin, start), self.index(block, origin, end)))
+        for kind, indices in by_kind.items():
+            widget.tag_add(f"code_{kind}", *indices)
+        block.applied = list(ranges[:i + len(batch)])
+        block.kept = len(block.applied)
+        if len(block.applied) < len(ranges):
+            block.applying = True
+            self.run_on_ui(self.apply, block)
+        elif block.closed and block.full and not block.busy and block.lexed == block.length:
+            self._finish(block)
+
+    def _finish(self, block):
+        if block.closed and not block.applying and not block.dropped:
+            block.dropped = True
+            block.widget.mark_unset(block.mark)
+
+    @staticmethod
+    def index(block, origin, offset):
+        # Text widget index of a character offset into the lexed text
+        line = bisect.bisect_right(block.line_starts, offset) - 1
+        column = offset - block.line_starts[line]
+        if line == 0:
+            column += origin[1]
+        return f"{origin[0] + line}.{column}"
+
+class StreamingMarkdownRenderer:
+    # Renders markdown into a Text widget as it streams in, without waiting for
+    # the end of the line. Plain text is inserted as soon as it arrives. Inline
+    # spans (`code`, **bold**, *italic*, ~~strike~~, [links](url), images) are
+    # shown literally while open; when the closing marker arrives only that
+    # span is replaced by its formatted version, from the text buffered for it,
+    # so nothing that was already rendered is scanned again. A span that is
+    # never closed on its line simply stays literal.
+    #
+    # Line markers (headings, bullets, numbered items, code fences) can only be
+    # told apart from text by the first few characters, so those are held back
+    # until the line's prefix is decided.
+
+    # A line start that could still turn into a marker
+    LINE_PREFIX_PENDING = re.compile(r'[ \t]*(?:`{1,2}|#{1,6}|[*-]|\d+\.?)?\Z')
+    LINE_PREFIX = re.compile(r'(?P<fence>[ \t]*```)|(?P<heading>#{1,6}) |[ \t]*(?P<bullet>[*-]) |[ \t]*(?P<number>\d+\.[ \t])')
+    CODE_FENCE_PENDING = re.compile(r'[ \t]*`{0,2}\Z')
+    CODE_FENCE = re.compile(r'[ \t]*```')
+    # Characters that can change the inline state; runs of anything else are
+    # inserted with a single call.
+    SPECIAL = re.compile(r'[`*~\[\]()!\n]')
+
+    SPAN_TAGS = {"code": "code", "bold": "bold", "italic": "italic", "strike": "strikethrough"}
+    # Where the text being streamed in goes and how far it has been parsed;
+    # render() sets this aside while it renders something else
+    STREAM_STATE = ("at", "span_mark", "block", "in_code_block", "code_language", "line_start", "prefix",
+                    "skip_line", "base_tags", "span", "span_text", "link_text", "pending")
+
+    def __init__(self, widget, highlighter=None):
+        self.widget = widget
+        self.at = "end-1c"
+        self.span_mark = "md_span"
+        # Every link shares the "link" tag; a mark where its text starts
+        # leads to its URL, so nothing per link is left in the tag table
+        self.links = {}
+        self.link_count = 0
+        # Code blocks being highlighted, by the mark where each starts
+        self.highlighter = highlighter
+        self.block = None
+        self.blocks = {}
+        self.block_count = 0
+        self.reset()
+
+    def link_at(self, index):
+        # The URL of the link whose text is at index: the closest link mark
+        # at or before it (mark_previous leaves out marks at the index itself)
+        mark = self.widget.mark_previous(f"{index}+1c")
+        while mark is not None and mark not in self.links:
+            mark = self.widget.mark_previous(mark)
+        return self.links.get(mark)
+
+    def forget(self, start, end):
+        # For text about to be deleted: drops the links and the highlighting
+        # of code blocks between start and end
+        marks = []
+        mark = self.widget.mark_next(start)
+        while mark is not None and self.widget.compare(mark, "<", end):
+            if mark in self.links:
+                marks.append(mark)
+                del self.links[mark]
+            elif mark in self.blocks:
+                marks.append(mark)
+                self.blocks.pop(mark).dropped = True
+            mark = self.widget.mark_next(mark)
+        if marks:
+            self.widget.mark_unset(*marks)
+        if self.block is not None and self.block.dropped:
+            self.block = None
+
+    def render(self, text, at):
+        # Renders a complete piece of markdown before the mark `at`, which has
+        # to have right gravity so it moves along. This is how older history
+        # goes in above the chat, while an answer may be streaming in below.
+        saved = {name: getattr(self, name) for name in self.STREAM_STATE}
+        self.at = at
+        self.span_mark = "md_render_span"
+        self.block = None
+        try:
+            self.reset()
+            self.feed(text)
+            self.reset()
+        finally:
+            for name, value in saved.items():
+                setattr(self, name, value)
+
+    def highlight(self):
+        # After each batch of text: lets the open code block catch up
+        if self.block is not None:
+            self.highlighter.update(self.block)
+        self.blocks = {mark: block for mark, block in self.blocks.items() if not block.dropped}
+
+    def _open_block(self):
+        if self.highlighter is None:
+            return
+        mark = f"code-{self.block_count}"
+        self.block_count += 1
+        self.widget.mark_set(mark, self.at)
+        self.widget.mark_gravity(mark, tk.LEFT)
+        self.block = self.blocks[mark] = CodeBlock(self.widget, mark, self.code_language)
+
+    def _close_block(self):
+        if self.block is not None:
+            self.block.closed = True
+            self.highlighter.update(self.block)
+            self.block = None
+
+    def _code(self, text):
+        self._insert(text, ("code",))
+        if self.block is not None:
+            self.block.add(text)
+
+    def reset(self):
+        # An answer can end inside a code block
+        self._close_block()
+        self.in_code_block = False
+        self.code_language = ""
+        self._start_line()
+
+    def _start_line(self):
+        self.line_start = True
+        self.prefix = ""
+        self.skip_line = False
+        self.base_tags = ()
+        self.span = None
+        self.span_text = ""
+        self.link_text = ""
+        self.pending = ""
+
+    def feed(self, text):
+        i = 0
+        n = len(text)
+        while i < n:
+            if self.line_start:
+                i = self._feed_prefix(text, i)
+                continue
+            j = text.find("\n", i)
+            end = n if j < 0 else j
+            if self.skip_line:
+                # Rest of a fence line is the language name, which is not shown
+                self.code_language += text[i:end]
+            elif self.in_code_block:
+                if end > i:
+                    self._code(text[i:end])
+            else:
+                self._inline(text, i, end)
+            if j < 0:
+                return
+            self._end_line()
+            i = j + 1
+
+    def _feed_prefix(self, text, i):
+        c = text[i]
+        if c != "\n":
+            self.prefix += c
+            pending = self.CODE_FENCE_PENDING if self.in_code_block else self.LINE_PREFIX_PENDING
+            if pending.match(self.prefix):
+                return i + 1
+            self._decide_prefix()
+            return i + 1
+        self._decide_prefix()
+        # The newline itself is handled by the regular path
+        return i
+
+    def _decide_prefix(self):
+        prefix = self.prefix
+        self.line_start = False
+        self.prefix = ""
+        if self.in_code_block:
+            if self.CODE_FENCE.match(prefix):
+                self.in_code_block = False
+                self.skip_line = True
+                self._close_block()
+                self._insert("\n")
+            elif prefix:
+                self._code(prefix)
+            return
+
+        match = self.LINE_PREFIX.match(prefix)
+        if match is None:
+            rest = prefix
+        elif match.group("fence"):
+            self.in_code_block = True
+            self.skip_line = True
+            self.code_language = prefix[match.end():]
+            return
+        elif match.group("heading"):
+            self.base_tags = (f"h{len(match.group('heading'))}",)
+            rest = prefix[match.end():]
+        elif match.group("bullet"):
+            self._insert("  • ")
+            rest = prefix[match.end():]
+        else:
+            self._insert(match.group("number"))
+            rest = prefix[match.end():]
+        self._inline(rest, 0, len(rest))
+
+    def _end_line(self):
+        if self.skip_line:
+            self.code_language = self.code_language.strip()
+            if self.in_code_block:
+                # The opening fence: the code starts on the next line
+                self._open_block()
+        elif self.in_code_block and not self.line_start:
+            self._code("\n")
+        elif not self.in_code_block:
+            if self.line_start:
+                self._decide_prefix()
+            self._resolve_pending()
+            self._insert("\n", self.base_tags)
+        self._start_line()
+
+    def _inline(self, text, i, end):
+        special = self.SPECIAL
+        while i < end:
+            match = special.search(text, i, end)
+            j = match.start() if match else end
+            if j > i:
+                self._resolve_pending()
+                self._add(text[i:j])
+            if not match:
+                return
+            self._special(text[j])
+            i = j + 1
+
+    def _special(self, c):
+        if self.pending:
+            pending = self.pending
+            self.pending = ""
+            if pending == c and c in "*~":
+                self._double(c)
+                return
+            if pending == "!" and c == "[":
+                self._open("image", "![")
+                return
+            if pending == "]" and c == "(":
+                # Link text is complete, the url follows
+                self.link_text = self.span_text
+                self.span_text = ""
+                self.span += "_url"
+                self._literal("](")
+                return
+            self._single(pending)
+
+        span = self.span
+        if c == "*":
+            if span == "italic":
+                self._close()
+            elif span in (None, "bold"):
+                self.pending = c
+            else:
+                self._add(c)
+        elif c == "~":
+            if span in (None, "strike"):
+                self.pending = c
+            else:
+                self._add(c)
+        elif c == "`":
+            if span is None:
+                self._open("code", c)
+            elif span == "code":
+                self._close()
+            else:
+                self._add(c)
+        elif c == "[" and span is None:
+            self._open("link", c)
+        elif c == "!" and span is None:
+            self.pending = c
+        elif c == "]" and span in ("link", "image"):
+            self.pending = c
+        elif c == ")" and span in ("link_url", "image_url"):
+            self._close()
+        else:
+            self._add(c)
+
+    def _double(self, c):
+        kind = "bold" if c == "*" else "strike"
+        if self.span == kind:
+            self._close()
+        elif self.span is None:
+            self._open(kind, c + c)
+        else:
+            self._add(c + c)
+
+    def _single(self, c):
+        if c == "*" and self.span is None:
+            self._open("italic", c)
+        else:
+            self._add(c)
+
+    def _resolve_pending(self):
+        if self.pending:
+            pending = self.pending
+            self.pending = ""
+            self._single(pending)
+
+    def _add(self, text):
+        self._literal(text)
+        if self.span:
+            self.span_text += text
+
+    def _open(self, kind, opener):
+        self.widget.mark_set(self.span_mark, self.at)
+        self.widget.mark_gravity(self.span_mark, tk.LEFT)
+        self._literal(opener)
+        self.span = kind
+        self.span_text = ""
+        self.link_text = ""
+
+    def _close(self):
+        # Swap the literal span for its formatted version
+        self.widget.delete(self.span_mark, self.at)
+        span = self.span
+        self.span = None
+        if span == "link_url":
+            mark = f"link-{self.link_count}"
+            self.link_count += 1
+            self.links[mark] = self.span_text
+            self.widget.mark_set(mark, self.at)
+            self.widget.mark_gravity(mark, tk.LEFT)
+            self._insert(self.link_text, self.base_tags + ("link",))
+        elif span == "image_url":
+            self._insert(f"[Image: {self.link_text}]", self.base_tags)
+        else:
+            self._insert(self.span_text, self.base_tags + (self.SPAN_TAGS[span],))
+        self.span_text = ""
+        self.link_text = ""
+
+    def _literal(self, text):
+        self._insert(text, self.base_tags)
+
+    def _insert(self, text, tags=()):
+        self.widget.insert(self.at, text, tags)
+
+class ChatTab:
+    # One conversation in the notebook: its chat display and a ChatSession
+    # with its own history journal. All tabs share the app's engine and
+    # request scheduler, so their answers can stream at the same time.
+    def __init__(self, app, name, history_file):
+        self.app = app
+        self.name = name
+        self.closed = False
+        # The history is loaded once the window is on screen; until then
+        # nothing can be sent from the tab
+        self.loaded = False
+        self.history_page_pending = False
+        self.current_metrics = None
+        # Record numbers of the turns in the chat display, oldest first; each
+        # has a turn-<number> mark where it starts
+        self.shown_turns = deque()
+        legacy_history_file = LEGACY_HISTORY_FILE if history_file == CHAT_HISTORY_FILE else None
+        self.session = ChatSession(app.settings, app.api_key, engine=app.engine, history_file=history_file,
+                                   legacy_history_file=legacy_history_file, scheduler=app.scheduler, cache=app.response_cache)
+
+        self.frame = ttk.Frame(app.notebook, style="Dark.TFrame")
+        self.chat_display = scrolledtext.ScrolledText(
+            self.frame, wrap=tk.WORD, bg="#282c34", fg="#D3D3D3", insertbackground="#D3D3D3", font=app.font
+        )
+        self.chat_display.pack(expand=True, fill=tk.BOTH)
+        self.chat_display.bind("<Key>", lambda event: "break")
+        self.chat_display.bind("<Button-3>", app.popup_menu)
+        self.chat_display.configure(yscrollcommand=self.on_chat_scroll)
+
+        # Timings of the last request, shown over the top of the chat
+        self.stats_label = tk.Label(self.chat_display, text="No requests yet", bg='#1e2227', fg='#98C379',
+                                    font=("Courier", 9), justify=tk.LEFT, padx=4, pady=2)
+        self.show_stats(app.settings["stats_overlay"])
+
+        # Configure tags for different styles
+        self.chat_display.tag_configure('bold', font=app.bold_font)
+        self.chat_display.tag_configure('italic', font=app.italic_font)
+        self.chat_display.tag_configure('code', font=app.code_font, background='#3E4451', foreground='#98C379', selectbackground='#4E5A6B', selectforeground='#98C379')
+        self.chat_display.tag_configure('link', foreground='#61AFEF', underline=True)
+        for heading, font in app.heading_fonts.items():
+            self.chat_display.tag_configure(heading, font=font)
+        self.chat_display.tag_configure('strikethrough', overstrike=True)
+        self.chat_display.tag_configure('found', background='#4B4632')
+        # Configured after 'code', so their colors win over it
+        for kind, color in HIGHLIGHT_COLORS.items():
+            self.chat_display.tag_configure(f"code_{kind}", foreground=color)
+
+        # Streamed answers are rendered as markdown while they arrive
+        self.renderer = StreamingMarkdownRenderer(self.chat_display, app.highlighter)
+
+        # Bind click event for links
+        self.chat_display.tag_bind('link', '<Button-1>', self.click_link)
+
+        app.notebook.add(self.frame, text=name)
+
+    def title(self):
+        # The tab label shows whether an answer is being written and how many
+        # messages are waiting for a request slot
+        text = self.name
+        if self.app.scheduler.busy(self.session):
+            text += " •"
+        depth = self.app.scheduler.depth(self.session)
+        if depth:
+            text += f" ({depth} queued)"
+        return text
+
+    def show_stats(self, shown):
+        if shown:
+            self.stats_label.place(relx=1.0, x=-4, y=4, anchor="ne")
+        else:
+            self.stats_label.place_forget()
+
+    def update_chat_display(self, text):
+        # Safe to call from any thread; the text is rendered by the next pump.
+        # The time it was queued gives the render lag.
+        self.app.ui_queue.put(("text", (self, text, time.perf_counter())))
+
+    def update_user_message(self, message):
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.insert(tk.END, f"You: {message}\n\n")
+        self.chat_display.see(tk.END)
+        self.chat_display.config(state=tk.DISABLED)
+        self.renderer.reset()
+
+    def render(self, text, queued):
+        self.chat_display.config(state=tk.NORMAL)
+        self.renderer.feed(text)
+        self.renderer.highlight()
+        if self.current_metrics is not None:
+            # How long the oldest text of the batch waited to be shown
+            self.current_metrics.render_lags.append(time.perf_counter() - queued)
+
+    def start_request(self, user_message, metrics, number):
+        # Queued by the request once it has a slot, so the question appears
+        # right before its answer even if it waited behind others. number is
+        # the question's record number in the history; the answer is next.
+        if self.closed:
+            return
+        self.current_metrics = metrics
+        self.mark_turn(number)
+        self.update_user_message(user_message)
+        self.mark_turn(number + 1)
+        self.trim_scrollback()
+
+    def mark_turn(self, number):
+        # Marks where a turn starts, for jumping to search results. Text added
+        # at the end goes after the mark.
+        self.chat_display.mark_set(f"turn-{number}", "end-1c")
+        self.chat_display.mark_gravity(f"turn-{number}", tk.LEFT)
+        # An answer that failed leaves no record, so the next question
+        # takes over its number
+        if not self.shown_turns or self.shown_turns[-1] != number:
+            self.shown_turns.append(number)
+
+    def trim_scrollback(self):
+        # Keeps the display to scrollback_turns turns by deleting the oldest,
+        # with their marks and links. They are paged back in from the history
+        # like any older turn. Nothing is deleted while it is being read.
+        limit = self.app.settings["scrollback_turns"]
+        excess = len(self.shown_turns) - limit
+        if limit <= 0 or excess <= 0:
+            return
+        display = self.chat_display
+        keep = f"turn-{self.shown_turns[excess]}"
+        if display.compare("@0,0", "<", keep):
+            return
+        following = display.yview()[1] >= 1.0
+        display.mark_set("view_top", "@0,0")
+        self.renderer.forget("1.0", keep)
+        evicted = [f"turn-{self.shown_turns.popleft()}" for _ in range(excess)]
+        display.config(state=tk.NORMAL)
+        display.delete("1.0", keep)
+        display.config(state=tk.DISABLED)
+        display.mark_unset(*evicted)
+        if following:
+            display.see(tk.END)
+        else:
+            display.yview("view_top")
+        # Turn numbers are record numbers, so scrolling back pages the
+        # evicted turns in again from the journal
+        self.session.history_start = self.shown_turns[0]
+
+    def click_link(self, event):
+        url = self.renderer.link_at("current")
+        if url:
+            self.app._click_link(url)
+
+    def show_turn(self, number):
+        # Pages older history in until the turn is loaded, then scrolls to it
+        # and highlights it. Returns False if it is not on screen.
+        while self.session.history_floor < self.session.history_start > number:
+            self.insert_history_page(self.session.read_history_page())
+        mark = f"turn-{number}"
+        if mark not in self.chat_display.mark_names():
+            return False
+        self.chat_display.tag_remove("found", "1.0", tk.END)
+        self.chat_display.tag_add("found", mark, f"{mark} lineend")
+        self.chat_display.yview(mark)
+        return True
+
+    def finish_request(self, metrics):
+        # Queued after the last of the answer, so it has all been rendered
+        if metrics is self.current_metrics:
+            self.current_metrics = None
+        if self.closed:
+            return
+        self.session.finish_metrics(metrics)
+        summary = metrics.summary().replace(" | ", "\n")
+        if self.session.cache is not None and self.app.settings["response_cache"] != "off":
+            summary += "\n" + self.session.cache.summary()
+        self.stats_label.config(text=summary)
+
+    def clear_screen(self, floor=None):
+        # Cleared turns are not paged back in; floor is the first record that
+        # may be, by default the next one
+        if self.closed:
+            return
+        if floor is None:
+            floor = self.session.record_count
+        self.session.history_start = self.session.history_floor = floor
+        self.renderer.forget("1.0", tk.END)
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.delete(1.0, tk.END)
+        self.chat_display.config(state=tk.DISABLED)
+        marks = [f"turn-{number}" for number in self.shown_turns]
+        if marks:
+            self.chat_display.mark_unset(*marks)
+        self.shown_turns.clear()
+
+    def load_chat_history(self):
+        if self.closed or self.loaded:
+            return
+        self.loaded = True
+        try:
+            records = self.session.open_history()
+        except Exception as e:
+            error_message = f"Encounterd an issue loading chat history: {str(e)}"
+            self.update_chat_display(error_message)
+            logging.error(error_message)
+            return
+        self.insert_history_page(records)
+        self.chat_display.see(tk.END)
+
+    def insert_history_page(self, records):
+        if not records:
+            return
+        display = self.chat_display
+        # The page goes in before this mark, which ends up at what was the
+        # first line, so the view stays where it was while the older page
+        # appears above it.
+        display.mark_set("history_top", "1.0")
+        display.mark_gravity("history_top", tk.RIGHT)
+        # Marks that stay before text inserted at them (turns, links, code
+        # blocks) would end up above the page if they are at the very top
+        pinned = []
+        mark = display.mark_next("1.0")
+        while mark is not None and display.compare(mark, "==", "1.0"):
+            if display.mark_gravity(mark) == tk.LEFT:
+                pinned.append(mark)
+                display.mark_gravity(mark, tk.RIGHT)
+            mark = display.mark_next(mark)
+        display.config(state=tk.NORMAL)
+        # Oldest first, rendered the way they were when they streamed in
+        for record in records:
+            display.mark_set(f"turn-{record['number']}", "history_top")
+            display.mark_gravity(f"turn-{record['number']}", tk.LEFT)
+            text = self.format_history_turn(record["role"], record["content"])
+            if record["role"] == "user":
+                display.insert("history_top", text)
+            else:
+                self.renderer.render(text, "history_top")
+        display.config(state=tk.DISABLED)
+        for mark in pinned:
+            display.mark_gravity(mark, tk.LEFT)
+        self.shown_turns.extendleft(record["number"] for record in reversed(records))
+        display.yview("history_top")
+
+    def on_chat_scroll(self, first, last):
+        self.chat_display.vbar.set(first, last)
+        if float(first) <= 0.0 and self.session.history_start > self.session.history_floor and not self.history_page_pending:
+            self.history_page_pending = True
+            self.app.master.after_idle(self.page_in_history)
+
+    def page_in_history(self):
+        try:
+            self.insert_history_page(self.session.read_history_page())
+        except Exception as e:
+            self.session.history_start = self.session.history_floor
+            logging.error(f"Encounterd an issue loading older chat history: {str(e)}")
+        finally:
+            self.history_page_pending = False
+
+    def format_history_turn(self, role, content):
+        if role == "user":
+            return f"You: {content}\n\n"
+        return f"{content}\n\n\n"
+
+    def close(self, delete_history=False):
+        # The tab's requests are stopped before its history is closed (or
+        # deleted), so an answer still being written cannot be recorded into
+        # a closed journal; what they queue for the window is ignored
+        self.closed = True
+
+        def close_session():
+            if delete_history:
+                self.session.delete_history()
+            self.session.close()
+
+        self.app.scheduler.stop((self.session, (self.session, "summary")), close_session)
+        self.frame.destroy()
 
 class ChatApp:
     def __init__(self, master):
@@ -46,37 +805,18 @@ class ChatApp:
         self.master.resizable(True, True)
 
         self.dragging = False
+        self.resizing = ""
         self.start_x = 0
         self.start_y = 0
 
-        self.current_line= ""
-        self.in_code_block = False
-        self.current_format = set()
-
-        self.link_count = 0  
-
         # Available models
-        self.available_models = ["Meta-Llama-3.1-8B-Instruct", "Mistral-Nemo-12B-Instruct-2407"]
+        self.available_models = AVAILABLE_MODELS
 
         # Default settings
-        self.default_settings = {
-            "system_prompt": "You are a helpful AI assistant.",
-            "repetition_penalty": 1.0,
-            "temperature": 0.7,
-            "top_p": 0.9,
-            "top_k": 40,
-            "max_tokens": 1024,
-            "max_history_chars": 4000,
-            "model": self.available_models[0],
-            "window": {
-                "width": 800,
-                "height": 600,
-                "x": 100,
-                "y": 100
-            }
-        }
+        self.default_settings = DEFAULT_SETTINGS
 
         # Load settings if file exists
+        self.settings_store = SettingsStore(SETTINGS_FILE)
         self.load_settings()
 
         # Set the initial window geometry from settings or default
@@ -92,31 +832,41 @@ class ChatApp:
         self.maximized = False
         self.original_geometry = master.geometry()
 
-        self.chat_history_file = "chat_history.txt"
-        self.max_history_chars = 8000
+        # Conversations, history journals and the network layer (one event
+        # loop thread with a keep-alive connection pool) live in pursuer_core.
+        # Every tab has its own ChatSession; they share the engine and the
+        # response cache, and the scheduler keeps them within the account's
+        # parallel request limit.
+        # The API key and the history are only read by finish_startup(), once
+        # the window has been drawn.
+        self.api_key = ""
+        self.started_up = False
+        self.engine = StreamingEngine()
+        self.scheduler = RequestScheduler(self.engine, self.settings["max_parallel_requests"], on_change=self.on_queue_change)
+        self.response_cache = ResponseCache(max_entries=self.settings["response_cache_entries"],
+                                            max_bytes=self.settings["response_cache_bytes"])
+        self.tabs = []
+
+        # Worker threads never touch widgets; they queue work for pump_ui
+        self.ui_queue = queue.SimpleQueue()
+        # Lexes code blocks in answers on a thread of its own
+        self.highlighter = CodeHighlighter(self.run_on_ui)
+        self.ui_interval = max(1, int(1000 / max(1, self.settings["render_fps"])))
 
         self.font_size = 12
         self.create_widgets()
         self.add_resize_functionality()
-        self.load_chat_history()
-        self.load_api_key()
+        self.master.after(self.ui_interval, self.pump_ui)
+        self.open_tabs()
+        self.master.bind("<Map>", self.on_first_map, add="+")
+        # In case the window starts out minimized and is never mapped
+        self.master.after(2000, self.finish_startup)
         self.model = "Meta-Llama-3.1-8B-Instruct"
 
         self.dragging = False
         self.start_x = 0
         self.start_y = 0
 
-    def load_api_key(self):
-        try:
-            with open("api_key.txt", "r") as f:
-                self.api_key = f.read().strip()
-        except FileNotFoundError:
-            self.api_key = ""
-
-    def save_api_key(self):
-        with open("api_key.txt", "w") as f:
-            f.write(self.api_key)
-
     def create_widgets(self):
         self.master.configure(bg='#282c34')
         self.master.overrideredirect(True)
@@ -130,7 +880,7 @@ class ChatApp:
         self.title_bar.bind('<ButtonRelease-1>', self.stop_move)
         self.title_bar.bind('<B1-Motion>', self.do_move)
 
-        self.close_button = tk.Button(self.title_bar, text='X', command=self.master.quit, bg='#1e2227', fg='white', bd=0)
+        self.close_button = tk.Button(self.title_bar, text='X', command=self.on_close, bg='#1e2227', fg='white', bd=0)
         self.close_button.pack(side=tk.RIGHT)
 
         self.maximize_button = tk.Button(self.title_bar, text='□', command=self.toggle_maximize, bg='#1e2227', fg='white', bd=0)
@@ -163,6 +913,30 @@ class ChatApp:
         separator = tk.Frame(self.title_bar, width=1, bg='white')
         separator.pack(side=tk.LEFT, fill=tk.Y, padx=5, pady=2)
 
+        self.new_tab_button = tk.Button(self.title_bar, text='New Tab', command=self.new_tab, bg='#1e2227', fg='white', bd=0)
+        self.new_tab_button.pack(side=tk.LEFT)
+
+        self.close_tab_button = tk.Button(self.title_bar, text='Close Tab', command=self.close_tab, bg='#1e2227', fg='white', bd=0)
+        self.close_tab_button.pack(side=tk.LEFT, padx=(5, 0))
+
+        # Add a vertical separator
+        separator = tk.Frame(self.title_bar, width=1, bg='white')
+        separator.pack(side=tk.LEFT, fill=tk.Y, padx=5, pady=2)
+
+        self.stats_button = tk.Button(self.title_bar, text='Stats', command=self.toggle_stats_overlay, bg='#1e2227', fg='white', bd=0)
+        self.stats_button.pack(side=tk.LEFT)
+
+        # Add a vertical separator
+        separator = tk.Frame(self.title_bar, width=1, bg='white')
+        separator.pack(side=tk.LEFT, fill=tk.Y, padx=5, pady=2)
+
+        self.search_button = tk.Button(self.title_bar, text='Search', command=self.toggle_search, bg='#1e2227', fg='white', bd=0)
+        self.search_button.pack(side=tk.LEFT)
+
+        # Add a vertical separator
+        separator = tk.Frame(self.title_bar, width=1, bg='white')
+        separator.pack(side=tk.LEFT, fill=tk.Y, padx=5, pady=2)
+
         # Add font size buttons
         self.font_increase_button = tk.Button(self.title_bar, text='A+', command=lambda: self.increase_font_size(None), bg='#1e2227', fg='white', bd=0)
         self.font_increase_button.pack(side=tk.RIGHT)
@@ -174,30 +948,45 @@ class ChatApp:
         self.help_button = tk.Button(self.title_bar, text='Help', command=self.show_help, bg='#1e2227', fg='white', bd=0)
         self.help_button.pack(side=tk.RIGHT)
 
-        self.chat_display = scrolledtext.ScrolledText(
-            self.master, wrap=tk.WORD, bg="#282c34", fg="#D3D3D3", insertbackground="#D3D3D3", font=self.font
-        )
-        self.chat_display.pack(expand=True, fill=tk.BOTH, padx=10, pady=10)
-        self.chat_display.bind("<Key>", lambda event: "break")
-
-        # Create additional fonts
+        # Create additional fonts, shared by the chat display of every tab
         self.bold_font = tkfont.Font(family="Arial", size=self.font_size, weight="bold")
         self.italic_font = tkfont.Font(family="Arial", size=self.font_size, slant="italic")
         self.code_font = tkfont.Font(family="Courier", size=self.font_size)
+        self.heading_fonts = {
+            'h1': tkfont.Font(family="Arial", size=self.font_size+6, weight="bold"),
+            'h2': tkfont.Font(family="Arial", size=self.font_size+4, weight="bold"),
+            'h3': tkfont.Font(family="Arial", size=self.font_size+2, weight="bold"),
+            'h4': tkfont.Font(family="Arial", size=self.font_size+1, weight="bold"),
+        }
 
-        # Configure tags for different styles
-        self.chat_display.tag_configure('bold', font=self.bold_font)
-        self.chat_display.tag_configure('italic', font=self.italic_font)
-        self.chat_display.tag_configure('code', font=self.code_font, background='#3E4451', foreground='#98C379', selectbackground='#4E5A6B', selectforeground='#98C379')
-        self.chat_display.tag_configure('link', foreground='#61AFEF', underline=True)
-        self.chat_display.tag_configure('h1', font=tkfont.Font(family="Arial", size=self.font_size+6, weight="bold"))
-        self.chat_display.tag_configure('h2', font=tkfont.Font(family="Arial", size=self.font_size+4, weight="bold"))
-        self.chat_display.tag_configure('h3', font=tkfont.Font(family="Arial", size=self.font_size+2, weight="bold"))
-        self.chat_display.tag_configure('h4', font=tkfont.Font(family="Arial", size=self.font_size+1, weight="bold"))
-        self.chat_display.tag_configure('strikethrough', overstrike=True)
-
-        # Bind click event for links
-        self.chat_display.tag_bind('link', '<Button-1>', self._click_link)
+        # One tab per conversation; Ctrl+Tab moves between them
+        self.notebook = ttk.Notebook(self.master)
+        self.notebook.pack(expand=True, fill=tk.BOTH, padx=10, pady=10)
+        self.notebook.enable_traversal()
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+
+        # Search bar over the current tab's history, shown above the tabs
+        self.search_shown = False
+        self.search_after = None
+        self.search_tab = None
+        self.search_hits = []
+        self.search_frame = ttk.Frame(self.master, style="Dark.TFrame")
+        self.search_frame.columnconfigure(0, weight=1)
+        self.search_entry = ttk.Entry(self.search_frame, style="Dark.TEntry")
+        self.search_entry.grid(row=0, column=0, sticky="ew")
+        self.search_entry.bind("<KeyRelease>", self.schedule_search)
+        self.search_entry.bind("<Return>", self.jump_to_result)
+        self.search_entry.bind("<Down>", lambda event: self.search_results.focus_set())
+        self.search_entry.bind("<Escape>", self.toggle_search)
+        self.search_status = tk.Label(self.search_frame, text="", bg='#282c34', fg='#98C379', width=18, anchor="e")
+        self.search_status.grid(row=0, column=1, padx=(5, 0))
+        self.search_results = tk.Listbox(self.search_frame, height=6, bg='#1e2227', fg='#D3D3D3', selectbackground='#4f5966',
+                                         activestyle="none", highlightthickness=0, bd=0, exportselection=False)
+        self.search_results.grid(row=1, column=0, columnspan=2, sticky="ew", pady=(5, 0))
+        self.search_results.bind("<Double-Button-1>", self.jump_to_result)
+        self.search_results.bind("<Return>", self.jump_to_result)
+        self.search_results.bind("<Escape>", self.toggle_search)
+        self.master.bind("<Control-f>", self.toggle_search)
 
         self.master.bind("+", self.increase_font_size)
         self.master.bind("-", self.decrease_font_size)
@@ -211,13 +1000,18 @@ class ChatApp:
         self.input_field.grid(row=0, column=0, sticky="ew")
         self.input_field.bind("<Return>", self.send_message)
         self.input_field.bind("<Button-3>", self.input_popup_menu)
-        self.chat_display.bind("<Button-3>", self.popup_menu)
 
         send_button = ttk.Button(
             input_frame, text="Send", command=self.send_message, style="Dark.TButton"
         )
         send_button.grid(row=0, column=1, padx=(5, 0))
 
+        self.stop_button = ttk.Button(
+            input_frame, text="Stop", command=self.stop_generation, style="Dark.TButton", state=tk.DISABLED
+        )
+        self.stop_button.grid(row=0, column=2, padx=(5, 0))
+        self.master.bind("<Escape>", self.stop_generation)
+
         style = ttk.Style()
         style.theme_create(
             "Dark",
@@ -227,6 +1021,11 @@ class ChatApp:
                 "TEntry": {
                     "configure": {"fieldbackground": "#000000", "foreground": "#D3D3D3", "insertcolor": "#D3D3D3"}
                 },
+                "TNotebook": {"configure": {"background": "#282c34", "borderwidth": 0}},
+                "TNotebook.Tab": {
+                    "configure": {"background": "#1e2227", "foreground": "#D3D3D3", "padding": [8, 2]},
+                    "map": {"background": [("selected", "#4f5966")]},
+                },
                 "TButton": {
                     "configure": {
                         "background": "#4f5966",
@@ -243,24 +1042,13 @@ class ChatApp:
         style.theme_use("Dark")
 
     def load_settings(self):
-        if os.path.exists("settings.txt"):
-            with open("settings.txt", "r") as f:
-                loaded_settings = json.load(f)
-                # Merge loaded settings with default settings
-                self.settings = {**self.default_settings, **loaded_settings}
-                # Ensure window settings exist
-                if "window" not in self.settings:
-                    self.settings["window"] = self.default_settings["window"]
-        else:
-            self.settings = self.default_settings.copy()
-
-        # Ensure the model is valid
-        if self.settings["model"] not in self.available_models:
-            self.settings["model"] = self.available_models[0]
+        self.settings = merge_settings(self.settings_store.load())
+        self.settings_store.data = self.settings
 
     def save_settings(self):
-        with open("settings.txt", "w") as f:
-            json.dump(self.settings, f, indent=4)
+        # Explicit saves (settings window, exit) are written right away
+        self.settings_store.mark_dirty()
+        self.settings_store.flush()
 
     def save_settings_from_window(self):
         # Update settings from the entry fields
@@ -270,15 +1058,24 @@ class ChatApp:
         self.settings["top_p"] = float(self.top_p_entry.get())
         self.settings["top_k"] = int(self.top_k_entry.get())
         self.settings["max_tokens"] = int(self.max_tokens_entry.get())
-        self.settings["max_history_chars"] = int(self.max_history_chars_entry.get())
+        self.settings["max_history_tokens"] = int(self.max_history_tokens_entry.get())
+        self.settings["scrollback_turns"] = max(0, int(self.scrollback_turns_entry.get()))
         self.settings["model"] = self.model_var.get()
+        self.settings["response_cache"] = self.response_cache_var.get()
+        self.settings["history_summary"] = self.history_summary_var.get()
+        self.settings["retrieval_memory"] = self.retrieval_memory_var.get()
+        self.settings["max_parallel_requests"] = max(1, int(self.max_parallel_requests_entry.get()))
 
         # Update the current model
         self.model = self.settings["model"]
+        self.scheduler.set_limit(self.settings["max_parallel_requests"])
 
         # Save API key
         self.api_key = self.api_key_entry.get()
-        self.save_api_key()
+        save_api_key(self.api_key)
+        for tab in self.tabs:
+            tab.session.set_budget()
+            tab.session.api_key = self.api_key
 
         # Save settings to file
         self.save_settings()
@@ -309,7 +1106,10 @@ Before you start:
 
 Button Explanations:
 • Clear Screen: Clears the current chat screen. Chat history and context are not deleted.
-• Clear History: Erases all chat history. The screen will be cleared when this is done.
+• Clear History: Erases the chat history of the current tab. The screen will be cleared when this is done.
+• New Tab / Close Tab: Starts another conversation with its own history, or closes the current one and deletes its history.
+• Search (Ctrl+F): Searches the chat history of the current tab as you type. Double-click a result (or press Enter) to jump to it.
+• Stats: Shows how long the last answer took to connect, start and stream. Every answer is also recorded in metrics.jsonl.
 • Font Size (A+/-): Increases or decreases the font size of the chat display.
 • Settings (⚙): Opens the settings menu to configure the AI and enter your API Key.
 • Push Away (↔): Moves other windows away so the AI Assistant can stay in view.
@@ -317,11 +1117,16 @@ Button Explanations:
 • Minimize (_): Minimizes the window.
 • Maximize (□): Toggles between maximized and normal window size.
 • Close (X): Closes the application.
+• Stop (Esc): Stops the answer that is being written in the current tab. The part already written is kept.
 
 Additional Features:
 • Resize the window by dragging its edges.
 • Use + and - keys to increase or decrease font size.
 • Right-click on the chat display or input field for copy/paste options.
+• Tabs: every tab is a separate conversation, and answers in different tabs are written at the same time. Messages sent while all requests allowed by your ArliAI plan are busy wait their turn; the tab shows • while it is answering and how many messages are queued. Set Parallel Requests (in Settings) to your plan's limit. Ctrl+Tab switches tabs.
+• Summarize history (in Settings): when the conversation gets too long to send in full, the oldest part is summarized in the background so the assistant still remembers it.
+• Recall relevant older turns (in Settings): each message is matched against the whole chat history, and the older turns that fit it best are sent along with it.
+• Response Cache (in Settings): answers a repeated question from a saved answer instead of asking ArliAI.com again. "deterministic" only does this when Temperature is 0.
 
 Enjoy using Pursuer AI!
 
@@ -342,21 +1147,177 @@ https://www.singularityon.com/
         help_window.grab_set()
         self.master.wait_window(help_window)
 
-    def update_user_message(self, message):
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, f"You: {message}\n\n")
-        self.chat_display.see(tk.END)
-        self.chat_display.config(state=tk.DISABLED)
+    @property
+    def tab(self):
+        # The conversation in the selected tab
+        return self.tabs[self.notebook.index("current")]
+
+    def open_tabs(self):
+        # Empty tabs, so the window can be drawn; finish_startup() loads them
+        for entry in self.settings["tabs"]:
+            self.tabs.append(ChatTab(self, entry["name"], entry["history"]))
+        self.notebook.select(self.tabs[self.settings["active_tab"]].frame)
+
+    def on_first_map(self, event):
+        # Idle callbacks run in order, so this one comes after the redraws
+        # the window's mapping has scheduled
+        if event.widget is self.master and not self.started_up:
+            self.master.after_idle(self.finish_startup)
+
+    def finish_startup(self):
+        # What the window does not need to be drawn: the API key, the history
+        # of the selected tab and then of the others, and a connection to the
+        # API opened in the background before the first message
+        if self.started_up:
+            return
+        self.started_up = True
+        first_paint = time.time()
+        imported = list(sys.modules)
+        self.api_key = load_api_key()
+        for tab in self.tabs:
+            tab.session.api_key = self.api_key
+        self.tab.load_chat_history()
+        for tab in self.tabs:
+            self.master.after_idle(tab.load_chat_history)
+        self.engine.warm_up(self.settings["api_url"])
+        if os.environ.get(STARTUP_PROFILE_ENV) == "1":
+            self.master.after_idle(self.report_startup, first_paint, imported)
+
+    def report_startup(self, first_paint, imported):
+        # For profile_startup(), which runs the window in a child process
+        report = {"script_started": SCRIPT_STARTED, "first_paint": first_paint, "ready": time.time(),
+                  "imported_before_paint": imported}
+        print(STARTUP_PROFILE_MARK + json.dumps(report), flush=True)
+        for tab in self.tabs:
+            tab.session.close()
+        self.engine.close()
+        self.master.destroy()
+
+    def add_tab(self, name, history_file):
+        tab = ChatTab(self, name, history_file)
+        self.tabs.append(tab)
+        tab.load_chat_history()
+        return tab
+
+    def new_tab(self):
+        used = {entry["history"] for entry in self.settings["tabs"]}
+        number = len(self.tabs) + 1
+        while f"chat_history-{number}.jsonl" in used or os.path.exists(f"chat_history-{number}.jsonl"):
+            number += 1
+        tab = self.add_tab(f"Chat {number}", f"chat_history-{number}.jsonl")
+        self.save_tabs()
+        self.notebook.select(tab.frame)
+
+    def close_tab(self):
+        if len(self.tabs) == 1:
+            messagebox.showinfo("Close Tab", "The last tab cannot be closed. Use Clear History to start over.")
+            return
+        tab = self.tab
+        if not messagebox.askyesno("Close Tab", f"Close {tab.name}? Its chat history will be deleted."):
+            return
+        # Out of the list before the notebook selects another tab
+        self.tabs.remove(tab)
+        self.notebook.forget(tab.frame)
+        tab.close(delete_history=True)
+        self.save_tabs()
+
+    def save_tabs(self):
+        self.settings_store.set("tabs", [{"name": tab.name, "history": tab.session.history_file} for tab in self.tabs])
+
+    def on_tab_changed(self, event=None):
+        if not self.tabs:
+            return
+        self.settings_store.set("active_tab", self.notebook.index("current"))
+        self.update_stop_button()
+        if self.search_shown and self.search_tab is not self.tab:
+            self.run_search()
+
+    def toggle_search(self, event=None):
+        if self.search_shown:
+            self.search_frame.pack_forget()
+            self.input_field.focus_set()
+        else:
+            self.search_frame.pack(fill=tk.X, padx=10, pady=(10, 0), before=self.notebook)
+            self.search_entry.focus_set()
+            self.search_entry.select_range(0, tk.END)
+        self.search_shown = not self.search_shown
+        return "break"
+
+    def schedule_search(self, event=None):
+        # Searches once typing pauses instead of on every key
+        if event is not None and event.keysym in ("Return", "Escape", "Down", "Up"):
+            return
+        if self.search_after is not None:
+            self.master.after_cancel(self.search_after)
+        self.search_after = self.master.after(150, self.run_search)
+
+    def run_search(self):
+        self.search_after = None
+        query = self.search_entry.get()
+        self.search_tab = self.tab
+        started = time.perf_counter()
+        self.search_hits = self.search_tab.session.search(query)
+        elapsed = time.perf_counter() - started
+        self.search_results.delete(0, tk.END)
+        for hit in self.search_hits:
+            who = "You" if hit["role"] == "user" else "AI"
+            snippet = " ".join(hit["snippet"].split())
+            self.search_results.insert(tk.END, f"{hit['time'][:10]} {who}: {snippet}")
+        if not query.strip():
+            status = ""
+        elif self.search_tab.session.search_index is None:
+            status = "Search is not available"
+        else:
+            status = f"{len(self.search_hits)} found in {elapsed * 1000:.0f} ms"
+        self.search_status.config(text=status)
+
+    def jump_to_result(self, event=None):
+        if self.search_after is not None:
+            self.master.after_cancel(self.search_after)
+            self.run_search()
+        tab = self.search_tab
+        if not self.search_hits or tab is None or tab.closed:
+            return "break"
+        selection = self.search_results.curselection()
+        hit = self.search_hits[selection[0] if selection else 0]
+        self.notebook.select(tab.frame)
+        try:
+            found = tab.show_turn(hit["number"])
+        except Exception as e:
+            logging.error(f"Encounterd an issue loading older chat history: {str(e)}")
+            found = False
+        if not found:
+            self.search_status.config(text="Cleared from the screen")
+        return "break"
+
+    def on_queue_change(self, key):
+        # Called on the engine thread by the scheduler
+        self.run_on_ui(self.update_tab_label, key)
+
+    def update_tab_label(self, key):
+        for tab in self.tabs:
+            if tab.session is key:
+                self.notebook.tab(tab.frame, text=tab.title())
+        self.update_stop_button()
+
+    def update_stop_button(self):
+        busy = self.scheduler.busy(self.tab.session)
+        self.stop_button.config(state=tk.NORMAL if busy else tk.DISABLED)
 
     def clear_screen(self):
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.delete(1.0, tk.END)
-        self.chat_display.config(state=tk.DISABLED)
+        self.tab.clear_screen()
 
     def clear_history(self):
-        with open(self.chat_history_file, "w") as f:
-            f.write("")
-        self.clear_screen()
+        # Runs on the engine thread once the tab's requests have stopped, so
+        # an answer still being written is recorded before the clear marker
+        # and not after it
+        tab = self.tab
+
+        def clear():
+            tab.session.clear_history()
+            self.run_on_ui(tab.clear_screen, tab.session.record_count)
+
+        self.scheduler.stop((tab.session, (tab.session, "summary")), clear)
 
     def start_move(self, event):
         self.dragging = True
@@ -365,6 +1326,7 @@ https://www.singularityon.com/
 
     def stop_move(self, event):
         self.dragging = False
+        self.save_window_position()  # Save position after moving
 
     def do_move(self, event):
         if self.dragging:
@@ -375,7 +1337,6 @@ https://www.singularityon.com/
             self.master.geometry(f"+{x}+{y}")
             self.start_x = event.x_root
             self.start_y = event.y_root
-        self.save_window_position()  # Save position after moving
 
     def add_resize_functionality(self):
         self.master.bind("<Button-1>", self.start_resize)
@@ -391,6 +1352,8 @@ https://www.singularityon.com/
 
     def stop_resize(self, event):
         if not self.dragging:
+            if self.resizing:
+                self.save_window_position()  # Save position after resizing
             self.resizing = ""
 
     def get_resize_edge(self, event):
@@ -429,7 +1392,6 @@ https://www.singularityon.com/
             new_h = max(new_h, 200)
 
             self.master.geometry(f"{new_w}x{new_h}+{new_x}+{new_y}")
-            self.save_window_position()  # Save position after resizing
 
     def toggle_maximize(self):
         if self.maximized:
@@ -449,17 +1411,21 @@ https://www.singularityon.com/
 
     def on_close(self):
         self.save_window_position()
-        self.save_settings()
+        self.settings_store.flush()
+        for tab in self.tabs:
+            tab.session.close()
+        self.engine.close()
         self.master.destroy()
 
     def save_window_position(self):
-        self.settings["window"] = {
+        # Only marks the settings dirty; the store writes them once the window
+        # has stopped moving
+        self.settings_store.set("window", {
             "width": self.master.winfo_width(),
             "height": self.master.winfo_height(),
             "x": self.master.winfo_x(),
             "y": self.master.winfo_y()
-        }
-        self.save_settings()
+        })
 
     def toggle_stay_on_top(self):
         if self.master.attributes('-topmost'):
@@ -473,6 +1439,8 @@ https://www.singularityon.com/
         if hasattr(self, 'settings_window') and self.settings_window.winfo_exists():
             self.settings_window.lift()
             return
+        # The API key field needs the key
+        self.finish_startup()
 
         self.settings_window = tk.Toplevel(self.master)
         self.settings_window.title("Settings")
@@ -545,13 +1513,51 @@ https://www.singularityon.com/
         self.max_tokens_entry.pack(side=tk.RIGHT, expand=True, fill=tk.X)
         self.max_tokens_entry.insert(0, str(self.settings["max_tokens"]))
 
-        # Max History Chars
-        max_history_chars_frame = tk.Frame(main_frame)
-        max_history_chars_frame.pack(fill=tk.X, pady=5)
-        tk.Label(max_history_chars_frame, text="Max History Chars:").pack(side=tk.LEFT)
-        self.max_history_chars_entry = tk.Entry(max_history_chars_frame, width=50)
-        self.max_history_chars_entry.pack(side=tk.RIGHT, expand=True, fill=tk.X)
-        self.max_history_chars_entry.insert(0, str(self.settings["max_history_chars"]))
+        # Max History Tokens
+        max_history_tokens_frame = tk.Frame(main_frame)
+        max_history_tokens_frame.pack(fill=tk.X, pady=5)
+        tk.Label(max_history_tokens_frame, text="Max History Tokens (0 = all that fits):").pack(side=tk.LEFT)
+        self.max_history_tokens_entry = tk.Entry(max_history_tokens_frame, width=50)
+        self.max_history_tokens_entry.pack(side=tk.RIGHT, expand=True, fill=tk.X)
+        self.max_history_tokens_entry.insert(0, str(self.settings["max_history_tokens"]))
+
+        # Scrollback Turns
+        scrollback_turns_frame = tk.Frame(main_frame)
+        scrollback_turns_frame.pack(fill=tk.X, pady=5)
+        tk.Label(scrollback_turns_frame, text="Scrollback Turns (0 = no limit):").pack(side=tk.LEFT)
+        self.scrollback_turns_entry = tk.Entry(scrollback_turns_frame, width=50)
+        self.scrollback_turns_entry.pack(side=tk.RIGHT, expand=True, fill=tk.X)
+        self.scrollback_turns_entry.insert(0, str(self.settings["scrollback_turns"]))
+
+        # History Summary
+        history_summary_frame = tk.Frame(main_frame)
+        history_summary_frame.pack(fill=tk.X, pady=5)
+        self.history_summary_var = tk.BooleanVar(value=self.settings["history_summary"])
+        tk.Checkbutton(history_summary_frame, text="Summarize history that no longer fits",
+                       variable=self.history_summary_var).pack(side=tk.LEFT)
+
+        # Retrieval Memory
+        retrieval_memory_frame = tk.Frame(main_frame)
+        retrieval_memory_frame.pack(fill=tk.X, pady=5)
+        self.retrieval_memory_var = tk.BooleanVar(value=self.settings["retrieval_memory"])
+        tk.Checkbutton(retrieval_memory_frame, text="Recall relevant older turns",
+                       variable=self.retrieval_memory_var).pack(side=tk.LEFT)
+
+        # Response Cache
+        response_cache_frame = tk.Frame(main_frame)
+        response_cache_frame.pack(fill=tk.X, pady=5)
+        tk.Label(response_cache_frame, text="Response Cache:").pack(side=tk.LEFT)
+        self.response_cache_var = tk.StringVar(value=self.settings["response_cache"])
+        response_cache_menu = tk.OptionMenu(response_cache_frame, self.response_cache_var, *RESPONSE_CACHE_MODES)
+        response_cache_menu.pack(side=tk.RIGHT, expand=True, fill=tk.X)
+
+        # Parallel Requests
+        max_parallel_requests_frame = tk.Frame(main_frame)
+        max_parallel_requests_frame.pack(fill=tk.X, pady=5)
+        tk.Label(max_parallel_requests_frame, text="Parallel Requests (your plan's limit):").pack(side=tk.LEFT)
+        self.max_parallel_requests_entry = tk.Entry(max_parallel_requests_frame, width=50)
+        self.max_parallel_requests_entry.pack(side=tk.RIGHT, expand=True, fill=tk.X)
+        self.max_parallel_requests_entry.insert(0, str(self.settings["max_parallel_requests"]))
 
         save_button = tk.Button(self.settings_window, text="Save", command=self.save_settings_from_window)
         save_button.pack(pady=10)
@@ -566,8 +1572,9 @@ https://www.singularityon.com/
 
     def update_font(self):
         self.font.configure(size=self.font_size)
-        self.chat_display.configure(font=self.font)
-        self.chat_display.update()
+        for tab in self.tabs:
+            tab.chat_display.configure(font=self.font)
+        self.master.update()
 
     def input_popup_menu(self, event):
         try:
@@ -597,7 +1604,7 @@ https://www.singularityon.com/
 
     def popup_menu(self, event):
         try:
-            self.chat_display.focus_set()
+            self.tab.chat_display.focus_set()
             popup = tk.Menu(self.master, tearoff=0)
             popup.add_command(label="Copy", command=self.copy_chat_display)
             popup.tk_popup(event.x_root, event.y_root, 0)
@@ -608,330 +1615,120 @@ https://www.singularityon.com/
 
     def copy_chat_display(self):
         try:
-            selected_text = self.chat_display.get(tk.SEL_FIRST, tk.SEL_LAST)
+            selected_text = self.tab.chat_display.get(tk.SEL_FIRST, tk.SEL_LAST)
             self.master.clipboard_clear()
             self.master.clipboard_append(selected_text)
         except tk.TclError:
             pass  # No selection
 
-    def load_chat_history(self):
-        try:
-            with open(self.chat_history_file, "r", encoding="utf-8") as f:
-                history = f.read()
-                self.chat_display.config(state=tk.NORMAL)
-                self.chat_display.insert(tk.END, history)
-                self.chat_display.config(state=tk.DISABLED)
-        except UnicodeDecodeError:
-            # If UTF-8 fails, try with 'iso-8859-1' encoding
-            try:
-                with open(self.chat_history_file, "r", encoding="iso-8859-1") as f:
-                    history = f.read()
-                    self.chat_display.config(state=tk.NORMAL)
-                    self.chat_display.insert(tk.END, history)
-                    self.chat_display.config(state=tk.DISABLED)
-            except Exception as e:
-                error_message = f"Encounterd an issue loading chat history: {str(e)}"
-                self.update_chat_display(error_message)
-                logging.error(error_message)
-        except FileNotFoundError:
-            pass
-        except Exception as e:
-            error_message = f"Encounterd an issue loading chat history: {str(e)}"
-            self.update_chat_display(error_message)
-            logging.error(error_message)
-
-    def save_chat_history(self):
-        try:
-            with open(self.chat_history_file, "w", encoding="utf-8") as f:
-                f.write(self.chat_display.get("1.0", tk.END))
-        except Exception as e:
-            error_message = f"Error saving chat history: {str(e)}"
-            self.update_chat_display(error_message)
-            logging.error(error_message)
-
     def signal_handler(sig, frame):
         print('\nYou pressed Ctrl+C!')
         sys.exit(0)            
 
     def send_message(self, event=None):
         user_message = self.input_field.get()
-        if not user_message:
+        if not user_message or not self.tab.loaded:
             return
-        
-        # Update chat display with user message
-        self.update_user_message(user_message)
-
         self.input_field.delete(0, tk.END)
 
-        # Replace the text area with the "Please Wait..." message
-        self.input_field.insert(0, "Please Wait...")
-        self.input_field.config(state=tk.DISABLED)
-
-        # Get the chat history
-        chat_history = self.chat_display.get("1.0", "end-1c") # Get all text except the last newline
-
-        # Format the chat history
-        formatted_history = []
-        current_speaker = None
-        current_message = ""
-
-        for line in chat_history.split("\n"):
-            if line.startswith("You: "):
-                if current_speaker and current_message:
-                    formatted_history.append({"role": current_speaker, "content": current_message.strip()})
-                current_speaker = "user"
-                current_message = line[5:]
-            elif current_speaker == "user" and line.strip() and not line.startswith("You: "):
-                # This is a continuation of the user's message
-                current_message += " " + line.strip()
-            elif current_speaker == "assistant" or (current_speaker is None and line.strip()):
-                # This is either a continuation of the AI's message or the start of a new AI message
-                if current_speaker and current_message:
-                    formatted_history.append({"role": current_speaker, "content": current_message.strip()})
-                current_speaker = "assistant"
-                current_message = line.strip()
-            elif line.strip() == "":
-                if current_speaker and current_message:
-                    formatted_history.append({"role": current_speaker, "content": current_message.strip()})
-                    current_speaker = None
-                    current_message = ""
-
-        # Add the last message if there's any
-        if current_speaker and current_message:
-            formatted_history.append({"role": current_speaker, "content": current_message.strip()})
-
-        # Remove the last user message from the history if it's the same as the current message
-        if formatted_history and formatted_history[-1]["role"] == "user" and formatted_history[-1]["content"] == user_message:
-            formatted_history.pop()
-
-        # Truncate the chat history to the last max_history_chars characters
-        while len(str(formatted_history)) > self.settings["max_history_chars"]:
-            formatted_history.pop(0)
-
-        # Prepare the messages for the API request
-        messages = [
-            {"role": "system", "content": self.settings["system_prompt"]},
-            *formatted_history,
-            {"role": "user", "content": user_message}
-        ]
-
-        threading.Thread(target=self.make_api_request, args=(messages,)).start()
-
-    def update_chat_display(self, text):
-        #self.master.after(0, self._update_chat_display, text)
-        self.master.after(0, self._update_chat_display, text)
-
-    def _update_chat_display(self, text):
-        self.chat_display.config(state=tk.NORMAL)
-
-        if not self.current_line:
-            self.in_code_block = False
-            self.current_format.clear()
-        
-        # Process the incoming text
-        self.current_line += text
-        lines = self.current_line.split('\n')
-        
-        # Process all complete lines
-        for line in lines[:-1]:
-            self._process_line(line)
-        
-        # Keep the last incomplete line
-        self.current_line = lines[-1]
-
-        self.chat_display.see(tk.END)
-        self.chat_display.config(state=tk.DISABLED)
-
-    def _process_line(self, line):
-        #Reset formatting at the start of each line
-        current_tags = tuple(self.current_format)
-        
-        # Check for code block start/end
-        if line.strip().startswith('```'):
-            if self.in_code_block:
-                # End of code block
-                self.in_code_block = False
-                self.chat_display.insert(tk.END, '\n')
-            else:
-                # Start of code block
-                self.in_code_block = True
-                self.code_language = line.strip()[3:].strip()  # Get language specifier if any
-            return
-
-        if self.in_code_block:
-            self.chat_display.insert(tk.END, line + '\n', 'code')
-            return
-
-        # Headers
-        if line.startswith('# '):
-            self.chat_display.insert(tk.END, line[2:] + '\n', 'h1')
-            return
-        elif line.startswith('## '):
-            self.chat_display.insert(tk.END, line[3:] + '\n', 'h2')
-            return
-        elif line.startswith('### '):
-            self.chat_display.insert(tk.END, line[4:] + '\n', 'h3')
-            return
-        elif line.startswith('#### '):
-            self.chat_display.insert(tk.END, line[5:] + '\n', 'h4')
-            return
-        elif line.startswith('##### '):
-            self.chat_display.insert(tk.END, line[6:] + '\n', 'h5')
-            return
-        elif line.startswith('###### '):
-            self.chat_display.insert(tk.END, line[7:] + '\n', 'h6')
+        # The input stays open while answers are written. The message waits in
+        # the tab's queue until the tab's previous answer is done and the
+        # scheduler has a free request slot, and is then sent with the history
+        # as it is at that point.
+        tab = self.tab
+        submitted = time.perf_counter()
+        self.scheduler.submit(tab.session, lambda: self.make_api_request(tab, user_message, submitted))
+
+    def stop_generation(self, event=None):
+        # Cancelling the task on the engine loop closes the response right
+        # away, which also frees the request slot on the server side.
+        # Messages still queued in the tab are sent afterwards.
+        self.scheduler.cancel(self.tab.session)
+
+    def run_on_ui(self, fn, *args):
+        # Everything the engine thread wants done to widgets goes through here
+        self.ui_queue.put(("call", (fn, args)))
+
+    def pump_ui(self):
+        # Drains everything queued since the last tick and applies it as one
+        # batch: one state toggle, one render pass per run of text, one scroll.
+        # At high token rates this turns hundreds of Tk events per second into
+        # at most render_fps updates.
+        # Text for different tabs is rendered in separate runs.
+        text = []
+        rendered = set()
+        try:
+            while True:
+                try:
+                    kind, payload = self.ui_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == "text":
+                    if text and text[0][0] is not payload[0]:
+                        self._render_batch(text, rendered)
+                        text = []
+                    text.append(payload)
+                    continue
+                if text:
+                    self._render_batch(text, rendered)
+                    text = []
+                fn, args = payload
+                fn(*args)
+            if text:
+                self._render_batch(text, rendered)
+        except Exception as e:
+            logging.error(f"Error updating the chat display: {str(e)}")
+        for tab in rendered:
+            if not tab.closed:
+                tab.chat_display.see(tk.END)
+                tab.chat_display.config(state=tk.DISABLED)
+        self.master.after(self.ui_interval, self.pump_ui)
+
+    def _render_batch(self, text, rendered):
+        tab = text[0][0]
+        if tab.closed:
             return
-
-        elif line.strip().startswith('* ') or line.strip().startswith('- '):
-            # Bullet points with possible nested formatting
-            bullet = "  • "
-            content = line.strip()[2:]
-            self.chat_display.insert(tk.END, bullet)
-        
-            # Check if the content is a header example
-            header_match = re.match(r'(H[1-6]): (#{1,6} .+)', content)
-            if header_match:
-                header_type, header_content = header_match.groups()
-                self.chat_display.insert(tk.END, f"{header_type}: ")
-                self._process_line(header_content)  # Process the header content
-            else:
-                self._process_inline_formatting(content)
-        
-            self.chat_display.insert(tk.END, '\n')
-        elif re.match(r'^\d+\.\s', line.strip()):
-            # Numbered list with possible nested formatting
-            match = re.match(r'^(\d+\.\s)(.*)$', line.strip())
-            if match:
-                number, content = match.groups()
-                self.chat_display.insert(tk.END, number)
-            
-            # Check if the content is a header example
-            header_match = re.match(r'(H[1-6]): (#{1,6} .+)', content)
-            if header_match:
-                header_type, header_content = header_match.groups()
-                self.chat_display.insert(tk.END, f"{header_type}: ")
-                self._process_line(header_content)  # Process the header content
-            else:
-                self._process_inline_formatting(content)
-            
-            self.chat_display.insert(tk.END, '\n')
-        else:
-            # Regular line with inline formatting
-            self._process_inline_formatting(line)
-            self.chat_display.insert(tk.END, '\n')
-
-    def _process_inline_formatting(self, text):
-        parts = re.split(r'(\[.*?\]\(.*?\)|`.*?`|\*\*.*?\*\*|\*.*?\*|~~.*?~~|!\[.*?\]\(.*?\))', text)
-        for part in parts:
-            if part.startswith('[') and '](' in part and part.endswith(')'):
-                text, url = part[1:-1].split('](')
-                tag_name = f'link-{self.link_count}'
-                self.chat_display.insert(tk.END, text, ('link', tag_name))
-                self.chat_display.tag_bind(tag_name, '<Button-1>', lambda e, url=url: self._click_link(url))
-                self.link_count += 1
-            elif part.startswith('`') and part.endswith('`'):
-                self.chat_display.insert(tk.END, part[1:-1], 'code')
-            elif part.startswith('**') and part.endswith('**'):
-                self.chat_display.insert(tk.END, part[2:-2], 'bold')
-            elif part.startswith('*') and part.endswith('*'):
-                self.chat_display.insert(tk.END, part[1:-1], 'italic')
-            elif part.startswith('~~') and part.endswith('~~'):
-                self.chat_display.insert(tk.END, part[2:-2], 'strikethrough')
-            elif part.startswith('![') and '](' in part and part.endswith(')'):
-                alt_text, url = part[2:-1].split('](')
-                self.chat_display.insert(tk.END, f"[Image: {alt_text}]")
-            else:
-                self.chat_display.insert(tk.END, part)
+        tab.render("".join(piece for _, piece, queued in text), text[0][2])
+        rendered.add(tab)
 
     def _click_link(self, url):
+        # Only needed when a link is clicked, so not imported at startup
+        import webbrowser
         webbrowser.open(url)
 
-    def create_retry_session(retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 504)):
-        session = requests.Session()
-        retry = Retry(
-            total=retries,
-            read=retries,
-            connect=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=status_forcelist,
-        )
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        return session
-
-    def make_api_request(self, messages):
+    def toggle_stats_overlay(self):
+        shown = not self.settings["stats_overlay"]
+        for tab in self.tabs:
+            tab.show_stats(shown)
+        self.settings_store.set("stats_overlay", shown)
+
+    async def make_api_request(self, tab, user_message, submitted):
+        # Runs as a task on the streaming engine's event loop once the
+        # scheduler has given the tab a request slot
+        metrics = RequestMetrics(self.settings["model"])
+        metrics.queued = metrics.started - submitted
+        # aprepare() records the question as the next turn of the history
+        self.run_on_ui(tab.start_request, user_message, metrics, tab.session.record_count)
         try:
-            url = "https://api.arliai.com/v1/chat/completions"
-
-            payload = json.dumps({
-                "model": self.settings["model"],
-                "messages": messages,
-                "repetition_penalty": self.settings["repetition_penalty"],
-                "temperature": self.settings["temperature"],
-                "top_p": self.settings["top_p"],
-                "top_k": self.settings["top_k"],
-                "max_tokens": self.settings["max_tokens"],
-                "stream": True
-            })
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f"Bearer {self.api_key}"
-            }
-
-            response = requests.request("POST", url, headers=headers, data=payload, stream=True, timeout=(15, 35))
-
-            if response.status_code == 200:
-                full_response = ""
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        #logging.info(f"Received line: {decoded_line}")
-                        if decoded_line.startswith("data: "):
-                            if decoded_line.strip() == "data: [DONE]":
-                                # Stream finished, do any cleanup if needed
-                                self.save_chat_history()
-                                #self.wait_label.place_forget()
-                                self.input_field.config(state=tk.NORMAL)
-                                self.input_field.delete(0, tk.END)
-                                self.update_chat_display("\n\n\n")  # Add a newline after the full response
-                                break
-                            try:
-                                json_data = json.loads(decoded_line[6:])
-                                if 'choices' in json_data and json_data['choices']:
-                                    delta = json_data['choices'][0].get('delta', {})
-                                    if 'content' in delta:
-                                        content = delta['content']
-                                        full_response += content
-                                        #self.master.after(0, self._update_chat_display, content)
-                                        self.update_chat_display(content)
-                            except json.JSONDecodeError as json_error:
-                                logging.error(f"JSON decode error: {str(json_error)}")
-                                logging.error(f"Problematic line: {decoded_line}")
-                                print("An issue has occured and has been logged in error_log.txt")
-                                continue
-                        else:
-                            self.update_chat_display(f"Unexpected error, line format: {decoded_line}\n")
-            else:
-                error_message = f"API request failed with status code {response.status_code}"
-                #self.master.after(0, self._update_chat_display, error_message)
-                self.update_chat_display(error_message, is_user=False)
-                logging.error(f"API request failed: {error_message}")
-                logging.error(f"Response content: {response.text}")
-                self.wait_label.place_forget()
-
-        except requests.exceptions.RequestException as e:
-            error_message = f"Please check your Internet Connection, or ArliAI.com service may be temporarily down. \n Network error: {str(e)}"
-            self.update_chat_display(error_message, is_user=False)
-            logging.error(f"Network error in API call: {str(e)}")
-            print("A network issue has occured and has been logged in error_log.txt")
+            messages = await tab.session.aprepare(user_message, metrics)
+            await tab.session.stream_reply(messages, tab.update_chat_display, metrics)
+            tab.update_chat_display("\n\n\n")  # Add a newline after the full response
+        except asyncio.CancelledError:
+            tab.update_chat_display("\n\n\n")
+            raise
         except Exception as e:
-            error_message = f"Unexpected error: {str(e)}"
-            self.update_chat_display(error_message, is_user=False)
-            logging.error(f"Unexpected error in API call: {str(e)}")
-            print("An issue with the server has occured and has been logged in error_log.txt")
+            tab.update_chat_display(describe_error(e) + "\n\n\n")
+            log_error(e)
+            if isinstance(e, NetworkError):
+                print("A network issue has occured and has been logged in error_log.txt")
+            elif not isinstance(e, ApiError):
+                print("An issue with the server has occured and has been logged in error_log.txt")
+        finally:
+            self.run_on_ui(tab.finish_request, metrics)
 
 if __name__ == "__main__":
+    # Only when run as a program, so importing this file writes no log
+    setup_logging()
     print("Pursuer AI is Starting. Version 1.0. Created by alby13 - https://singularityon.com")
     print("")
     root = tk.Tk()
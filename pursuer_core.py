@@ -0,0 +1,3080 @@
+# Pursuer AI core: conversation, history, network and settings without any UI.
+# The window in pursuer-ai.py and the command line mode below are both built
+# on this module, and importing it never loads tkinter.
+# Uses only the Python standard library
+# Created by alby13 - https://www.singularityon.com
+
+import os
+import sys
+import asyncio
+import atexit
+import concurrent.futures
+import contextvars
+import logging
+import logging.handlers
+import socket
+import ssl
+import threading
+import queue
+import struct
+import time
+import re
+import hashlib
+import sqlite3
+import functools
+import heapq
+import math
+from collections import OrderedDict, deque
+from datetime import datetime
+from urllib.parse import urlsplit
+import json
+
+API_URL = "https://api.arliai.com/v1/chat/completions"
+
+LOG_FILE = "error_log.txt"
+METRICS_FILE = "metrics.jsonl"
+RESPONSE_CACHE_DIR = "response_cache"
+SETTINGS_FILE = "settings.txt"
+API_KEY_FILE = "api_key.txt"
+CHAT_HISTORY_FILE = "chat_history.jsonl"
+# Older versions kept a plain text transcript; it is imported into the
+# journal the first time it is found.
+LEGACY_HISTORY_FILE = "chat_history.txt"
+
+AVAILABLE_MODELS = ["Meta-Llama-3.1-8B-Instruct", "Mistral-Nemo-12B-Instruct-2407"]
+
+# "deterministic" only caches requests sent with temperature 0
+RESPONSE_CACHE_MODES = ("off", "deterministic", "always")
+
+DEFAULT_SETTINGS = {
+    "system_prompt": "You are a helpful AI assistant.",
+    "repetition_penalty": 1.0,
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "top_k": 40,
+    "max_tokens": 1024,
+    # 0 sends as much history as fits in the model's context
+    "max_history_tokens": 0,
+    # 0 uses the context length of the model's profile
+    "context_length": 0,
+    "history_fsync": "interval",
+    "history_page_turns": 50,
+    # Turns kept in the chat display; older ones are paged back in from the
+    # history when scrolled to (0 keeps everything)
+    "scrollback_turns": 200,
+    # Full-text search over the history, kept in <history>.search.db
+    "search_index": True,
+    "render_fps": 30,
+    "metrics": True,
+    "stats_overlay": False,
+    # Summarize turns that no longer fit instead of only dropping them
+    "history_summary": False,
+    "summary_max_tokens": 300,
+    # Add the older turns that best match each message (BM25 over the whole
+    # history), up to memory_turns of them within memory_tokens
+    "retrieval_memory": False,
+    "memory_turns": 4,
+    "memory_tokens": 600,
+    "response_cache": "off",
+    "response_cache_entries": 128,
+    "response_cache_bytes": 20000000,
+    # Requests the ArliAI account may have running at once, shared by all
+    # conversations
+    "max_parallel_requests": 1,
+    # One entry per conversation tab, each with its own history journal
+    "tabs": [{"name": "Chat 1", "history": CHAT_HISTORY_FILE}],
+    "active_tab": 0,
+    "model": AVAILABLE_MODELS[0],
+    # Any OpenAI-compatible endpoint works, e.g. the mock server in benchmarks/
+    "api_url": API_URL,
+    "window": {
+        "width": 800,
+        "height": 600,
+        "x": 100,
+        "y": 100
+    }
+}
+
+class CustomHandler(logging.Handler):
+    def emit(self, record):
+        current_time = datetime.now().strftime('%H:%M:%S')
+        print(f"Log file updated at {current_time}.")
+
+# The request being worked on by the current task, added to its log records
+LOG_CONTEXT = contextvars.ContextVar("pursuer_log_context", default=None)
+
+class ContextFilter(logging.Filter):
+    # Gives every record request_id and model fields (None outside a
+    # request) and `context`, the two of them ready to append to a line
+    def filter(self, record):
+        context = LOG_CONTEXT.get()
+        record.request_id, record.model = context or (None, None)
+        record.context = f" [request {context[0]}, {context[1]}]" if context else ""
+        return True
+
+class RepeatFilter(logging.Filter):
+    # Lets the first of a run of identical warnings or errors through and
+    # only counts the rest for `interval` seconds; the first one after that
+    # says how many were left out. A stream of bad events or a dead
+    # connection then costs a few lines instead of thousands.
+    def __init__(self, interval=60.0, max_keys=256):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.seen = {}
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, record.getMessage())
+        now = time.monotonic()
+        with self.lock:
+            seen = self.seen.get(key)
+            if seen is not None and now < seen[0]:
+                seen[1] += 1
+                return False
+            if len(self.seen) >= self.max_keys:
+                self.seen = {k: v for k, v in self.seen.items() if now < v[0] or v[1]}
+            self.seen[key] = [now + self.interval, 0]
+        if seen is not None and seen[1]:
+            record.msg = f"{key[2]} (repeated {seen[1]} more times)"
+            record.args = None
+        return True
+
+# Listener threads of queued_handler(), stopped at exit
+log_listeners = []
+
+def queued_handler(*handlers):
+    # A handler that only puts records on a queue; `handlers` run on a
+    # listener thread, so nobody that logs ever waits for the disk or console
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    if not log_listeners:
+        atexit.register(stop_logging)
+    log_listeners.append(listener)
+    return logging.handlers.QueueHandler(records)
+
+def stop_logging():
+    # Writes out everything still queued
+    while log_listeners:
+        log_listeners.pop().stop()
+
+def setup_logging(log_file=LOG_FILE, console=True, max_bytes=1000000, backups=3):
+    # Configure error logging. Nothing is configured on import, so the module
+    # can be used from other programs without touching their logging.
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s%(context)s')
+    handlers = [logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")]
+    if console:
+        handlers.append(logging.StreamHandler())
+        notice = CustomHandler()
+        notice.addFilter(logging.Filter("__main__"))
+        handlers.append(notice)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    handler = queued_handler(*handlers)
+    # Records are formatted once they come off the queue
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.addFilter(ContextFilter())
+    handler.addFilter(RepeatFilter())
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+    logger = logging.getLogger("__main__")
+    logger.setLevel(logging.WARNING)
+    return logger
+
+def metrics_logger(path=METRICS_FILE, max_bytes=1000000, backups=3):
+    # One JSON object per line, rotated like the log so it can be left on
+    logger = logging.getLogger("pursuer.metrics")
+    if not logger.handlers:
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(queued_handler(handler))
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+def merge_settings(loaded_settings):
+    # Merge loaded settings with default settings
+    settings = {**DEFAULT_SETTINGS, **loaded_settings}
+    # Older settings files budget history in characters
+    if "max_history_chars" in settings:
+        max_history_chars = settings.pop("max_history_chars")
+        if "max_history_tokens" not in loaded_settings and max_history_chars != 4000:
+            # A limit the user chose is kept, at about four characters to a
+            # token; the old default becomes "whatever fits"
+            settings["max_history_tokens"] = max(1, int(max_history_chars / 4))
+    # Ensure window settings exist
+    if not isinstance(settings.get("window"), dict):
+        settings["window"] = dict(DEFAULT_SETTINGS["window"])
+    # Ensure the model is valid
+    if settings["model"] not in AVAILABLE_MODELS:
+        settings["model"] = AVAILABLE_MODELS[0]
+    if settings["history_fsync"] not in ChatJournal.FSYNC_POLICIES:
+        settings["history_fsync"] = DEFAULT_SETTINGS["history_fsync"]
+    if settings["response_cache"] not in RESPONSE_CACHE_MODES:
+        settings["response_cache"] = DEFAULT_SETTINGS["response_cache"]
+    tabs = settings["tabs"]
+    if not isinstance(tabs, list) or not tabs or not all(isinstance(tab, dict) and tab.get("history") for tab in tabs):
+        tabs = DEFAULT_SETTINGS["tabs"]
+    settings["tabs"] = [{"name": tab.get("name") or f"Chat {i + 1}", "history": tab["history"]} for i, tab in enumerate(tabs)]
+    if not 0 <= settings["active_tab"] < len(settings["tabs"]):
+        settings["active_tab"] = 0
+    settings["max_parallel_requests"] = max(1, int(settings["max_parallel_requests"]))
+    settings["scrollback_turns"] = max(0, int(settings["scrollback_turns"]))
+    return settings
+
+def load_api_key(path=API_KEY_FILE):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+def save_api_key(api_key, path=API_KEY_FILE):
+    with open(path, "w") as f:
+        f.write(api_key)
+
+# Context each model is served with, and the longest answer it will write.
+# An answer never runs past max_tokens, so reserving more room than that for
+# it would only take space the history could use. token_scale adjusts the
+# estimate below for the model's tokenizer.
+MODEL_PROFILES = {
+    "Meta-Llama-3.1-8B-Instruct": {"context_length": 8192, "max_tokens": 4096, "token_scale": 1.0},
+    "Mistral-Nemo-12B-Instruct-2407": {"context_length": 8192, "max_tokens": 4096, "token_scale": 1.08},
+}
+DEFAULT_MODEL_PROFILE = {"context_length": 4096, "max_tokens": 2048, "token_scale": 1.1}
+
+# Role header and separators the chat template wraps around every message
+MESSAGE_TOKEN_OVERHEAD = 4
+
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+SUMMARY_PROMPT = ("You keep the memory of a conversation between a user and an assistant. Rewrite the summary so far "
+                  "and the turns that follow it as one summary of at most {words} words. Keep names, facts, decisions, "
+                  "preferences, open questions and anything the user asked to remember. Write only the summary.")
+
+MEMORY_HEADER = "Earlier parts of the conversation that may be relevant:"
+
+# Splits text the way BPE pre-tokenizers (Llama 3, Tekken) do before merging:
+# contractions, words with their leading space, runs of up to three digits,
+# punctuation runs and whitespace. Most pieces end up as a single token.
+TOKEN_PIECES = re.compile(r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\w]?[^\W\d_]+|\d{1,3}| ?[^\s\w]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""")
+
+def model_profile(model):
+    return MODEL_PROFILES.get(model, DEFAULT_MODEL_PROFILE)
+
+@functools.lru_cache(maxsize=1024)
+def estimate_tokens(text, model):
+    # Local estimate of the tokens a message costs, without shipping the real
+    # tokenizers. Words and punctuation are costed piece by piece, so code and
+    # non-English text (which split into many more tokens per character than
+    # English prose) are not badly under-counted.
+    count = 0
+    for piece in TOKEN_PIECES.findall(text):
+        length = len(piece)
+        if length <= 6 and piece.isascii():
+            count += 1
+        elif piece.isascii():
+            if piece[-1].isalpha():
+                # Common words are one token; longer ones split every few letters
+                count += 1 + max(0, length - 7) // 4
+            else:
+                count += (length + 1) // 2
+        else:
+            # CJK is about a token per character, other scripts and symbols a
+            # token per two or three characters
+            wide = sum(1 for char in piece if ord(char) >= 0x2E80)
+            count += wide + (length - wide + 2) // 3
+    return int(count * model_profile(model)["token_scale"]) + 1 + MESSAGE_TOKEN_OVERHEAD
+
+def context_budget(settings):
+    # Tokens the system prompt, the history and the new message may use
+    # together: the model's context minus the room kept for the answer,
+    # capped by max_history_tokens when that is set.
+    profile = model_profile(settings["model"])
+    context_length = settings["context_length"] or profile["context_length"]
+    budget = context_length - min(settings["max_tokens"], profile["max_tokens"])
+    if settings["max_history_tokens"]:
+        budget = min(budget, settings["max_history_tokens"])
+    return max(0, budget)
+
+class Turn:
+    # A single message in the conversation; the size is cached so building a
+    # request never has to measure the same text twice.
+    __slots__ = ("role", "content", "chars", "tokens", "number")
+
+    def __init__(self, role, content, number=None):
+        self.role = role
+        self.content = content
+        self.chars = len(content)
+        self.tokens = {}
+        # Record number in the history journal
+        self.number = number
+
+    def token_count(self, model):
+        count = self.tokens.get(model)
+        if count is None:
+            count = self.tokens[model] = estimate_tokens(self.content, model)
+        return count
+
+    def as_message(self):
+        return {"role": self.role, "content": self.content}
+
+class ContextWindow:
+    # The newest turns of the conversation that fit in the token budget, kept
+    # as turns[start:] with a running total of their tokens. Building a request
+    # moves `start` forward to drop the oldest turns, or back to take older
+    # turns in again when there is room (after a long message, or when the
+    # budget grows), so the request always carries as much history as fits
+    # and no turn is ever measured twice.
+    def __init__(self, turns, model, budget):
+        self.last_dropped_turns = 0
+        self.last_dropped_tokens = 0
+        self.reset(turns, model, budget)
+
+    def reset(self, turns, model, budget):
+        # Refill from the newest turn backwards; only needed when the model or
+        # the budget changes, or the conversation starts over.
+        self.turns = turns
+        self.model = model
+        self.budget = budget
+        self.start = len(turns)
+        self.tokens = 0
+        self._fit(budget)
+
+    def push(self, turn):
+        # The turn has just been appended to the conversation's list
+        self.tokens += turn.token_count(self.model)
+        self._fit(self.budget)
+
+    @property
+    def dropped_turns(self):
+        return self.start
+
+    @property
+    def dropped_tokens(self):
+        return sum(turn.token_count(self.model) for turn in self.turns[:self.start])
+
+    def _fitted(self, budget):
+        # The start and tokens the window would have in `budget`
+        start = self.start
+        tokens = self.tokens
+        while start < len(self.turns) and tokens > budget:
+            tokens -= self.turns[start].token_count(self.model)
+            start += 1
+        while start > 0:
+            count = self.turns[start - 1].token_count(self.model)
+            if tokens + count > budget:
+                break
+            start -= 1
+            tokens += count
+        return start, tokens
+
+    def _fit(self, budget):
+        # Returns the number of turns and tokens dropped from the window
+        start = self.start
+        tokens = self.tokens
+        self.start, self.tokens = self._fitted(budget)
+        return max(0, self.start - start), max(0, tokens - self.tokens)
+
+    def _reserved(self, system_prompt, user_message, summary):
+        reserved = estimate_tokens(system_prompt, self.model) + estimate_tokens(user_message, self.model)
+        if summary:
+            reserved += estimate_tokens(summary, self.model)
+        return reserved
+
+    def recall_start(self, system_prompt, user_message, summary=""):
+        # The start that build() will pass to recall(), without moving the window
+        return self._fitted(self.budget - self._reserved(system_prompt, user_message, summary))[0]
+
+    def build(self, system_prompt, user_message, summary="", recall=None):
+        # The system prompt and the new message are always sent; history gets
+        # whatever is left of the budget. A summary of older turns is added to
+        # the system prompt, but only when some turns do not fit.
+        #
+        # recall(start) may return older turns that matter for this message,
+        # from before turns[start]; they go in the system prompt too, and the
+        # window makes room for them.
+        reserved = self._reserved(system_prompt, user_message, summary)
+        self.last_dropped_turns, self.last_dropped_tokens = self._fit(self.budget - reserved)
+        memory = recall(self.start) if recall is not None and self.start > 0 else ""
+        if memory:
+            reserved += estimate_tokens(memory, self.model)
+            turns, tokens = self._fit(self.budget - reserved)
+            self.last_dropped_turns += turns
+            self.last_dropped_tokens += tokens
+        if summary and self.start > 0:
+            system_prompt = f"{system_prompt}\n\n{SUMMARY_HEADER}\n{summary}"
+        if memory:
+            system_prompt = f"{system_prompt}\n\n{MEMORY_HEADER}\n{memory}"
+        return [
+            {"role": "system", "content": system_prompt},
+            *(turn.as_message() for turn in self.turns[self.start:]),
+            {"role": "user", "content": user_message}
+        ]
+
+class Conversation:
+    def __init__(self):
+        self.turns = []
+        self.total_chars = 0
+        self.window = ContextWindow(self.turns, None, 0)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def append(self, role, content, number=None):
+        turn = Turn(role, content, number)
+        self.turns.append(turn)
+        self.total_chars += turn.chars
+        self.window.push(turn)
+        return turn
+
+    def clear(self):
+        self.turns = []
+        self.total_chars = 0
+        self.window.reset(self.turns, self.window.model, self.window.budget)
+
+    def set_budget(self, model, budget):
+        self.window.reset(self.turns, model, budget)
+
+    def build_messages(self, system_prompt, user_message, summary="", recall=None):
+        return self.window.build(system_prompt, user_message, summary, recall)
+
+    @classmethod
+    def from_transcript(cls, text):
+        # Rebuild turns from a plain text transcript as written by older
+        # versions: "You: ..." lines are the user, everything up to the next
+        # "You: " line is one (possibly multi-line) assistant answer.
+        conversation = cls()
+        role = None
+        lines = []
+
+        def flush():
+            content = "\n".join(lines).strip()
+            if role and content:
+                conversation.append(role, content)
+
+        for line in text.split("\n"):
+            if line.startswith("You: "):
+                flush()
+                role = "user"
+                lines = [line[5:]]
+            elif role == "user" and not line.strip():
+                flush()
+                role = "assistant"
+                lines = []
+            elif role == "user":
+                lines.append(line)
+            else:
+                role = "assistant"
+                lines.append(line)
+        flush()
+        return conversation
+
+# Words too common to say anything about which turns are relevant
+STOPWORDS = frozenset(
+    "a an and are as at be but by can could do does for from had has have how i if in into is it its me my no not of on or "
+    "our so than that the their them then there these they this to was we were what when where which who why will with "
+    "would you your".split())
+
+def index_terms(text):
+    return [word for word in re.findall(r"\w+", text.lower()) if len(word) > 1 and word not in STOPWORDS]
+
+class RetrievalMemory:
+    # Inverted index of past turns, scored with BM25, so the turns that best
+    # match a new message can be found without sending the whole history.
+    # Turns are keyed by their record number in the journal and added one at
+    # a time as they are recorded; older history is added by a background
+    # thread, which is why everything goes through the lock.
+    #
+    # A turn's content is kept when given; turns indexed straight from the
+    # journal are only scored here and read back from it when chosen.
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.docs = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, number, role, content, keep_content=True):
+        terms = index_terms(content)
+        with self.lock:
+            if number in self.docs:
+                return
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                self.postings.setdefault(term, {})[number] = count
+            self.docs[number] = (role, content if keep_content else None, len(terms))
+            self.total_length += len(terms)
+
+    def search(self, query, before, limit):
+        # Best scoring turns numbered below `before`, as
+        # (number, score, role, content or None)
+        terms = set(index_terms(query))
+        with self.lock:
+            count = len(self.docs)
+            if not terms or not count:
+                return []
+            average = self.total_length / count or 1.0
+            scores = {}
+            for term in terms:
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+                for number, frequency in docs.items():
+                    if number >= before:
+                        continue
+                    length = self.docs[number][2]
+                    score = idf * frequency * (self.K1 + 1) / (frequency + self.K1 * (1 - self.B + self.B * length / average))
+                    scores[number] = scores.get(number, 0.0) + score
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [(number, score, *self.docs[number][:2]) for number, score in best]
+
+class ChatJournal:
+    # Append-only JSONL log of conversation turns. Every record is one line, so
+    # a reply costs one small append instead of rewriting the whole file. The
+    # writing happens on a background thread; the caller only queues records.
+    #
+    # Next to the journal an index file holds the byte offset of every record
+    # as a fixed-size entry, so record N can be found with a single seek. This
+    # is what lets startup read only the last page of history.
+    #
+    # fsync policy: "always" syncs after every record, "interval" at most once
+    # every fsync_interval seconds, "never" leaves it to the OS.
+    #
+    # Compaction only happens when the journal is closed: it renumbers the
+    # records, and while the journal is open the session's turn numbers and
+    # the search index's rowids are record numbers.
+    FSYNC_POLICIES = ("always", "interval", "never")
+    INDEX_ENTRY = struct.Struct("<Q")
+
+    def __init__(self, path, fsync="interval", fsync_interval=5.0):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.path = path
+        self.index_path = path + ".idx"
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.queue = queue.Queue()
+        self.file = None
+        self.index_file = None
+        self.last_sync = time.monotonic()
+        # Records that compaction would remove (turns before a clear marker).
+        # Only touched by the writer thread.
+        self.garbage = 0
+        # Called on the writer thread after records reach the file
+        self.on_write = None
+        self.check_index()
+        self.thread = threading.Thread(target=self._run, name="ChatJournal", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def read(path):
+        # Returns the turns since the last "clear" marker, skipping lines that
+        # cannot be parsed (a torn write from a crash, maybe inside a UTF-8
+        # character, which is why the file is read as bytes).
+        records = []
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("type") == "clear":
+                    records = []
+                else:
+                    records.append(record)
+        return records
+
+    @classmethod
+    def write_all(cls, path, records, fsync=True):
+        # Write a complete journal and its index next to the real files and swap
+        # them in, so a crash leaves either the old or the new history.
+        offsets = []
+        offset = 0
+        with open(path + ".tmp", "wb") as f:
+            for record in records:
+                line = cls.encode(record)
+                offsets.append(offset)
+                f.write(line)
+                offset += len(line)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        with open(path + ".idx.tmp", "wb") as f:
+            f.write(b"".join(cls.INDEX_ENTRY.pack(o) for o in offsets))
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        os.replace(path + ".idx.tmp", path + ".idx")
+
+    def check_index(self):
+        # Make sure every record in the journal has an index entry. Normally
+        # this only looks at the last entry; records written after it (a crash
+        # between the two writes) are scanned and added, and a missing or stale
+        # index is rebuilt with one pass over the journal.
+        if not os.path.exists(self.path):
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            return
+        size = os.path.getsize(self.path)
+        with open(self.path, "rb+") as f:
+            # Terminate a torn last line so the next record starts on its own line
+            if size:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+                    size += 1
+
+            count = self.count()
+            scan_from = 0
+            if count:
+                last = self.offset(count - 1)
+                if last < size:
+                    boundary = True
+                    if last:
+                        f.seek(last - 1)
+                        boundary = f.read(1) == b"\n"
+                    if boundary:
+                        f.seek(last)
+                        f.readline()
+                        scan_from = f.tell()
+            if scan_from == size and (count or not size):
+                return
+
+            offsets = []
+            f.seek(scan_from)
+            while True:
+                offset = f.tell()
+                if not f.readline():
+                    break
+                offsets.append(offset)
+        with open(self.index_path, "ab" if scan_from else "wb") as f:
+            f.write(b"".join(self.INDEX_ENTRY.pack(o) for o in offsets))
+
+    def count(self):
+        try:
+            return os.path.getsize(self.index_path) // self.INDEX_ENTRY.size
+        except FileNotFoundError:
+            return 0
+
+    def offset(self, number):
+        with open(self.index_path, "rb") as f:
+            f.seek(number * self.INDEX_ENTRY.size)
+            return self.INDEX_ENTRY.unpack(f.read(self.INDEX_ENTRY.size))[0]
+
+    def read_range(self, start, end):
+        # (number, record) for records start..end-1 (clear markers included),
+        # read with one seek and without touching the rest of the journal. A
+        # line that cannot be parsed is left out but keeps its number.
+        end = min(end, self.count())
+        if start >= end:
+            return []
+        with open(self.index_path, "rb") as f:
+            f.seek(start * self.INDEX_ENTRY.size)
+            data = f.read((end - start + 1) * self.INDEX_ENTRY.size)
+        offsets = [entry[0] for entry in self.INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % self.INDEX_ENTRY.size])]
+        records = []
+        with open(self.path, "rb") as f:
+            f.seek(offsets[0])
+            chunk = f.read(offsets[end - start] - offsets[0]) if len(offsets) > end - start else f.read()
+        for number, line in enumerate(chunk.splitlines()[:end - start], start):
+            try:
+                records.append((number, json.loads(line)))
+            except ValueError:
+                # Not JSON, or cut off inside a UTF-8 character
+                continue
+        return records
+
+    def append(self, role, content):
+        # Returns the number of bytes the record adds to the journal
+        record = {"role": role, "content": content, "time": datetime.now().isoformat(timespec="seconds")}
+        line = self.encode(record)
+        self.queue.put(("append", line))
+        return len(line)
+
+    def clear(self):
+        # Clearing is just another record; compaction on close drops the
+        # turns before it.
+        self.queue.put(("clear", self.encode({"type": "clear"})))
+
+    @staticmethod
+    def encode(record):
+        return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def rewrite(self, records):
+        self.queue.put(("rewrite", records))
+
+    def flush(self, timeout=5.0):
+        done = threading.Event()
+        self.queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def close(self, timeout=5.0):
+        self.queue.put(("close", None))
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                op, arg = self.queue.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                op, arg = "idle", None
+            try:
+                if op == "append":
+                    self._write(arg)
+                elif op == "clear":
+                    self._write(arg)
+                    self.garbage += 1
+                elif op == "rewrite":
+                    self._rewrite(arg)
+                elif op == "flush":
+                    self._sync()
+                    arg.set()
+                elif op == "close":
+                    self._close()
+                    return
+                if op in ("append", "clear", "rewrite") and self.on_write is not None:
+                    self.on_write()
+                if self.fsync == "interval" and time.monotonic() - self.last_sync >= self.fsync_interval:
+                    self._sync()
+            except Exception as e:
+                logging.error(f"Error writing chat history journal: {str(e)}")
+
+    def _write(self, line):
+        if self.file is None:
+            self.file = open(self.path, "ab")
+            self.index_file = open(self.index_path, "ab")
+        offset = self.file.tell()
+        self.file.write(line)
+        self.file.flush()
+        self.index_file.write(self.INDEX_ENTRY.pack(offset))
+        self.index_file.flush()
+        if self.fsync == "always":
+            self._sync()
+
+    def _sync(self):
+        if self.file and self.fsync != "never":
+            os.fsync(self.file.fileno())
+            os.fsync(self.index_file.fileno())
+        self.last_sync = time.monotonic()
+
+    def _close(self):
+        # The last op: whatever goes wrong, the files are closed and the
+        # writer thread ends, so close() does not wait for it in vain
+        try:
+            if self.garbage:
+                self.compact()
+            self._sync()
+        except Exception as e:
+            logging.error(f"Error closing chat history journal: {str(e)}")
+        try:
+            self._close_files()
+        except OSError as e:
+            logging.error(f"Error closing chat history journal: {str(e)}")
+
+    def _close_files(self):
+        if self.file:
+            self.file.close()
+            self.index_file.close()
+            self.file = None
+            self.index_file = None
+
+    def _rewrite(self, records):
+        self._close_files()
+        self.write_all(self.path, records, fsync=self.fsync != "never")
+        self.garbage = 0
+
+    def compact(self):
+        # Runs on the writer thread: drop everything before the last clear
+        # marker along with any unreadable lines.
+        try:
+            records = self.read(self.path)
+        except FileNotFoundError:
+            records = []
+        self._rewrite(records)
+        if self.on_write is not None:
+            self.on_write()
+
+class HistoryIndex:
+    # SQLite FTS5 index of a ChatJournal's turns, in a file next to it. A
+    # background thread follows the journal: the journal's writer wakes it
+    # after every write and it indexes whatever is new, so saving a turn never
+    # waits for the index. A turn's rowid is its record number in the
+    # journal, which is what the window pages to. Turns before a clear marker
+    # are removed, and when the journal has been rewritten (compaction after
+    # a clear) the index is built again.
+    #
+    # search() runs on the caller's thread with its own connection; in WAL
+    # mode it never waits for the indexer.
+    BATCH = 500
+
+    # The prefix indexes keep short, half-typed words fast
+    TURNS_TABLE = ("CREATE VIRTUAL TABLE IF NOT EXISTS turns USING fts5(role UNINDEXED, time UNINDEXED, content, "
+                   "tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+
+    def __init__(self, path, journal):
+        self.path = path
+        self.journal = journal
+        self.wake = threading.Event()
+        self.closing = False
+        self.reader = None
+        # Set once the index has caught up with the journal after opening
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="HistoryIndex", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def available():
+        # Not every SQLite build has FTS5
+        try:
+            db = sqlite3.connect(":memory:")
+            try:
+                db.execute("CREATE VIRTUAL TABLE probe USING fts5(content)")
+            finally:
+                db.close()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def notify(self):
+        self.wake.set()
+
+    def search(self, query, limit=50):
+        # Every word of the query has to match and the last one may be
+        # unfinished, so results can follow typing. Best matches first.
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        match = " ".join(f'"{word}"' for word in words) + "*"
+        try:
+            if self.reader is None:
+                self.reader = sqlite3.connect(self.path)
+            rows = self.reader.execute(
+                "SELECT rowid, role, time, snippet(turns, 2, '', '', ' … ', 16) FROM turns "
+                "WHERE turns MATCH ? ORDER BY rank LIMIT ?", (match, limit)).fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"Could not search the chat history: {str(e)}")
+            return []
+        return [{"number": number, "role": role, "time": when, "snippet": snippet} for number, role, when, snippet in rows]
+
+    def close(self, timeout=2.0):
+        self.closing = True
+        self.wake.set()
+        self.thread.join(timeout)
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def _signature(self):
+        # Changes when the journal is replaced by a rewrite
+        try:
+            stat = os.stat(self.journal.path)
+        except FileNotFoundError:
+            return None
+        return f"{stat.st_dev}:{stat.st_ino}"
+
+    def _run(self):
+        try:
+            db = sqlite3.connect(self.path)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(self.TURNS_TABLE)
+            db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+            db.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Could not open the search index: {str(e)}")
+            self.ready.set()
+            return
+        try:
+            while not self.closing:
+                self.wake.clear()
+                try:
+                    self._sync(db)
+                except (OSError, sqlite3.Error) as e:
+                    db.rollback()
+                    logging.error(f"Error updating the search index: {str(e)}")
+                self.ready.set()
+                self.wake.wait(30.0)
+        finally:
+            db.close()
+
+    def _sync(self, db):
+        state = dict(db.execute("SELECT key, value FROM state").fetchall())
+        signature = self._signature()
+        indexed = int(state.get("indexed", 0))
+        count = self.journal.count()
+        if state.get("journal") != signature or count < indexed:
+            started = time.perf_counter()
+            self._empty(db)
+            db.execute("INSERT OR REPLACE INTO state VALUES ('journal', ?)", (signature,))
+            indexed = 0
+            logging.debug(f"Rebuilding the search index of {self.journal.path}")
+        else:
+            started = None
+        while indexed < count and not self.closing:
+            end = min(count, indexed + self.BATCH)
+            rows = []
+            for number, record in self.journal.read_range(indexed, end):
+                if record.get("type") == "clear":
+                    # Everything indexed so far is older than the marker
+                    rows = []
+                    self._empty(db)
+                elif "role" in record and "content" in record:
+                    rows.append((number, record["role"], record.get("time", ""), record["content"]))
+            if self._signature() != signature:
+                # Rewritten while it was being read; start over on the next pass
+                db.rollback()
+                self.wake.set()
+                return
+            db.executemany("INSERT OR REPLACE INTO turns (rowid, role, time, content) VALUES (?, ?, ?, ?)", rows)
+            indexed = end
+            db.execute("INSERT OR REPLACE INTO state VALUES ('indexed', ?)", (str(indexed),))
+            db.commit()
+        db.commit()
+        if started is not None:
+            logging.debug(f"Indexed {indexed} history records in {time.perf_counter() - started:.2f}s")
+
+    def _empty(self, db):
+        # Much faster than deleting the rows of an FTS table one by one
+        db.execute("DROP TABLE IF EXISTS turns")
+        db.execute(self.TURNS_TABLE)
+
+class NetworkError(Exception):
+    # `sent` is set when the request may already have reached the server, so
+    # sending it again could start (and bill) the same completion twice
+    def __init__(self, message, sent=False):
+        super().__init__(message)
+        self.sent = sent
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        # Only needed for a 429 with a date, so not imported at startup
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class Connection:
+    __slots__ = ("key", "reader", "writer", "requests", "idle_since")
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.requests = 0
+        self.idle_since = None
+
+    def usable(self):
+        return not self.reader.at_eof() and not self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+class Proxy:
+    __slots__ = ("host", "port", "authorization")
+
+    def __init__(self, url):
+        parts = urlsplit(url if "://" in url else "http://" + url)
+        if parts.scheme != "http":
+            raise NetworkError(f"Unsupported proxy {url}: only http:// proxies can be used")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.authorization = None
+        if parts.username is not None:
+            import base64
+            from urllib.parse import unquote
+            credentials = f"{unquote(parts.username)}:{unquote(parts.password or '')}"
+            self.authorization = "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+
+class ConnectionPool:
+    # Keep-alive connections per (scheme, host, port). Only touched from the
+    # engine's event loop, so it needs no locking.
+    #
+    # A proxy set in HTTPS_PROXY / HTTP_PROXY (and not bypassed by NO_PROXY),
+    # or in the system settings, is used the way browsers do: https goes
+    # through a CONNECT tunnel, plain http requests are sent to the proxy
+    # with the full URL.
+    def __init__(self, max_idle_per_host=4, idle_timeout=60.0, connect_timeout=15.0):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.idle = {}
+        self.ssl_context = None
+        # The Proxy (or None) of every key, looked up once
+        self.proxies = {}
+        self.connections = 0
+        self.requests = 0
+
+    async def acquire(self, key):
+        self.requests += 1
+        idle = self.idle.get(key, [])
+        now = time.monotonic()
+        while idle:
+            conn = idle.pop()
+            if conn.usable() and now - conn.idle_since < self.idle_timeout:
+                conn.requests += 1
+                return conn
+            conn.close()
+        conn = await self.connect(key)
+        conn.requests = 1
+        return conn
+
+    async def prewarm(self, key):
+        # Leaves an idle connection for the next request, unless there is one
+        if not any(conn.usable() for conn in self.idle.get(key, [])):
+            self.release(await self.connect(key))
+
+    def proxy(self, key):
+        if key not in self.proxies:
+            # Only needed once per server, and not at startup
+            import urllib.request
+            scheme, host, port = key
+            url = urllib.request.getproxies().get(scheme)
+            bypass = url and (urllib.request.proxy_bypass(host) or urllib.request.proxy_bypass(f"{host}:{port}"))
+            self.proxies[key] = Proxy(url) if url and not bypass else None
+        return self.proxies[key]
+
+    async def connect(self, key):
+        scheme, host, port = key
+        ssl_context = None
+        if scheme == "https":
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            ssl_context = self.ssl_context
+        proxy = self.proxy(key)
+        try:
+            if proxy is None:
+                opening = asyncio.open_connection(host, port, ssl=ssl_context, server_hostname=host if ssl_context else None)
+            elif ssl_context is None:
+                opening = asyncio.open_connection(proxy.host, proxy.port)
+            else:
+                opening = self._tunnel(proxy, host, port, ssl_context)
+            reader, writer = await asyncio.wait_for(opening, self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise NetworkError(f"Timed out connecting to {host}:{port}")
+        except OSError as e:
+            via = f" through the proxy {proxy.host}:{proxy.port}" if proxy is not None else ""
+            raise NetworkError(f"Could not connect to {host}:{port}{via}: {e}")
+        self.connections += 1
+        return Connection(key, reader, writer)
+
+    async def _tunnel(self, proxy, host, port, ssl_context):
+        # A CONNECT tunnel through the proxy, with TLS to the server on top
+        loop = asyncio.get_running_loop()
+        sock = await loop.run_in_executor(None, socket.create_connection, (proxy.host, proxy.port), self.connect_timeout)
+        try:
+            sock.setblocking(False)
+            request = f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n"
+            if proxy.authorization:
+                request += f"Proxy-Authorization: {proxy.authorization}\r\n"
+            await loop.sock_sendall(sock, (request + "\r\n").encode("latin-1"))
+            response = b""
+            while b"\r\n\r\n" not in response:
+                data = await loop.sock_recv(sock, 4096)
+                if not data or len(response) > 65536:
+                    raise ConnectionResetError("The proxy closed the connection")
+                response += data
+            status_line = response.split(b"\r\n", 1)[0].decode("latin-1")
+            if status_line.split(" ", 2)[1:2] != ["200"]:
+                raise ConnectionRefusedError(f"The proxy answered {status_line!r}")
+            return await asyncio.open_connection(sock=sock, ssl=ssl_context, server_hostname=host)
+        except BaseException:
+            sock.close()
+            raise
+
+    def release(self, conn):
+        idle = self.idle.setdefault(conn.key, [])
+        if conn.usable() and len(idle) < self.max_idle_per_host:
+            conn.idle_since = time.monotonic()
+            idle.append(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        for idle in self.idle.values():
+            for conn in idle:
+                conn.close()
+        self.idle = {}
+
+class StreamResponse:
+    def __init__(self, pool, conn, status, headers, read_timeout):
+        self.pool = pool
+        self.conn = conn
+        self.status = status
+        self.headers = headers
+        self.read_timeout = read_timeout
+        self.complete = False
+        self.closed = False
+        self.chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        length = headers.get("content-length")
+        self.length = int(length) if length is not None and not self.chunked else None
+        self.keep_alive = headers.get("connection", "").lower() != "close" and (self.chunked or self.length is not None)
+
+    async def _read(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.read_timeout)
+        except asyncio.TimeoutError:
+            raise NetworkError("Timed out waiting for the server")
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            raise NetworkError(f"Connection lost: {e}")
+
+    async def iter_chunks(self):
+        # Yields body bytes as they arrive; no read ever blocks the event loop.
+        reader = self.conn.reader
+        if self.chunked:
+            while True:
+                line = await self._read(reader.readline())
+                try:
+                    size = int(line.split(b";", 1)[0].strip(), 16)
+                except ValueError:
+                    raise NetworkError(f"Invalid chunk header: {line!r}")
+                if size == 0:
+                    # Skip trailers up to the blank line ending the message
+                    while (await self._read(reader.readline())).strip():
+                        pass
+                    break
+                data = await self._read(reader.readexactly(size + 2))
+                yield data[:-2]
+        elif self.length is not None:
+            remaining = self.length
+            while remaining > 0:
+                data = await self._read(reader.read(min(remaining, 65536)))
+                if not data:
+                    raise NetworkError("Connection closed before the response was complete")
+                remaining -= len(data)
+                yield data
+        else:
+            while True:
+                data = await self._read(reader.read(65536))
+                if not data:
+                    break
+                yield data
+        self.complete = True
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.iter_chunks()])
+
+    async def _drain(self, limit):
+        drained = 0
+        async for chunk in self.iter_chunks():
+            drained += len(chunk)
+            if drained > limit:
+                return
+
+    async def aclose(self, drain_limit=65536, drain_timeout=1.0):
+        # Hand the connection back to the pool when the body has been read to
+        # the end. A little unread data (the terminating chunk after [DONE]) is
+        # drained first; anything more means the connection is thrown away.
+        if self.closed:
+            return
+        self.closed = True
+        if not self.complete and self.keep_alive and drain_limit:
+            try:
+                await asyncio.wait_for(self._drain(drain_limit), drain_timeout)
+            except (NetworkError, asyncio.TimeoutError):
+                pass
+        if self.complete and self.keep_alive:
+            self.pool.release(self.conn)
+        else:
+            self.conn.close()
+
+    def abort(self):
+        # Drop the connection immediately, e.g. when a stream is cancelled
+        self.closed = True
+        self.conn.close()
+
+class SSEParser:
+    # Incremental parser for the server-sent event stream of a chat
+    # completion. It works on the raw bytes as they come off the socket:
+    # only the unfinished last line is carried over between chunks, events
+    # are split on blank lines (several data: lines are joined), comments and
+    # other fields are skipped and "[DONE]" ends the stream.
+    #
+    # Almost every event is a plain delta, so the content is first pulled out
+    # with one precompiled regex; only events it cannot handle (escapes,
+    # nested objects, errors) go through json.loads. Errors are logged for the
+    # first error_limit occurrences and counted after that.
+    DELTA_CONTENT = re.compile(rb'"delta"\s*:\s*\{[^{}]*?"content"\s*:\s*"([^"\\]*)"')
+
+    def __init__(self, error_limit=5):
+        # Pieces of the unfinished last line
+        self.partial = []
+        self.data = []
+        self.done = False
+        self.error_limit = error_limit
+        self.errors = 0
+        self.fast = 0
+        self.slow = 0
+
+    def feed(self, chunk):
+        # Returns the data of every event completed by this chunk
+        if b"\n" not in chunk and b"\r" not in chunk:
+            self.partial.append(chunk)
+            return []
+        if self.partial:
+            self.partial.append(chunk)
+            data = b"".join(self.partial)
+        else:
+            data = chunk
+        tail = b""
+        if b"\r" in data:
+            # A trailing CR may be the first half of a CRLF
+            if data.endswith(b"\r"):
+                data = data[:-1]
+                tail = b"\r"
+            data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        # A blank line ends an event, so split on those first; the unfinished
+        # last block is kept for the next chunk.
+        blocks = data.split(b"\n\n")
+        last = blocks.pop() + tail
+        self.partial = [last] if last else []
+        events = []
+        for block in blocks:
+            if block.startswith(b"data: ") and b"\n" not in block and not self.data:
+                # The usual case: one event, one data line
+                events.append(block[6:])
+                continue
+            for line in block.split(b"\n"):
+                if not line:
+                    continue
+                if line.startswith(b"data:"):
+                    self.data.append(line[6:] if line[5:6] == b" " else line[5:])
+                elif not line.startswith((b":", b"event:", b"id:", b"retry:")):
+                    self.error("Unexpected line in event stream", line)
+            if self.data:
+                events.append(b"\n".join(self.data))
+                self.data = []
+        return events
+
+    def content(self, event):
+        # choices[0].delta.content of one event, or None
+        if event == b"[DONE]":
+            self.done = True
+            return None
+        match = self.DELTA_CONTENT.search(event)
+        if match:
+            self.fast += 1
+            return match.group(1).decode("utf-8")
+        self.slow += 1
+        try:
+            json_data = json.loads(event)
+        except ValueError:
+            self.error("Malformed event", event)
+            return None
+        if not isinstance(json_data, dict):
+            self.error("Unexpected event", event)
+            return None
+        if "error" in json_data:
+            self.error("Error event", event)
+            return None
+        choices = json_data.get("choices")
+        if choices:
+            content = (choices[0].get("delta") or {}).get("content")
+            if isinstance(content, str):
+                return content
+        return None
+
+    def contents(self, chunk):
+        # All content from the events completed by this chunk, stopping at [DONE]
+        out = []
+        for event in self.feed(chunk):
+            content = self.content(event)
+            if self.done:
+                break
+            if content:
+                out.append(content)
+        return out
+
+    def error(self, message, data):
+        self.errors += 1
+        if self.errors <= self.error_limit:
+            logging.error(f"{message}: {data[:200]!r}")
+            if self.errors == self.error_limit:
+                logging.error("Further event stream errors in this response will only be counted")
+
+    def close(self):
+        if self.errors > self.error_limit:
+            logging.error(f"{self.errors - self.error_limit} more event stream errors were not logged")
+
+# Syntax highlighting for the code blocks in answers, as (start, end, kind)
+# character ranges with kind one of HIGHLIGHT_KINDS. Pygments is used when it
+# is installed; otherwise a small regular expression lexer covers the common
+# languages. Blocks without a known language only get strings, numbers and
+# comments.
+HIGHLIGHT_KINDS = ("keyword", "builtin", "function", "string", "number", "comment")
+
+QUOTED = r'"(?:\\.|[^"\\\n])*"?|\'(?:\\.|[^\'\\\n])*\'?'
+DOUBLE_QUOTED = r'"(?:\\.|[^"\\\n])*"?'
+HASH_COMMENT = r"#[^\n]*"
+SLASH_COMMENT = r"//[^\n]*|/\*[\s\S]*?(?:\*/|\Z)"
+
+# name: (aliases, comment, string, keywords, builtins)
+CODE_LANGUAGES = {
+    "python": (
+        ("py", "python3", "py3"), HASH_COMMENT,
+        r'(?:\b[rRbBuUfF]{1,2})?(?:"""[\s\S]*?(?:"""|\Z)|\'\'\'[\s\S]*?(?:\'\'\'|\Z)|' + QUOTED + ")",
+        "False None True and as assert async await break class continue def del elif else except finally for from global "
+        "if import in is lambda match case nonlocal not or pass raise return try while with yield",
+        "abs all any bool bytes dict enumerate Exception filter float getattr hasattr int isinstance len list map max min "
+        "next object open print range repr reversed self set sorted str sum super tuple type zip"),
+    "javascript": (
+        ("js", "jsx", "ts", "tsx", "typescript", "node"), SLASH_COMMENT,
+        QUOTED + r"|`(?:\\.|[^`\\])*`?",
+        "async await break case catch class const continue debugger default delete do else enum export extends false "
+        "finally for function if implements import in instanceof interface let new null of private protected public "
+        "readonly return static super switch this throw true try type typeof undefined var void while yield",
+        "Array console document JSON Math Number Object Promise require String window"),
+    "c": (
+        ("cpp", "c++", "h", "hpp", "java", "cs", "csharp", "go", "golang", "rust", "rs", "kotlin", "kt", "swift", "php"),
+        SLASH_COMMENT, DOUBLE_QUOTED,
+        "auto bool boolean break case catch chan char class const continue crate default defer delete do double else "
+        "enum extends extern false final float fn for func go goto if impl implements import in int interface let long "
+        "loop map match mod mut namespace new nil null override package private protected pub public range return "
+        "select self short signed sizeof static string struct super switch template this throw trait true try type "
+        "typedef union unsafe unsigned use using var virtual void volatile where while",
+        "cin cout endl Err fmt free malloc None Ok Option printf println Some std String System Vec"),
+    "shell": (
+        ("sh", "bash", "zsh", "console", "shell-session", "ps1", "powershell", "bat", "cmd"), HASH_COMMENT, QUOTED,
+        "case do done elif else esac exit export fi for function if in local return then until while",
+        "cat cd cp curl echo git grep ls mkdir mv npm pip printf python read rm sed set source sudo unset"),
+    "sql": (
+        ("mysql", "postgresql", "postgres", "sqlite"), r"--[^\n]*|/\*[\s\S]*?(?:\*/|\Z)", QUOTED,
+        "add all alter and as asc begin between by case commit create delete desc distinct drop else end exists from "
+        "group having if in index inner insert into is join key left like limit not null on or order outer primary "
+        "references right rollback select set table then union unique update values view when where with",
+        "avg coalesce count max min now sum"),
+    "json": (("jsonl", "json5"), SLASH_COMMENT, DOUBLE_QUOTED, "true false null", ""),
+}
+CODE_ALIASES = {alias: name for name, spec in CODE_LANGUAGES.items() for alias in (name,) + spec[0]}
+
+@functools.lru_cache(maxsize=None)
+def code_lexer(language):
+    # (pattern, keywords, builtins, case sensitive) for a language the
+    # built-in lexer knows, or the generic one
+    name = CODE_ALIASES.get(language)
+    if name is None:
+        comment, string, keywords, builtins = HASH_COMMENT + "|" + SLASH_COMMENT, QUOTED, "", ""
+    else:
+        comment, string, keywords, builtins = CODE_LANGUAGES[name][1:]
+    pattern = re.compile(
+        rf"(?P<comment>{comment})|(?P<string>{string})"
+        r"|(?P<number>\b0[xX][0-9a-fA-F_]+\b|\b\d[\d_]*(?:\.\d+)?(?:[eE][+-]?\d+)?\b)"
+        r"|(?P<word>[A-Za-z_$][\w$]*)")
+    return pattern, frozenset(keywords.split()), frozenset(builtins.split()), name != "sql"
+
+@functools.lru_cache(maxsize=None)
+def pygments_lexer(language):
+    if not language:
+        return None
+    try:
+        from pygments.lexers import get_lexer_by_name
+        from pygments.util import ClassNotFound
+    except ImportError:
+        return None
+    try:
+        return get_lexer_by_name(language)
+    except ClassNotFound:
+        return None
+
+@functools.lru_cache(maxsize=128)
+def highlight_code(text, language=""):
+    # Cached on the text, so a block that is shown again is not lexed again
+    language = language.strip().lower()
+    lexer = pygments_lexer(language)
+    if lexer is not None:
+        return tuple(pygments_ranges(lexer, text))
+    pattern, keywords, builtins, case_sensitive = code_lexer(language)
+    ranges = []
+    for match in pattern.finditer(text):
+        kind = match.lastgroup
+        if kind == "word":
+            word = match.group() if case_sensitive else match.group().lower()
+            if word in keywords:
+                kind = "keyword"
+            elif word in builtins:
+                kind = "builtin"
+            elif text.startswith("(", match.end()):
+                kind = "function"
+            else:
+                continue
+        ranges.append((match.start(), match.end(), kind))
+    return tuple(ranges)
+
+def pygments_ranges(lexer, text):
+    from pygments.token import Comment, Keyword, Name, Number, String
+    kinds = ((Comment, "comment"), (String, "string"), (Number, "number"), (Keyword, "keyword"),
+             (Name.Builtin, "builtin"), (Name.Function, "function"), (Name.Class, "function"), (Name.Decorator, "function"))
+    last = None
+    for index, token_type, value in lexer.get_tokens_unprocessed(text):
+        kind = next((kind for parent, kind in kinds if token_type in parent), None)
+        if kind is None or not value:
+            continue
+        end = index + len(value)
+        # Pygments splits strings and comments into many tokens
+        if last is not None and last[2] == kind and last[1] == index:
+            last = (last[0], end, kind)
+            continue
+        if last is not None:
+            yield last
+        last = (index, end, kind)
+    if last is not None:
+        yield last
+
+def percentiles(values, points=(50, 90, 99), scale=1000.0):
+    # Nearest-rank percentiles, in milliseconds by default
+    if not values:
+        return None
+    values = sorted(values)
+    result = {f"p{point}": round(values[min(len(values) - 1, len(values) * point // 100)] * scale, 2) for point in points}
+    result["max"] = round(values[-1] * scale, 2)
+    return result
+
+class RequestMetrics:
+    # Timings for one request, filled in by the engine (connection, first
+    # byte), the session (tokens, history) and the UI (render lag). Times are
+    # seconds since the request started.
+    #
+    # Token times are taken when a chunk with content arrives; ArliAI sends one
+    # token per event, and a chunk holding several events counts each of them.
+    def __init__(self, model=""):
+        self.model = model
+        # Also on the log lines written while the request runs
+        self.id = os.urandom(4).hex()
+        self.time = datetime.now().isoformat(timespec="seconds")
+        self.started = time.perf_counter()
+        # Seconds the request waited for a free slot before it was sent
+        self.queued = 0.0
+        self.attempts = 0
+        self.reused = None
+        self.connect = None
+        self.ttfb = None
+        self.status = None
+        self.ttft = None
+        self.token_times = []
+        self.tokens = 0
+        self.bytes_received = 0
+        self.render_lags = []
+        self.history_bytes = 0
+        self.context_messages = 0
+        # Retrieval memory: seconds spent choosing older turns, and what was added
+        self.recall = None
+        self.recalled_turns = 0
+        self.recalled_tokens = 0
+        self.cache = None
+        self.outcome = None
+        self.total = None
+
+    def content(self, tokens):
+        now = time.perf_counter() - self.started
+        if self.ttft is None:
+            self.ttft = now
+        self.token_times.append(now)
+        self.tokens += tokens
+
+    def finish(self, outcome):
+        if self.outcome is None:
+            self.outcome = outcome
+            self.total = time.perf_counter() - self.started
+
+    def tokens_per_sec(self):
+        if len(self.token_times) < 2 or self.token_times[-1] <= self.token_times[0]:
+            return None
+        return round((self.tokens - 1) / (self.token_times[-1] - self.token_times[0]), 1)
+
+    def as_record(self):
+        gaps = [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 2)
+
+        return {
+            "id": self.id,
+            "time": self.time,
+            "model": self.model,
+            "outcome": self.outcome,
+            "status": self.status,
+            "attempts": self.attempts,
+            "reused": self.reused,
+            "connect_ms": ms(self.connect),
+            "ttfb_ms": ms(self.ttfb),
+            "ttft_ms": ms(self.ttft),
+            "total_ms": ms(self.total),
+            "queued_ms": ms(self.queued),
+            "tokens": self.tokens,
+            "tokens_per_sec": self.tokens_per_sec(),
+            "inter_token_ms": percentiles(gaps),
+            "render_lag_ms": percentiles(self.render_lags),
+            "bytes_received": self.bytes_received,
+            "history_bytes": self.history_bytes,
+            "context_messages": self.context_messages,
+            "recall_ms": ms(self.recall),
+            "recalled_turns": self.recalled_turns,
+            "recalled_tokens": self.recalled_tokens,
+            "cache": self.cache,
+        }
+
+    def summary(self):
+        # One line for the stats overlay and --stats
+        def part(label, value, unit):
+            return f"{label} {value:.0f} {unit}" if value is not None else f"{label} -"
+        record = self.as_record()
+        if self.cache == "hit":
+            return f"cache hit | first token {self.ttft * 1000:.0f} ms | {self.history_bytes} B history"
+        parts = [] if self.queued < 0.001 else [part("queued", record["queued_ms"], "ms")]
+        parts += [
+            "connect reused" if self.reused else part("connect", record["connect_ms"], "ms"),
+            part("first byte", record["ttfb_ms"], "ms"),
+            part("first token", record["ttft_ms"], "ms"),
+            part("rate", record["tokens_per_sec"], "tok/s"),
+        ]
+        if record["inter_token_ms"]:
+            parts.append(f"gap p50 {record['inter_token_ms']['p50']:.0f} / p99 {record['inter_token_ms']['p99']:.0f} ms")
+        if record["render_lag_ms"]:
+            parts.append(f"render lag p90 {record['render_lag_ms']['p90']:.0f} ms")
+        if self.recall is not None:
+            parts.append(f"recalled {self.recalled_turns} turns ({self.recalled_tokens} tokens) in {record['recall_ms']:.1f} ms")
+        parts.append(f"{self.tokens} tokens, {self.history_bytes} B history")
+        return " | ".join(parts)
+
+class StreamingEngine:
+    # asyncio event loop on one background thread. Callers hand it
+    # coroutines with submit(); every stream is a task on this loop, so any
+    # number of them can run at once without a thread each.
+    #
+    # post() retries connection errors and 5xx answers with exponential
+    # back-off, and honours Retry-After on 429 up to max_retry_after seconds.
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, retries=3, backoff_factor=0.5, max_retry_after=30, connect_timeout=15.0, read_timeout=35.0):
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_retry_after = max_retry_after
+        self.read_timeout = read_timeout
+        self.pool = ConnectionPool(connect_timeout=connect_timeout)
+        self.rate_limited = 0
+        self.last_reused = None
+        self.last_time_to_headers = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name="StreamingEngine", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        # Thread-safe; returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def backoff(self, attempt):
+        return self.backoff_factor * (2 ** attempt)
+
+    def warm_up(self, url):
+        # Opens a connection to url's server ahead of the first request, so
+        # its DNS lookup, handshakes and the loading of the CA certificates
+        # happen on the engine thread while nobody is waiting for an answer.
+        # A failure is left for that request to report.
+        async def warm_up():
+            started = time.perf_counter()
+            try:
+                await self.pool.prewarm(self.endpoint(url)[0])
+            except NetworkError as e:
+                logging.debug(f"Could not warm up a connection: {str(e)}")
+                return
+            logging.debug(f"Warmed up a connection to {url} in {time.perf_counter() - started:.3f}s")
+        return self.submit(warm_up())
+
+    @staticmethod
+    def endpoint(url):
+        # The pool key, request path and Host header for url
+        parts = urlsplit(url)
+        scheme = parts.scheme or "https"
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+        return (scheme, parts.hostname, port), path, host
+
+    async def post(self, url, headers, body, metrics=None):
+        key, path, host = self.endpoint(url)
+        proxy = self.pool.proxy(key)
+        if proxy is not None and key[0] == "http":
+            # Sent to the proxy itself, which needs the whole URL
+            path = f"http://{host}{path}"
+            if proxy.authorization:
+                headers = dict(headers, **{"Proxy-Authorization": proxy.authorization})
+        request_head = "".join(
+            [f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\nConnection: keep-alive\r\n"]
+            + [f"{name}: {value}\r\n" for name, value in headers.items()]
+            + ["\r\n"]).encode("latin-1")
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            if metrics is not None:
+                metrics.attempts += 1
+            try:
+                response = await self._send(key, request_head + body, metrics)
+            except NetworkError as e:
+                # A chat completion is not idempotent: once the request has
+                # gone out, sending it again could run it twice
+                if e.sent or attempt >= self.retries:
+                    raise
+                await asyncio.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            self.last_time_to_headers = time.perf_counter() - started
+
+            if response.status == 429:
+                self.rate_limited += 1
+                wait = parse_retry_after(response.headers.get("retry-after"))
+                if wait is None:
+                    wait = self.backoff(attempt)
+                if attempt >= self.retries or wait > self.max_retry_after:
+                    return response
+                logging.warning(f"Rate limited by the API, retrying in {wait:.1f}s")
+            elif response.status in self.RETRY_STATUSES and attempt < self.retries:
+                wait = self.backoff(attempt)
+            else:
+                return response
+            await response.aclose()
+            await asyncio.sleep(wait)
+            attempt += 1
+
+    async def _send(self, key, request, metrics=None):
+        while True:
+            started = time.perf_counter()
+            conn = await self.pool.acquire(key)
+            reused = conn.requests > 1
+            # Taken from the idle list, including a warmed up connection
+            pooled = conn.idle_since is not None
+            if metrics is not None:
+                metrics.reused = reused
+                metrics.connect = None if reused else time.perf_counter() - started
+            sent = False
+            try:
+                conn.writer.write(request)
+                await conn.writer.drain()
+                sent = True
+                status_line = await asyncio.wait_for(conn.reader.readline(), self.read_timeout)
+                if not status_line:
+                    raise ConnectionResetError("Connection closed by the server")
+                first_byte = time.perf_counter()
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(conn.reader.readline(), self.read_timeout)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                status = int(status_line.split()[1])
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                conn.close()
+                # The server may close an idle keep-alive connection at any
+                # time; that is not a failure, just try a fresh one.
+                if pooled:
+                    continue
+                raise NetworkError(f"Connection lost: {e}", sent)
+            except asyncio.TimeoutError:
+                conn.close()
+                raise NetworkError("Timed out waiting for the server", sent)
+            except (ValueError, IndexError):
+                conn.close()
+                raise NetworkError(f"Invalid response from the server: {status_line!r}", True)
+            except BaseException:
+                # Cancelled (Stop) while waiting for the answer: the connection
+                # is in the middle of a request and cannot go back to the pool
+                conn.close()
+                raise
+            self.last_reused = reused
+            if metrics is not None:
+                metrics.ttfb = first_byte - metrics.started
+                metrics.status = status
+            return StreamResponse(self.pool, conn, status, headers, self.read_timeout)
+
+    def stats(self):
+        return {
+            "requests": self.pool.requests,
+            "connections": self.pool.connections,
+            "reused": max(0, self.pool.requests - self.pool.connections),
+            "rate_limited": self.rate_limited,
+        }
+
+    def close(self, timeout=2.0):
+        if self.loop.is_closed():
+            return
+        self.call(self.pool.close)
+        self.call(self.loop.stop)
+        self.thread.join(timeout)
+
+class RequestScheduler:
+    # Shares the account's limit on parallel requests between conversations.
+    # Every key (a conversation, its summaries) has its own queue and runs one
+    # request at a time, in order. Free slots go round robin to the queues
+    # that are waiting, so a tab with many queued messages cannot hold up the
+    # others.
+    #
+    # The queues live on the engine loop: submit(), cancel() and set_limit()
+    # may be called from any thread, and on_change(key) is called on the
+    # engine thread whenever a key's queue or running request changes.
+    def __init__(self, engine, max_parallel=1, on_change=None):
+        self.engine = engine
+        self.max_parallel = max(1, max_parallel)
+        self.on_change = on_change
+        self.queues = OrderedDict()
+        self.running = {}
+        # Keys being stopped by stop(); their queues wait until it is done
+        self.held = set()
+        # Queue lengths, readable from any thread
+        self.depths = {}
+
+    def submit(self, key, job):
+        # job is called without arguments once the request has a slot and
+        # returns the coroutine to run. Returns a concurrent.futures.Future
+        # for its result; cancelling the future drops a request still waiting.
+        future = concurrent.futures.Future()
+        self.engine.call(self._enqueue, key, job, future)
+        return future
+
+    def depth(self, key):
+        # Requests waiting behind key's running one
+        return self.depths.get(key, 0)
+
+    def busy(self, key):
+        return key in self.running
+
+    def cancel(self, key, queued=False):
+        # Stops key's running request, and with queued=True the waiting ones
+        self.engine.call(self._cancel, key, queued)
+
+    def stop(self, keys, then):
+        # Cancels the running and waiting requests of keys, and calls then()
+        # on the engine thread once the running ones have finished. Requests
+        # submitted in the meantime wait until then() has returned.
+        self.engine.call(self._stop, tuple(keys), then)
+
+    def set_limit(self, max_parallel):
+        self.engine.call(self._set_limit, max(1, max_parallel))
+
+    def stats(self):
+        return {"running": len(self.running), "queued": sum(self.depths.values()), "max_parallel": self.max_parallel}
+
+    def _enqueue(self, key, job, future):
+        self.queues.setdefault(key, deque()).append((job, future))
+        self._changed(key)
+        self._dispatch()
+
+    def _dispatch(self):
+        # Queues are served in line order; one that gets a slot moves to the
+        # back, and so does one whose request has just finished
+        for key in list(self.queues):
+            if len(self.running) >= self.max_parallel:
+                break
+            if key in self.running or key in self.held:
+                continue
+            waiting = self.queues.pop(key)
+            while waiting:
+                job, future = waiting.popleft()
+                if future.set_running_or_notify_cancel():
+                    self._start(key, job, future)
+                    break
+            if waiting:
+                self.queues[key] = waiting
+            self._changed(key)
+
+    def _start(self, key, job, future):
+        try:
+            task = self.engine.loop.create_task(job())
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self.running[key] = task
+        task.add_done_callback(functools.partial(self._finished, key, future))
+
+    def _finished(self, key, future, task):
+        if self.running.get(key) is task:
+            del self.running[key]
+        if key in self.queues:
+            self.queues.move_to_end(key)
+        if task.cancelled():
+            future.set_exception(concurrent.futures.CancelledError())
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+        self._changed(key)
+        self._dispatch()
+
+    def _cancel(self, key, queued):
+        if queued:
+            for job, future in self.queues.pop(key, ()):
+                future.cancel()
+        task = self.running.get(key)
+        if task is not None:
+            task.cancel()
+        self._changed(key)
+
+    def _stop(self, keys, then):
+        self.held.update(keys)
+        tasks = [self.running[key] for key in keys if key in self.running]
+        for key in keys:
+            self._cancel(key, True)
+        self.engine.loop.create_task(self._release(keys, tasks, then))
+
+    async def _release(self, keys, tasks, then):
+        try:
+            if tasks:
+                await asyncio.wait(tasks)
+            then()
+        except Exception as e:
+            logging.error(f"Error after stopping requests: {str(e)}")
+        finally:
+            self.held.difference_update(keys)
+            self._dispatch()
+
+    def _set_limit(self, max_parallel):
+        self.max_parallel = max_parallel
+        self._dispatch()
+
+    def _changed(self, key):
+        depth = len(self.queues.get(key, ()))
+        if depth:
+            self.depths[key] = depth
+        else:
+            self.depths.pop(key, None)
+        if self.on_change is not None:
+            try:
+                self.on_change(key)
+            except Exception as e:
+                logging.error(f"Error reporting the request queue: {str(e)}")
+
+class SettingsStore:
+    # settings.txt with coalesced, atomic writes. A change only marks the
+    # store dirty; the file is written once there have been no changes for
+    # `delay` seconds, or straight away on flush(). Writing goes through a temp
+    # file and a rename, so a crash can never leave a truncated file behind.
+    # `data` belongs to the thread that calls set(), mark_dirty() and flush();
+    # the timer thread only ever writes the text serialized on that thread.
+    def __init__(self, path, delay=1.0):
+        self.path = path
+        self.delay = delay
+        self.data = {}
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.text = None
+        self.last_change = 0.0
+        self.timer = None
+        self.writes = 0
+
+    def load(self):
+        # Returns what is stored on disk; an unreadable file is logged and
+        # treated like a missing one so the defaults apply.
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+            if not isinstance(loaded, dict):
+                raise ValueError("settings must be a JSON object")
+            return loaded
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read {self.path}, using default settings: {str(e)}")
+            return {}
+
+    def set(self, key, value):
+        with self.lock:
+            if self.data.get(key) == value:
+                return
+            self.data[key] = value
+            self.mark_dirty()
+
+    def mark_dirty(self):
+        with self.lock:
+            self.text = json.dumps(self.data, indent=4)
+            self.dirty = True
+            self.last_change = time.monotonic()
+            if self.timer is None:
+                self._arm(self.delay)
+
+    def _arm(self, delay):
+        # One timer per quiet period, however many changes arrive meanwhile
+        self.timer = threading.Timer(delay, self._on_timer)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _on_timer(self):
+        with self.lock:
+            remaining = self.last_change + self.delay - time.monotonic()
+            if remaining > 0:
+                self._arm(remaining)
+                return
+            self.timer = None
+            self._write()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.dirty:
+                self.text = json.dumps(self.data, indent=4)
+                self._write()
+
+    def _write(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(self.text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                self.dirty = False
+                self.writes += 1
+            except OSError as e:
+                logging.error(f"Could not save settings: {str(e)}")
+
+class ApiError(Exception):
+    # The server answered, but with an error instead of a stream
+    def __init__(self, status, body="", retry_after=None):
+        super().__init__(f"API request failed with status code {status}")
+        self.status = status
+        self.body = body
+        self.retry_after = retry_after
+
+def payload_fields(settings, messages):
+    return {
+        "model": settings["model"],
+        "messages": messages,
+        "repetition_penalty": settings["repetition_penalty"],
+        "temperature": settings["temperature"],
+        "top_p": settings["top_p"],
+        "top_k": settings["top_k"],
+        "max_tokens": settings["max_tokens"],
+        "stream": True
+    }
+
+def build_payload(settings, messages):
+    return json.dumps(payload_fields(settings, messages)).encode("utf-8")
+
+class ResponseCache:
+    # Answers to earlier requests, keyed on a hash of everything that was sent:
+    # endpoint, model, messages and every sampling parameter. The most recent
+    # answers are kept in memory; all of them are also written to one small
+    # file each in `path`, which is kept under max_bytes by removing the least
+    # recently used files. A hit touches its file, so that order survives a
+    # restart.
+    #
+    # One cache is shared by every session using the directory, so max_bytes
+    # holds for all of them together. The lock makes it safe to use from any
+    # thread; on the engine loop aget() and aput() do the file I/O in the
+    # default executor, so a slow disk does not hold up other streams.
+    def __init__(self, path=RESPONSE_CACHE_DIR, max_entries=128, max_bytes=20000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.files = None
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(url, payload):
+        canonical = json.dumps([url, payload], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            content = self.memory.get(key)
+            if content is not None:
+                self.memory.move_to_end(key)
+            else:
+                content = self._load(key)
+            if content is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return content
+
+    def put(self, key, content):
+        with self.lock:
+            self._remember(key, content)
+            data = json.dumps({"content": content, "time": datetime.now().isoformat(timespec="seconds")},
+                              ensure_ascii=False).encode("utf-8")
+            if len(data) > self.max_bytes:
+                return
+            self._scan()
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                with open(self._file(key) + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(self._file(key) + ".tmp", self._file(key))
+            except OSError as e:
+                logging.error(f"Could not write to the response cache: {str(e)}")
+                return
+            self.disk_bytes += len(data) - self.files.pop(key, 0)
+            self.files[key] = len(data)
+            self.stores += 1
+            while self.disk_bytes > self.max_bytes and self.files:
+                self._evict(next(iter(self.files)))
+
+    async def aget(self, key):
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    async def aput(self, key, content):
+        await asyncio.get_running_loop().run_in_executor(None, self.put, key, content)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self._scan()
+            for key in list(self.files):
+                self._evict(key)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "stores": self.stores, "evictions": self.evictions,
+                    "entries": len(self.files) if self.files is not None else len(self.memory), "bytes": self.disk_bytes}
+
+    def summary(self):
+        stats = self.stats()
+        return f"cache {stats['hits']} hits / {stats['misses']} misses, {stats['entries']} answers, {stats['bytes'] // 1024} KB"
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def _scan(self):
+        # The files on disk, oldest use first; read once, then kept up to date
+        if self.files is not None:
+            return
+        self.files = OrderedDict()
+        try:
+            entries = [entry for entry in os.scandir(self.path) if entry.name.endswith(".json")]
+        except FileNotFoundError:
+            return
+        stats = [(entry.name[:-5], entry.stat()) for entry in entries]
+        for key, stat in sorted(stats, key=lambda item: item[1].st_mtime):
+            self.files[key] = stat.st_size
+            self.disk_bytes += stat.st_size
+
+    def _load(self, key):
+        self._scan()
+        if key not in self.files:
+            return None
+        try:
+            with open(self._file(key), "r", encoding="utf-8") as f:
+                content = json.load(f)["content"]
+            os.utime(self._file(key))
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Dropping unreadable response cache entry: {str(e)}")
+            self._evict(key)
+            return None
+        self.files.move_to_end(key)
+        self._remember(key, content)
+        return content
+
+    def _remember(self, key, content):
+        self.memory[key] = content
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _evict(self, key):
+        self.disk_bytes -= self.files.pop(key, 0)
+        self.memory.pop(key, None)
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Could not remove a response cache entry: {str(e)}")
+        self.evictions += 1
+
+def describe_error(e):
+    # What the user is told when a request fails
+    if isinstance(e, ApiError):
+        if e.status == 429:
+            wait = f" Please try again in {e.retry_after:.0f} seconds." if e.retry_after else " Please try again shortly."
+            return f"ArliAI.com is limiting requests right now.{wait}"
+        return str(e)
+    if isinstance(e, NetworkError):
+        return f"Please check your Internet Connection, or ArliAI.com service may be temporarily down. \n Network error: {str(e)}"
+    return f"Unexpected error: {str(e)}"
+
+def log_error(e):
+    if isinstance(e, ApiError):
+        if e.status == 429:
+            logging.error(f"API request rate limited: {e.body}")
+        else:
+            logging.error(f"API request failed: {str(e)}")
+            logging.error(f"Response content: {e.body}")
+    elif isinstance(e, NetworkError):
+        logging.error(f"Network error in API call: {str(e)}")
+    else:
+        logging.error(f"Unexpected error in API call: {str(e)}")
+
+class ChatSession:
+    # One conversation without any UI: the context window, the history journal
+    # and the streaming requests. The window and the command line mode each
+    # drive one of these and only decide how the text is shown.
+    #
+    # With history_file=None nothing is read from or written to disk. Several
+    # sessions can share one engine; with a RequestScheduler their background
+    # requests also wait for a free slot. Sessions that share a ResponseCache
+    # share its size limit; without one a cache is made when first needed.
+    def __init__(self, settings, api_key="", engine=None, history_file=CHAT_HISTORY_FILE, legacy_history_file=LEGACY_HISTORY_FILE,
+                 scheduler=None, cache=None):
+        self.settings = settings
+        self.api_key = api_key
+        self.owns_engine = engine is None
+        self.engine = engine or StreamingEngine()
+        self.scheduler = scheduler
+        self.history_file = history_file
+        self.legacy_history_file = legacy_history_file
+        self.conversation = Conversation()
+        self.journal = None
+        self.search_index = None
+        # Journal records so far (turns and clear markers); the number of the
+        # next turn to be recorded
+        self.record_count = 0
+        # The first record shown by the UI, and the oldest it may page back to
+        self.history_start = 0
+        self.history_floor = 0
+        self.last_metrics = None
+        self.cache = cache
+        # Rolling summary of conversation.turns[:summary_upto], written by a
+        # background request; `summary_generation` changes when the history is
+        # cleared so a summary still being written is thrown away.
+        self.summary = ""
+        self.summary_upto = 0
+        self.summary_generation = 0
+        self.summary_task = None
+        self.summary_file = history_file + ".summary" if history_file else None
+        # BM25 index of the history for retrieval_memory, created when first
+        # needed; `loaded_from` is the first record loaded into the
+        # conversation, older records are indexed in the background
+        self.memory = None
+        self.loaded_from = 0
+        self.last_recall = None
+        self.set_budget()
+
+    def set_budget(self):
+        self.conversation.set_budget(self.settings["model"], context_budget(self.settings))
+
+    def open_history(self):
+        # Opens the journal, importing the legacy transcript the first time,
+        # and loads the newest page of history into the context window.
+        # Returns that page so a UI can show it.
+        if self.history_file is None:
+            return []
+        try:
+            if not os.path.exists(self.history_file):
+                records = self.import_legacy_history()
+                if records:
+                    ChatJournal.write_all(self.history_file, records)
+        finally:
+            self.journal = ChatJournal(self.history_file, fsync=self.settings["history_fsync"])
+            if self.settings["search_index"] and HistoryIndex.available():
+                self.search_index = HistoryIndex(self.history_file + ".search.db", self.journal)
+                self.journal.on_write = self.search_index.notify
+
+        # Only the newest page is read at startup; older pages are read from
+        # the journal index when they are asked for.
+        self.history_start = self.record_count = self.journal.count()
+        records = self.read_history_page()
+        self.loaded_from = self.history_start
+        for record in records:
+            self.conversation.append(record["role"], record["content"], record["number"])
+        self.load_summary()
+        if self.settings["retrieval_memory"]:
+            self.start_memory()
+        return records
+
+    def load_summary(self):
+        # The summary from the last session covers turns before and maybe some
+        # of the page just loaded; the next summary merges any overlap.
+        try:
+            with open(self.summary_file, "r", encoding="utf-8") as f:
+                self.summary = json.load(f)["content"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Could not read the history summary: {str(e)}")
+
+    def read_history_page(self):
+        # The page of records before history_start, going back no further
+        # than history_floor
+        if self.journal is None or self.history_start <= self.history_floor:
+            return []
+        start = max(self.history_floor, self.history_start - self.settings["history_page_turns"])
+        if self.history_start > self.journal.count():
+            # Turns recorded moments ago may still be on their way to the file
+            self.journal.flush()
+        records = []
+        for number, record in self.journal.read_range(start, self.history_start):
+            # The record number goes with each turn so a UI can find it again
+            record["number"] = number
+            records.append(record)
+        self.history_start = start
+        # Nothing before a clear marker belongs to the current history
+        for i in range(len(records) - 1, -1, -1):
+            if records[i].get("type") == "clear":
+                records = records[i + 1:]
+                self.history_start = 0
+                break
+        return [record for record in records if "role" in record]
+
+    def import_legacy_history(self):
+        if self.legacy_history_file is None:
+            return []
+        try:
+            with open(self.legacy_history_file, "r", encoding="utf-8") as f:
+                history = f.read()
+        except UnicodeDecodeError:
+            # If UTF-8 fails, try with 'iso-8859-1' encoding
+            with open(self.legacy_history_file, "r", encoding="iso-8859-1") as f:
+                history = f.read()
+        except FileNotFoundError:
+            return []
+        return [turn.as_message() for turn in Conversation.from_transcript(history).turns]
+
+    def record_turn(self, role, content):
+        # Returns the number of bytes written to the history journal
+        self.conversation.append(role, content, self.record_count)
+        if self.memory is not None:
+            self.memory.add(self.record_count, role, content)
+        self.record_count += 1
+        if self.journal is not None:
+            return self.journal.append(role, content)
+        return 0
+
+    def search(self, query, limit=50):
+        # Turns of the saved history matching query; see HistoryIndex.search
+        if self.search_index is None:
+            return []
+        return self.search_index.search(query, limit)
+
+    def clear_history(self):
+        if self.journal is not None:
+            self.journal.clear()
+            self.record_count += 1
+        self.conversation.clear()
+        # Record numbers carry on after the marker; nothing before it is paged back in
+        self.history_start = self.history_floor = self.record_count
+        self.loaded_from = 0
+        self.memory = None
+        self.summary = ""
+        self.summary_upto = 0
+        self.summary_generation += 1
+        if self.summary_file is not None:
+            try:
+                os.remove(self.summary_file)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f"Could not remove the history summary: {str(e)}")
+
+    def delete_history(self):
+        # Closes the journal and removes its files, for a conversation that is
+        # being thrown away
+        self.clear_history()
+        if self.search_index is not None:
+            self.search_index.close()
+            self.search_index = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.history_file is not None:
+            search_db = self.history_file + ".search.db"
+            for path in (self.history_file, self.history_file + ".idx", search_db, search_db + "-wal", search_db + "-shm"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.error(f"Could not remove {path}: {str(e)}")
+
+    def cache_key(self, messages):
+        # The response cache key for these messages, or None when the request
+        # should not be cached with the current settings
+        mode = self.settings["response_cache"]
+        if mode == "off" or (mode == "deterministic" and self.settings["temperature"] != 0):
+            return None
+        if self.cache is None:
+            self.cache = ResponseCache(max_entries=self.settings["response_cache_entries"],
+                                       max_bytes=self.settings["response_cache_bytes"])
+        return ResponseCache.key(self.settings["api_url"], payload_fields(self.settings, messages))
+
+    def start_memory(self):
+        # Indexes the loaded turns now and the older history in the background
+        memory = self.memory = RetrievalMemory()
+        for turn in self.conversation.turns:
+            memory.add(turn.number, turn.role, turn.content)
+        if self.journal is not None and self.loaded_from > 0:
+            threading.Thread(target=self._index_older_history, args=(memory, self.journal, self.loaded_from),
+                             name="RetrievalMemory", daemon=True).start()
+
+    def _index_older_history(self, memory, journal, end, batch=500):
+        # Newest first, so the recent past is searchable soonest; nothing
+        # before a clear marker belongs to the history
+        started = time.perf_counter()
+        try:
+            while end > 0 and self.memory is memory:
+                start = max(0, end - batch)
+                for number, record in reversed(journal.read_range(start, end)):
+                    if record.get("type") == "clear":
+                        return
+                    if "role" in record and "content" in record:
+                        memory.add(number, record["role"], record["content"], keep_content=False)
+                end = start
+            logging.debug(f"Indexed {len(memory)} turns for retrieval in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logging.error(f"Could not index the older chat history: {str(e)}")
+
+    def _recall_candidates(self, user_message, start):
+        turns = self.conversation.turns
+        before = turns[start].number if start < len(turns) and turns[start].number is not None else self.record_count
+        return self.memory.search(user_message, before, self.settings["memory_turns"] * 4)
+
+    def recall(self, user_message, start, contents=None):
+        # The older turns that best match user_message, from before
+        # conversation.turns[start] (the oldest turn still in the window), as
+        # many as fit in memory_turns and memory_tokens, oldest first.
+        # `contents` has turns already read from the journal by number.
+        started = time.perf_counter()
+        limit = self.settings["memory_turns"]
+        budget = self.settings["memory_tokens"]
+        model = self.settings["model"]
+        chosen = []
+        tokens = 0
+        for number, score, role, content in self._recall_candidates(user_message, start):
+            if content is None:
+                content = contents[number] if contents and number in contents else self._read_turn(number)
+                if content is None:
+                    continue
+            count = estimate_tokens(f"{role}: {content}", model)
+            if tokens + count > budget:
+                continue
+            chosen.append((number, role, content))
+            tokens += count
+            if len(chosen) >= limit:
+                break
+        chosen.sort()
+        self.last_recall = (len(chosen), tokens, time.perf_counter() - started)
+        return "\n\n".join(f"{role}: {content}" for number, role, content in chosen)
+
+    def _read_turn(self, number):
+        try:
+            records = self.journal.read_range(number, number + 1) if self.journal is not None else []
+        except OSError as e:
+            logging.error(f"Could not read turn {number} of the chat history: {str(e)}")
+            return None
+        return records[0][1].get("content") if records else None
+
+    async def aprepare(self, user_message, metrics=None):
+        # prepare() for the engine loop: the older turns that recall() has to
+        # read from the journal are read in the executor first
+        contents = None
+        if self.settings["retrieval_memory"]:
+            if self.memory is None:
+                self.start_memory()
+            summary = self.summary if self.settings["history_summary"] else ""
+            start = self.conversation.window.recall_start(self.settings["system_prompt"], user_message, summary)
+            if start > 0:
+                numbers = [number for number, score, role, content in self._recall_candidates(user_message, start)
+                           if content is None]
+                if numbers:
+                    contents = await asyncio.get_running_loop().run_in_executor(None, self._read_turns, numbers)
+        return self.prepare(user_message, metrics, contents)
+
+    def _read_turns(self, numbers):
+        return {number: self._read_turn(number) for number in numbers}
+
+    def prepare(self, user_message, metrics=None, contents=None):
+        # Builds the messages for the API request from the context window and
+        # records the user's turn. Returns the messages for stream_reply().
+        summary = self.summary if self.settings["history_summary"] else ""
+        recall = None
+        self.last_recall = None
+        if self.settings["retrieval_memory"]:
+            if self.memory is None:
+                self.start_memory()
+            recall = functools.partial(self.recall, user_message, contents=contents)
+        messages = self.conversation.build_messages(self.settings["system_prompt"], user_message, summary, recall)
+        window = self.conversation.window
+        if window.last_dropped_turns and logging.getLogger().isEnabledFor(logging.DEBUG):
+            # dropped_tokens adds up every dropped turn, so it is only worked
+            # out when the message is going to be logged
+            logging.debug("Context window dropped %d turns (%d tokens), %d turns (%d tokens) in total",
+                          window.last_dropped_turns, window.last_dropped_tokens, window.dropped_turns, window.dropped_tokens)
+        written = self.record_turn("user", user_message)
+        if metrics is not None:
+            metrics.history_bytes += written
+            metrics.context_messages = len(messages)
+            if self.last_recall is not None:
+                metrics.recalled_turns, metrics.recalled_tokens, metrics.recall = self.last_recall
+        if self.settings["history_summary"]:
+            self.schedule_summary()
+        return messages
+
+    # Turns that must have left the window before a new summary is written,
+    # so there is not a summary request after every message
+    SUMMARY_BATCH_TURNS = 4
+
+    def schedule_summary(self):
+        # Turns that fell out of the context window and are not in the summary
+        # yet are summarized in the background. Requests keep using the last
+        # summary until the new one is ready.
+        upto = self.conversation.window.start
+        if upto - self.summary_upto < self.SUMMARY_BATCH_TURNS:
+            return
+        if self.summary_task is not None and not self.summary_task.done():
+            return
+        generation = self.summary_generation
+        if self.scheduler is not None:
+            self.summary_task = self.scheduler.submit((self, "summary"), lambda: self.summarize(upto, generation))
+        else:
+            self.summary_task = self.engine.submit(self.summarize(upto, generation))
+
+    async def summarize(self, upto, generation):
+        # Runs on the engine loop. Older turns are folded into the summary in
+        # batches that fit the model's context along with the summary itself.
+        model = self.settings["model"]
+        max_tokens = self.settings["summary_max_tokens"]
+        instructions = SUMMARY_PROMPT.format(words=int(max_tokens * 0.7))
+        limit = context_budget(self.settings) - max_tokens - estimate_tokens(instructions, model)
+        turns = self.conversation.turns[self.summary_upto:upto]
+        summary = self.summary
+        started = time.perf_counter()
+        try:
+            index = 0
+            while index < len(turns):
+                batch = []
+                tokens = estimate_tokens(summary, model)
+                while index < len(turns) and (not batch or tokens + turns[index].token_count(model) <= limit):
+                    batch.append(f"{turns[index].role}: {turns[index].content}")
+                    tokens += turns[index].token_count(model)
+                    index += 1
+                text = "\n\n".join(batch)
+                messages = [
+                    {"role": "system", "content": instructions},
+                    {"role": "user", "content": f"Summary so far:\n{summary or '(none)'}\n\nConversation:\n{text}"},
+                ]
+                summary = (await self.complete(messages, max_tokens)).strip() or summary
+        except (ApiError, NetworkError) as e:
+            logging.error(f"Could not summarize the older history: {str(e)}")
+            return
+        if generation != self.summary_generation:
+            return
+        self.summary = summary
+        self.summary_upto = upto
+        logging.debug(f"Summarized {len(turns)} turns into {estimate_tokens(summary, model)} tokens "
+                      f"in {time.perf_counter() - started:.1f}s")
+        self.save_summary()
+
+    def save_summary(self):
+        if self.summary_file is None:
+            return
+        try:
+            with open(self.summary_file + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"content": self.summary, "time": datetime.now().isoformat(timespec="seconds")}, f, ensure_ascii=False)
+            os.replace(self.summary_file + ".tmp", self.summary_file)
+        except OSError as e:
+            logging.error(f"Could not save the history summary: {str(e)}")
+
+    async def stream_reply(self, messages, on_delta, metrics=None):
+        # Runs as a task on the streaming engine's event loop. on_delta is
+        # called on the engine thread with every piece of the answer as it
+        # arrives. The answer is recorded once complete; if the task is
+        # cancelled, whatever had arrived is recorded instead. Raises ApiError
+        # or NetworkError when the request fails.
+        #
+        # With a RequestMetrics the timings of the request are filled in; the
+        # caller hands it to finish_metrics() once the answer is shown.
+        if metrics is None:
+            metrics = RequestMetrics(self.settings["model"])
+        key = self.cache_key(messages)
+        if key is not None:
+            cached = await self.cache.aget(key)
+            metrics.cache = "miss" if cached is None else "hit"
+            if cached is not None:
+                # Replayed through the same callback as a streamed answer
+                metrics.content(0)
+                on_delta(cached)
+                metrics.history_bytes += self.record_turn("assistant", cached)
+                metrics.finish("ok")
+                return cached
+
+        parts = []
+
+        def on_content(content):
+            parts.append(content)
+            on_delta(content)
+
+        try:
+            await self._stream(payload_fields(self.settings, messages), on_content, metrics)
+        except asyncio.CancelledError:
+            if parts:
+                metrics.history_bytes += self.record_turn("assistant", "".join(parts))
+            metrics.finish("cancelled")
+            raise
+        except ApiError as e:
+            metrics.finish(f"status {e.status}")
+            raise
+        except Exception as e:
+            metrics.finish(type(e).__name__)
+            raise
+        full_response = "".join(parts)
+        if full_response:
+            metrics.history_bytes += self.record_turn("assistant", full_response)
+            if key is not None:
+                await self.cache.aput(key, full_response)
+        metrics.finish("ok")
+        return full_response
+
+    async def complete(self, messages, max_tokens):
+        # The whole answer to a request the user does not see
+        parts = []
+        payload = dict(payload_fields(self.settings, messages), max_tokens=max_tokens)
+        await self._stream(payload, parts.append, RequestMetrics(self.settings["model"]))
+        return "".join(parts)
+
+    async def _stream(self, payload, on_content, metrics):
+        # Runs in a task of its own, so the log context stays with this request
+        context = LOG_CONTEXT.set((metrics.id, payload.get("model", metrics.model)))
+        try:
+            await self._stream_response(payload, on_content, metrics)
+        finally:
+            LOG_CONTEXT.reset(context)
+
+    async def _stream_response(self, payload, on_content, metrics):
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f"Bearer {self.api_key}"
+        }
+        body = json.dumps(payload).encode("utf-8")
+        response = await self.engine.post(self.settings["api_url"], headers, body, metrics)
+        stats = self.engine.stats()
+        logging.debug("Response headers after %.3fs, connection reused: %s, %d/%d requests on reused connections",
+                      self.engine.last_time_to_headers, self.engine.last_reused, stats["reused"], stats["requests"])
+        try:
+            if response.status != 200:
+                body = await response.read()
+                raise ApiError(response.status, body.decode("utf-8", "replace"),
+                               parse_retry_after(response.headers.get("retry-after")))
+            parser = SSEParser()
+            async for chunk in response.iter_chunks():
+                metrics.bytes_received += len(chunk)
+                contents = parser.contents(chunk)
+                if contents:
+                    metrics.content(len(contents))
+                    on_content("".join(contents))
+                if parser.done:
+                    break
+            parser.close()
+            if not parser.done:
+                raise NetworkError("The response ended before it was complete")
+        except asyncio.CancelledError:
+            # Stopped by the user: the rest of the answer is not wanted, so
+            # the connection is dropped instead of drained.
+            response.abort()
+            raise
+        finally:
+            await response.aclose()
+
+    def finish_metrics(self, metrics):
+        # Called once the answer has been shown; writes the metrics record
+        metrics.finish("ok")
+        self.last_metrics = metrics
+        if self.settings["metrics"]:
+            try:
+                metrics_logger().info(json.dumps(metrics.as_record()))
+            except Exception as e:
+                logging.error(f"Could not write metrics: {str(e)}")
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+        if self.search_index is not None:
+            self.search_index.close()
+        if self.owns_engine:
+            self.engine.close()
+
+class BatchRunner:
+    # Runs many independent prompts with the chat's model and settings, up
+    # to `concurrency` at a time, and appends one JSON line per result to
+    # the output as soon as it is finished. Prompts that already have an "ok"
+    # line in the output are skipped, so running the same batch again after
+    # an interruption picks up where it stopped.
+    #
+    # The engine already retries connection errors and 5xx answers before a
+    # stream starts; a request that still fails, or breaks off part way, is
+    # tried again up to `retries` times with exponential back-off.
+    def __init__(self, session, output, concurrency=1, retries=3, restart=False, progress=None):
+        self.session = session
+        self.output = output
+        self.concurrency = max(1, concurrency)
+        self.retries = max(0, retries)
+        self.restart = restart
+        # Called with the runner on the engine thread after every result
+        self.progress = progress
+        self.total = 0
+        self.skipped = 0
+        self.ok = 0
+        self.failed = 0
+        self.tokens = 0
+        self.ttfts = []
+        self.latencies = []
+        self.started = None
+        self.elapsed = 0.0
+
+    @staticmethod
+    def read_prompts(path, system_prompt):
+        # JSONL lines are {"prompt": "..."} or {"messages": [...]}, with an
+        # optional "id" and "system" (or just a JSON string). Any other file
+        # has one prompt per line. A prompt without an id is known by its
+        # line number.
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        first = next((line for line in lines if line.strip()), "")
+        jsonl = path.endswith((".jsonl", ".json")) or first.lstrip().startswith("{")
+        prompts = []
+        ids = set()
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            if jsonl:
+                try:
+                    item = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f"{path} line {number}: {str(e)}")
+                if isinstance(item, str):
+                    item = {"prompt": item}
+                if not isinstance(item, dict) or not (isinstance(item.get("prompt"), str) or isinstance(item.get("messages"), list)):
+                    raise ValueError(f'{path} line {number}: expected a "prompt" or "messages" field')
+            else:
+                item = {"prompt": line}
+            prompt_id = item.get("id", number)
+            if str(prompt_id) in ids:
+                raise ValueError(f"{path} line {number}: id {prompt_id} is used twice")
+            ids.add(str(prompt_id))
+            messages = item.get("messages") or [
+                {"role": "system", "content": item.get("system", system_prompt)},
+                {"role": "user", "content": item["prompt"]},
+            ]
+            prompts.append({"id": prompt_id, "prompt": item.get("prompt"), "messages": messages})
+        return prompts
+
+    def completed(self):
+        # Ids with an "ok" result in the output; broken lines (from a run that
+        # was killed while writing, maybe inside a UTF-8 character) are
+        # ignored, which is why the file is read as bytes
+        done = set()
+        try:
+            with open(self.output, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict) and record.get("status") == "ok":
+                        done.add(str(record.get("id")))
+        except FileNotFoundError:
+            pass
+        return done
+
+    async def run(self, prompts):
+        # Runs on the engine loop
+        done = set() if self.restart else self.completed()
+        todo = [prompt for prompt in prompts if str(prompt["id"]) not in done]
+        self.total = len(prompts)
+        self.skipped = len(prompts) - len(todo)
+        pending = iter(todo)
+        self.started = time.perf_counter()
+        if not self.restart:
+            self.end_last_line()
+        with open(self.output, "w" if self.restart else "a", encoding="utf-8") as out:
+
+            async def worker():
+                for prompt in pending:
+                    record = await self.run_one(prompt)
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+                    self.add(record)
+
+            try:
+                await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+            finally:
+                self.elapsed = time.perf_counter() - self.started
+
+    def end_last_line(self):
+        # A line cut short by an earlier run must not swallow the next
+        try:
+            with open(self.output, "rb+") as f:
+                size = f.seek(0, os.SEEK_END)
+                if size:
+                    f.seek(size - 1)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+        except FileNotFoundError:
+            pass
+
+    async def run_one(self, prompt):
+        settings = self.session.settings
+        messages = prompt["messages"]
+        record = {"id": prompt["id"]}
+        if prompt["prompt"] is not None:
+            record["prompt"] = prompt["prompt"]
+        key = self.session.cache_key(messages)
+        if key is not None:
+            cached = await self.session.cache.aget(key)
+            if cached is not None:
+                record.update(status="ok", response=cached, attempts=0, cache="hit", model=settings["model"])
+                return record
+
+        for attempt in range(self.retries + 1):
+            metrics = RequestMetrics(settings["model"])
+            parts = []
+            try:
+                await self.session._stream(payload_fields(settings, messages), parts.append, metrics)
+            except (ApiError, NetworkError) as e:
+                metrics.finish(f"status {e.status}" if isinstance(e, ApiError) else type(e).__name__)
+                log_error(e)
+                if attempt < self.retries and self.retryable(e):
+                    await asyncio.sleep(self.delay(e, attempt))
+                    continue
+                record.update(status="error", error=str(e), attempts=attempt + 1, model=settings["model"])
+                if isinstance(e, ApiError):
+                    record["http_status"] = e.status
+                return record
+            response = "".join(parts)
+            self.session.finish_metrics(metrics)
+            if key is not None and response:
+                await self.session.cache.aput(key, response)
+            stats = metrics.as_record()
+            record.update(status="ok", response=response, attempts=attempt + 1, model=settings["model"],
+                          ttft_ms=stats["ttft_ms"], total_ms=stats["total_ms"], tokens=metrics.tokens,
+                          tokens_per_sec=stats["tokens_per_sec"])
+            return record
+
+    @staticmethod
+    def retryable(e):
+        return isinstance(e, NetworkError) or e.status == 429 or e.status >= 500
+
+    def delay(self, e, attempt):
+        engine = self.session.engine
+        if isinstance(e, ApiError) and e.retry_after is not None:
+            return min(e.retry_after, engine.max_retry_after)
+        return engine.backoff(attempt)
+
+    def add(self, record):
+        if record["status"] == "ok":
+            self.ok += 1
+            self.tokens += record.get("tokens", 0)
+            if record.get("ttft_ms") is not None:
+                self.ttfts.append(record["ttft_ms"] / 1000)
+            if record.get("total_ms") is not None:
+                self.latencies.append(record["total_ms"] / 1000)
+        else:
+            self.failed += 1
+        if self.progress is not None:
+            self.progress(self)
+
+    def report(self):
+        # Throughput of the run, for the end of a batch
+        elapsed = self.elapsed or (time.perf_counter() - self.started if self.started else 0.0)
+        finished = self.ok + self.failed
+        lines = [f"{finished} of {self.total - self.skipped} prompts in {elapsed:.1f} s: {self.ok} ok, {self.failed} failed"
+                 + (f", {self.skipped} already done" if self.skipped else "")]
+        if elapsed > 0 and finished:
+            lines.append(f"{finished / elapsed:.2f} prompts/s, {self.tokens / elapsed:.1f} tokens/s at concurrency {self.concurrency}")
+        ttft = percentiles(self.ttfts)
+        latency = percentiles(self.latencies)
+        if ttft and latency:
+            lines.append(f"first token p50 {ttft['p50']:.0f} / p90 {ttft['p90']:.0f} ms, "
+                         f"answer p50 {latency['p50']:.0f} / p90 {latency['p90']:.0f} ms")
+        lines.append(f"Results in {self.output}")
+        return "\n".join(lines)
+
+def _write_delta(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+def ask(session, user_message, stats=False):
+    # Streams one answer to stdout. Ctrl+C stops the answer, keeping what had
+    # arrived, but not the program. Returns an exit status.
+    metrics = RequestMetrics(session.settings["model"])
+    messages = session.prepare(user_message, metrics)
+    finished = threading.Event()
+
+    async def reply():
+        try:
+            return await session.stream_reply(messages, _write_delta, metrics)
+        finally:
+            finished.set()
+
+    future = session.engine.submit(reply())
+    status = 0
+    try:
+        # Waiting in short steps keeps Ctrl+C working on Windows, where a
+        # blocking wait cannot be interrupted.
+        while True:
+            try:
+                future.result(timeout=0.2)
+                break
+            except concurrent.futures.TimeoutError:
+                continue
+        sys.stdout.write("\n")
+    except KeyboardInterrupt:
+        future.cancel()
+        # Let the task record the partial answer before anything is closed
+        finished.wait(2.0)
+        sys.stdout.write("\n")
+        status = 130
+    except Exception as e:
+        log_error(e)
+        sys.stdout.write("\n")
+        print(describe_error(e), file=sys.stderr)
+        status = 1
+    session.finish_metrics(metrics)
+    if stats:
+        sys.stdout.flush()
+        print(metrics.summary(), file=sys.stderr)
+        if session.cache is not None:
+            print(session.cache.summary(), file=sys.stderr)
+    return status
+
+def run_batch(session, path, output, concurrency, retries, restart):
+    # Command line side of BatchRunner. Ctrl+C stops the batch; every result
+    # already written stays in the output. Returns an exit status.
+    try:
+        prompts = BatchRunner.read_prompts(path, session.settings["system_prompt"])
+    except (OSError, ValueError) as e:
+        print(f"Could not read the prompts: {str(e)}", file=sys.stderr)
+        return 2
+    interactive = sys.stderr.isatty()
+
+    def progress(runner):
+        if interactive:
+            sys.stderr.write(f"\r{runner.ok + runner.failed}/{runner.total - runner.skipped} done, {runner.failed} failed")
+            sys.stderr.flush()
+
+    runner = BatchRunner(session, output, concurrency, retries, restart, progress)
+    future = session.engine.submit(runner.run(prompts))
+    status = 0
+    try:
+        while True:
+            try:
+                future.result(timeout=0.2)
+                break
+            except concurrent.futures.TimeoutError:
+                continue
+    except KeyboardInterrupt:
+        future.cancel()
+        status = 130
+    except OSError as e:
+        print(f"Could not write the results: {str(e)}", file=sys.stderr)
+        return 1
+    if interactive:
+        sys.stderr.write("\n")
+    if status == 130:
+        print("Stopped; run the same command again to continue.", file=sys.stderr)
+    print(runner.report(), file=sys.stderr)
+    if status == 0 and runner.failed:
+        status = 1
+    return status
+
+# Set for the window started by profile_startup(), which reports its startup
+# times on a line starting with STARTUP_PROFILE_MARK and closes
+STARTUP_PROFILE_ENV = "PURSUER_STARTUP_PROFILE"
+STARTUP_PROFILE_MARK = "startup-profile "
+
+def parse_importtime(lines):
+    # (name, depth, self ms, cumulative ms) for each "import time:" line that
+    # python -X importtime writes to stderr, in the order they finished
+    imports = []
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(parts[0]) / 1000, int(parts[1]) / 1000))
+    return imports
+
+def profile_startup(script, argv=None):
+    # Starts the window the way a user would, under -X importtime, and
+    # reports where the time went until the first paint and until the
+    # history was loaded. Exits with 1 when the first paint is over budget.
+    import argparse
+    import subprocess
+    parser = argparse.ArgumentParser(prog="pursuer-ai.py --startup-profile",
+                                     description="Measure how long the window takes to appear.")
+    parser.add_argument("--budget", type=float, default=750.0, help="time to first paint allowed, in ms (default 750)")
+    parser.add_argument("--top", type=int, default=15, help="number of imports to list (default 15)")
+    args = parser.parse_args([arg for arg in (argv or []) if arg != "--startup-profile"])
+
+    env = dict(os.environ, **{STARTUP_PROFILE_ENV: "1"})
+    started = time.time()
+    try:
+        child = subprocess.run([sys.executable, "-X", "importtime", script], env=env, capture_output=True,
+                               text=True, timeout=60)
+    except subprocess.TimeoutExpired:
+        print("The window did not report its startup within 60 seconds", file=sys.stderr)
+        return 2
+    report = None
+    for line in child.stdout.splitlines():
+        if line.startswith(STARTUP_PROFILE_MARK):
+            report = json.loads(line[len(STARTUP_PROFILE_MARK):])
+    stderr = child.stderr.splitlines()
+    if report is None:
+        print("The window did not report its startup:", file=sys.stderr)
+        print("\n".join(line for line in stderr if not line.startswith("import time:"))[-2000:], file=sys.stderr)
+        return 2
+
+    imports = parse_importtime(stderr)
+    before_paint = [entry for entry in imports if entry[0] in report["imported_before_paint"]]
+    first_paint = (report["first_paint"] - started) * 1000
+    print(f"Time to first paint:  {first_paint:7.0f} ms (budget {args.budget:.0f} ms)"
+          f"{'' if first_paint <= args.budget else '  OVER BUDGET'}")
+    print(f"  interpreter start:  {(report['script_started'] - started) * 1000:7.0f} ms")
+    print(f"  script to paint:    {(report['first_paint'] - report['script_started']) * 1000:7.0f} ms")
+    print(f"History loaded:       {(report['ready'] - started) * 1000:7.0f} ms")
+    print(f"Imports before paint: {sum(entry[2] for entry in before_paint):7.1f} ms in {len(before_paint)} modules")
+    print(f"Imports after paint:  {sum(entry[2] for entry in imports if entry not in before_paint):7.1f} ms")
+    print("\nSlowest imports before paint (self / cumulative ms):")
+    for name, depth, own, cumulative in sorted(before_paint, key=lambda entry: entry[3], reverse=True)[:args.top]:
+        print(f"  {own:7.1f} {cumulative:7.1f}  {'  ' * depth}{name}")
+    return 0 if first_paint <= args.budget else 1
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="pursuer-ai.py --cli",
+        description="Chat with ArliAI.com from the command line. Answers are streamed to stdout.")
+    parser.add_argument("prompt", nargs="*",
+                        help="message to send; read from stdin when omitted and stdin is not a terminal, "
+                             "otherwise an interactive chat starts")
+    parser.add_argument("--model", choices=AVAILABLE_MODELS, help="model to use for this run")
+    parser.add_argument("--system", help="system prompt for this run")
+    parser.add_argument("--no-history", action="store_true", help="do not read or write the saved chat history")
+    parser.add_argument("--api-url", help="chat completions endpoint to use instead of ArliAI.com")
+    parser.add_argument("--stats", action="store_true", help="print timings for every answer to stderr")
+    parser.add_argument("--summarize", action="store_true", help="summarize history that no longer fits in the context")
+    parser.add_argument("--memory", action="store_true", help="add the older turns that best match each message to the context")
+    parser.add_argument("--cache", choices=RESPONSE_CACHE_MODES,
+                        help="reuse saved answers to identical requests (deterministic: only at temperature 0)")
+    batch = parser.add_argument_group("batch mode")
+    batch.add_argument("--batch", metavar="FILE",
+                       help="answer every prompt in FILE (JSONL, or one prompt per line) and write the results to --output")
+    batch.add_argument("--output", metavar="FILE",
+                       help="JSONL file for the results (default: FILE.results.jsonl); prompts already answered there are skipped")
+    batch.add_argument("--concurrency", type=int, help="requests at once (default: max_parallel_requests from the settings)")
+    batch.add_argument("--retries", type=int, default=3, help="times a failed prompt is tried again (default: 3)")
+    batch.add_argument("--restart", action="store_true", help="overwrite --output instead of resuming")
+    args = parser.parse_args(argv)
+    if args.batch and args.prompt:
+        parser.error("a message cannot be given with --batch")
+
+    setup_logging(console=False)
+    if hasattr(sys.stdout, "reconfigure"):
+        # Some consoles cannot show every character a model may produce
+        sys.stdout.reconfigure(errors="replace")
+
+    settings = merge_settings(SettingsStore(SETTINGS_FILE).load())
+    if args.model:
+        settings["model"] = args.model
+    if args.system is not None:
+        settings["system_prompt"] = args.system
+    if args.api_url:
+        settings["api_url"] = args.api_url
+    if args.cache:
+        settings["response_cache"] = args.cache
+    if args.summarize:
+        settings["history_summary"] = True
+    if args.memory:
+        settings["retrieval_memory"] = True
+    api_key = os.environ.get("ARLIAI_API_KEY") or load_api_key()
+    if not api_key:
+        print(f"No API key found. Save one in the settings window, in {API_KEY_FILE}, or set ARLIAI_API_KEY.", file=sys.stderr)
+        return 2
+
+    if args.batch:
+        # Every prompt stands alone: no chat history is read or written
+        output = args.output or os.path.splitext(args.batch)[0] + ".results.jsonl"
+        if os.path.abspath(output) == os.path.abspath(args.batch):
+            parser.error("--output must not be the prompts file")
+        session = ChatSession(settings, api_key, history_file=None)
+        try:
+            return run_batch(session, args.batch, output, args.concurrency or settings["max_parallel_requests"],
+                             args.retries, args.restart)
+        finally:
+            session.close()
+
+    if args.prompt:
+        prompts = [" ".join(args.prompt)]
+    elif not sys.stdin.isatty():
+        prompts = [sys.stdin.read().strip()]
+        if not prompts[0]:
+            parser.error("no message given on stdin")
+    else:
+        prompts = None
+
+    session = ChatSession(settings, api_key, history_file=None if args.no_history else CHAT_HISTORY_FILE)
+    try:
+        try:
+            session.open_history()
+        except Exception as e:
+            logging.error(f"Encounterd an issue loading chat history: {str(e)}")
+            print(f"Encounterd an issue loading chat history: {str(e)}", file=sys.stderr)
+
+        if prompts is not None:
+            return ask(session, prompts[0], args.stats)
+
+        print("Pursuer AI. Type a message and press Enter; an empty line or Ctrl+D quits, Ctrl+C stops an answer.")
+        while True:
+            try:
+                user_message = input("You: ")
+            except (EOFError, KeyboardInterrupt):
+                print()
+                break
+            if not user_message.strip():
+                break
+            ask(session, user_message, args.stats)
+            print()
+        return 0
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
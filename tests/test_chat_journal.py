@@ -0,0 +1,126 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pursuer_core
+from pursuer_core import ChatJournal, ChatSession, HistoryIndex
+
+def record(role, content):
+    return ChatJournal.encode({"role": role, "content": content})
+
+class ChatJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "history.jsonl")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, data):
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def open_session(self, **settings):
+        settings = dict(pursuer_core.DEFAULT_SETTINGS, **dict({"search_index": False}, **settings))
+        session = ChatSession(settings, history_file=self.path, legacy_history_file=None)
+        self.addCleanup(session.close)
+        return session, session.open_history()
+
+    def test_reopen_after_a_tail_torn_inside_a_utf8_character(self):
+        torn = record("assistant", "café au lait")
+        self.write(record("user", "déjà vu?") + record("assistant", "oui") + torn[:torn.index("é".encode()) + 1])
+        session, records = self.open_session()
+        self.assertEqual([(r["number"], r["content"]) for r in records], [(0, "déjà vu?"), (1, "oui")])
+        # The torn line keeps its number; the next turn comes after it
+        self.assertEqual(session.record_count, 3)
+        self.assertEqual(session.journal.read_range(0, 3), [(0, {"role": "user", "content": "déjà vu?"}),
+                                                            (1, {"role": "assistant", "content": "oui"})])
+        session.record_turn("user", "encore")
+        session.journal.flush()
+        [(number, turn)] = session.journal.read_range(3, 4)
+        self.assertEqual((number, turn["content"]), (3, "encore"))
+
+    def test_close_compacts_a_journal_with_a_torn_line(self):
+        torn = record("assistant", "smörgåsbord")
+        self.write(record("user", "gone") + ChatJournal.encode({"type": "clear"}) + record("user", "kept")
+                   + torn[:torn.index("ö".encode()) + 1])
+        journal = ChatJournal(self.path)
+        journal.clear()
+        journal.append("user", "après")
+        started = time.monotonic()
+        journal.close()
+        self.assertFalse(journal.thread.is_alive())
+        self.assertLess(time.monotonic() - started, 2)
+        # Only what follows the last clear marker is left, renumbered from 0
+        self.assertEqual([r["content"] for r in ChatJournal.read(self.path)], ["après"])
+        journal = ChatJournal(self.path)
+        self.addCleanup(journal.close)
+        self.assertEqual(journal.count(), 1)
+        self.assertEqual(journal.read_range(0, 1)[0][1]["content"], "après")
+
+    def contents(self, journal, start=0, end=100):
+        return [turn.get("content", turn.get("type")) for number, turn in journal.read_range(start, end)]
+
+    def open_journal(self):
+        journal = ChatJournal(self.path)
+        self.addCleanup(journal.close)
+        return journal
+
+    def test_records_written_after_the_last_index_entry_are_indexed(self):
+        # A crash between writing a record and its index entry
+        ChatJournal.write_all(self.path, [{"role": "user", "content": "one"}, {"role": "assistant", "content": "two"}])
+        with open(self.path, "ab") as f:
+            f.write(record("user", "three") + record("assistant", "four"))
+        journal = self.open_journal()
+        self.assertEqual(journal.count(), 4)
+        self.assertEqual(self.contents(journal, 2), ["three", "four"])
+
+    def test_missing_index_is_rebuilt(self):
+        self.write(record("user", "one") + record("assistant", "two"))
+        journal = self.open_journal()
+        self.assertEqual(journal.count(), 2)
+        self.assertEqual(self.contents(journal, 1), ["two"])
+
+    def test_stale_index_is_rebuilt(self):
+        # The index of a longer journal than the one on disk
+        ChatJournal.write_all(self.path, [{"role": "user", "content": "x" * 100} for _ in range(3)])
+        self.write(record("user", "short"))
+        journal = self.open_journal()
+        self.assertEqual(journal.count(), 1)
+        self.assertEqual(self.contents(journal), ["short"])
+
+    def test_close_compacts_to_the_turns_after_the_last_clear(self):
+        journal = ChatJournal(self.path)
+        journal.append("user", "first")
+        journal.clear()
+        journal.append("user", "second")
+        journal.clear()
+        journal.append("user", "third")
+        journal.append("assistant", "fourth")
+        journal.flush()
+        self.assertEqual(self.contents(journal), ["first", "clear", "second", "clear", "third", "fourth"])
+        journal.close()
+        self.assertEqual(self.contents(self.open_journal()), ["third", "fourth"])
+
+    def test_close_leaves_a_journal_without_clear_markers_alone(self):
+        journal = ChatJournal(self.path)
+        journal.append("user", "first")
+        journal.flush()
+        written = os.stat(self.path).st_ino
+        journal.close()
+        self.assertEqual(os.stat(self.path).st_ino, written)
+
+    @unittest.skipUnless(HistoryIndex.available(), "SQLite without FTS5")
+    def test_search_index_skips_a_torn_line(self):
+        torn = record("assistant", "naïve answer")
+        self.write(record("user", "naïve question") + torn[:torn.index("ï".encode()) + 1])
+        session, records = self.open_session(search_index=True)
+        self.assertTrue(session.search_index.ready.wait(5))
+        self.assertEqual([hit["number"] for hit in session.search("naïve")], [0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import asyncio
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pursuer_core import RequestScheduler, StreamingEngine
+
+class RequestSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = StreamingEngine()
+        self.scheduler = RequestScheduler(self.engine, max_parallel=1)
+        self.events = []
+
+    def tearDown(self):
+        self.engine.close()
+
+    def job(self, name, started=None, forever=False):
+        async def run():
+            self.events.append(f"start {name}")
+            if started is not None:
+                started.set()
+            try:
+                await asyncio.sleep(60 if forever else 0)
+            except asyncio.CancelledError:
+                # Like a stream that records its partial answer when stopped
+                self.events.append(f"cancelled {name}")
+                raise
+            self.events.append(f"end {name}")
+        return run
+
+    def test_free_slots_go_round_robin(self):
+        release = threading.Event()
+        started = threading.Event()
+
+        def blocked():
+            async def run():
+                self.events.append("start a1")
+                started.set()
+                await self.engine.loop.run_in_executor(None, release.wait, 5)
+            return run()
+
+        futures = [self.scheduler.submit("a", blocked)]
+        self.assertTrue(started.wait(5))
+        futures += [self.scheduler.submit("a", self.job(name)) for name in ("a2", "a3")]
+        futures += [self.scheduler.submit("b", self.job(name)) for name in ("b1", "b2")]
+        futures.append(self.scheduler.submit("c", self.job("c1")))
+        release.set()
+        for future in futures:
+            future.result(5)
+        starts = [event for event in self.events if event.startswith("start")]
+        self.assertEqual(starts, ["start a1", "start b1", "start c1", "start a2", "start b2", "start a3"])
+
+    def test_limit_on_parallel_requests(self):
+        self.scheduler.set_limit(2)
+        futures = [self.scheduler.submit(key, self.job(key, forever=True)) for key in ("a", "b", "c")]
+        deadline = time.monotonic() + 5
+        while self.scheduler.stats()["running"] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.scheduler.stats(), {"running": 2, "queued": 1, "max_parallel": 2})
+        self.assertEqual(self.events, ["start a", "start b"])
+        # A finished request frees its slot for the one waiting
+        self.scheduler.cancel("a")
+        with self.assertRaises(concurrent.futures.CancelledError):
+            futures[0].result(5)
+        deadline = time.monotonic() + 5
+        while "start c" not in self.events and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.events, ["start a", "start b", "cancelled a", "start c"])
+        for key, future in zip(("b", "c"), futures[1:]):
+            self.scheduler.cancel(key)
+            with self.assertRaises(concurrent.futures.CancelledError):
+                future.result(5)
+
+    def test_stop_waits_for_the_running_request(self):
+        started = threading.Event()
+        done = threading.Event()
+        first = self.scheduler.submit("tab", self.job("a", started, forever=True))
+        queued = self.scheduler.submit("tab", self.job("b"))
+        self.assertTrue(started.wait(5))
+
+        def then():
+            self.events.append("then")
+            done.set()
+
+        self.scheduler.stop(("tab", ("tab", "summary")), then)
+        later = self.scheduler.submit("tab", self.job("c"))
+        self.assertTrue(done.wait(5))
+        later.result(5)
+        with self.assertRaises(concurrent.futures.CancelledError):
+            first.result(5)
+        self.assertTrue(queued.cancelled())
+        # Nothing of the tab runs between the stopped request and then()
+        self.assertEqual(self.events, ["start a", "cancelled a", "then", "start c", "end c"])
+
+if __name__ == "__main__":
+    unittest.main()
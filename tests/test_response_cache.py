@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pursuer_core import ResponseCache
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "response_cache")
+
+    def test_key_covers_everything_sent(self):
+        payload = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "temperature": 0}
+        self.assertEqual(ResponseCache.key("url", payload), ResponseCache.key("url", dict(reversed(payload.items()))))
+        self.assertNotEqual(ResponseCache.key("url", payload), ResponseCache.key("url", dict(payload, temperature=0.5)))
+        self.assertNotEqual(ResponseCache.key("url", payload), ResponseCache.key("other", payload))
+
+    def test_answers_survive_a_restart(self):
+        ResponseCache(self.path).put("a", "answer")
+        cache = ResponseCache(self.path)
+        self.assertEqual(cache.get("a"), "answer")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_memory_keeps_the_most_recent_answers(self):
+        cache = ResponseCache(self.path, max_entries=2)
+        for key in "abc":
+            cache.put(key, key * 3)
+        cache.get("b")
+        cache.put("d", "ddd")
+        self.assertEqual(list(cache.memory), ["b", "d"])
+        # Older answers are still on disk
+        self.assertEqual(cache.get("a"), "aaa")
+
+    def test_least_recently_used_files_are_removed_over_max_bytes(self):
+        cache = ResponseCache(self.path)
+        cache.put("a", "x" * 100)
+        size = cache.stats()["bytes"]
+        cache = ResponseCache(self.path, max_bytes=size * 2)
+        cache.put("b", "x" * 100)
+        # A hit moves the answer to the back of the line, also across a restart
+        old = time.time() - 60
+        os.utime(os.path.join(self.path, "b.json"), (old, old))
+        cache = ResponseCache(self.path, max_bytes=size * 2)
+        self.assertEqual(cache.get("b"), "x" * 100)
+        cache.put("c", "x" * 100)
+        self.assertEqual(sorted(os.listdir(self.path)), ["b.json", "c.json"])
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertLessEqual(cache.stats()["bytes"], size * 2)
+
+    def test_unreadable_entry_is_dropped(self):
+        os.makedirs(self.path)
+        with open(os.path.join(self.path, "a.json"), "w") as f:
+            f.write("{torn")
+        cache = ResponseCache(self.path)
+        with self.assertLogs(level="ERROR"):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_clear(self):
+        cache = ResponseCache(self.path)
+        cache.put("a", "answer")
+        cache.clear()
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
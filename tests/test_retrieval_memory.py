@@ -0,0 +1,93 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pursuer_core
+from pursuer_core import ChatJournal, ChatSession, RetrievalMemory
+
+class RetrievalMemoryTest(unittest.TestCase):
+    def memory(self, *contents):
+        memory = RetrievalMemory()
+        for number, content in enumerate(contents):
+            memory.add(number, "user", content)
+        return memory
+
+    def numbers(self, hits):
+        return [number for number, score, role, content in hits]
+
+    def test_rarer_terms_count_for_more(self):
+        memory = self.memory("python lists and python tuples", "python dictionaries", "rust ownership", "python sets")
+        self.assertEqual(self.numbers(memory.search("python ownership", 10, 2)), [2, 0])
+
+    def test_shorter_turns_rank_higher_for_the_same_matches(self):
+        memory = self.memory("zebra " + "padding words " * 30, "zebra stripes")
+        self.assertEqual(self.numbers(memory.search("zebra", 10, 5)), [1, 0])
+
+    def test_only_turns_before_the_window(self):
+        memory = self.memory("zebra", "zebra zebra", "zebra zebra zebra")
+        self.assertEqual(sorted(self.numbers(memory.search("zebra", 2, 5))), [0, 1])
+
+    def test_stopwords_and_unknown_terms_match_nothing(self):
+        memory = self.memory("what is the zebra")
+        self.assertEqual(memory.search("what is the", 10, 5), [])
+        self.assertEqual(memory.search("giraffe", 10, 5), [])
+        self.assertEqual(RetrievalMemory().search("zebra", 10, 5), [])
+
+    def test_content_is_kept_only_when_asked(self):
+        memory = RetrievalMemory()
+        memory.add(0, "user", "zebra facts")
+        memory.add(1, "assistant", "zebra answers", keep_content=False)
+        # A turn is only indexed once
+        memory.add(1, "assistant", "zebra answers")
+        self.assertEqual(len(memory), 2)
+        hits = {number: (role, content) for number, score, role, content in memory.search("zebra", 10, 5)}
+        self.assertEqual(hits, {0: ("user", "zebra facts"), 1: ("assistant", None)})
+
+class RecallTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "history.jsonl")
+
+    def open_session(self, turns, **settings):
+        with open(self.path, "wb") as f:
+            for role, content in turns:
+                f.write(ChatJournal.encode({"role": role, "content": content}))
+        settings = dict(pursuer_core.DEFAULT_SETTINGS, **dict({"search_index": False}, **settings))
+        session = ChatSession(settings, history_file=self.path, legacy_history_file=None)
+        self.addCleanup(session.close)
+        session.open_history()
+        # Turns older than the loaded page are indexed on a thread
+        deadline = time.monotonic() + 5
+        while len(session.memory) < len(turns) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return session
+
+    def test_aprepare_reads_recalled_turns_off_the_event_loop(self):
+        filler = " ".join(["nothing to see here"] * 40)
+        turns = [("user", "where do zebras live?"), ("assistant", "Zebras live in Africa.")]
+        turns += [("user" if i % 2 == 0 else "assistant", filler) for i in range(8)]
+        session = self.open_session(turns, retrieval_memory=True, history_page_turns=4, max_history_tokens=400)
+        reads = []
+        read_turn = session._read_turn
+        def _read_turn(number):
+            reads.append((number, threading.current_thread()))
+            return read_turn(number)
+        session._read_turn = _read_turn
+
+        async def prepare():
+            return await session.aprepare("tell me about zebras"), threading.current_thread()
+
+        messages, loop_thread = asyncio.run(prepare())
+        self.assertIn("assistant: Zebras live in Africa.", messages[0]["content"])
+        self.assertEqual(sorted(number for number, thread in reads)[:2], [0, 1])
+        self.assertNotIn(loop_thread, [thread for number, thread in reads])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,266 @@
+import collections
+import importlib.util
+import os
+import re
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pursuer_core
+
+# The app's file name has a dash in it, so it is loaded by path
+spec = importlib.util.spec_from_file_location("pursuer_ai", os.path.join(ROOT, "pursuer-ai.py"))
+pursuer_ai = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(pursuer_ai)
+
+class FakeText:
+    # Just enough of tkinter.Text for the display logic: text, tags, marks
+    # with gravity, and a view of LINES lines.
+    LINES = 4
+    INDEX = re.compile(r"(?P<base>.*?)(?P<mods>(?:\s*[+-]\s*\d+\s*c|\s+lineend)*)\Z")
+
+    def __init__(self):
+        self.text = ""
+        self.tags = {}
+        self.marks = {}
+        self.order = 0
+        self.top = 0
+        self.state = "normal"
+
+    def _line_start(self, line):
+        offset = 0
+        for _ in range(line - 1):
+            offset = self.text.index("\n", offset) + 1
+        return offset
+
+    def _off(self, index):
+        match = self.INDEX.match(str(index).strip())
+        base = match.group("base")
+        if base == "end":
+            offset = len(self.text) + 1
+        elif base.startswith("@"):
+            offset = self.top
+        elif base in self.marks:
+            offset = self.marks[base][0]
+        else:
+            line, column = map(int, base.split("."))
+            if line > self.text.count("\n") + 1:
+                offset = len(self.text) + 1
+            else:
+                start = self._line_start(line)
+                end = self.text.find("\n", start)
+                offset = start + min(column, (len(self.text) if end < 0 else end) - start)
+        for sign, count, unit in re.findall(r"([+-]?)\s*(\d*)\s*(c|lineend)", match.group("mods")):
+            if unit == "c":
+                offset += int(count) if sign == "+" else -int(count)
+            else:
+                end = self.text.find("\n", offset)
+                offset = len(self.text) if end < 0 else end
+        return max(0, min(offset, len(self.text)))
+
+    def index(self, index):
+        offset = self._off(index)
+        before = self.text[:offset]
+        return f"{before.count(chr(10)) + 1}.{offset - before.rfind(chr(10)) - 1}"
+
+    def compare(self, a, op, b):
+        return {"<": int.__lt__, "<=": int.__le__, "==": int.__eq__, ">=": int.__ge__, ">": int.__gt__,
+                "!=": int.__ne__}[op](self._off(a), self._off(b))
+
+    def get(self, a, b):
+        return self.text[self._off(a):self._off(b)]
+
+    def config(self, **options):
+        self.state = options.get("state", self.state)
+
+    configure = config
+
+    def insert(self, index, text, tags=()):
+        offset = self._off(index)
+        self.text = self.text[:offset] + text + self.text[offset:]
+        n = len(text)
+        for name, (position, gravity, order) in self.marks.items():
+            if position > offset or (position == offset and gravity == "right"):
+                self.marks[name][0] += n
+        if self.top > offset:
+            self.top += n
+        for name, offsets in self.tags.items():
+            self.tags[name] = {o + n if o >= offset else o for o in offsets}
+        if isinstance(tags, str):
+            tags = (tags,)
+        for name in tags:
+            self.tags.setdefault(name, set()).update(range(offset, offset + n))
+
+    def delete(self, a, b):
+        a, b = self._off(a), self._off(b)
+        if b <= a:
+            return
+        self.text = self.text[:a] + self.text[b:]
+        for mark in self.marks.values():
+            mark[0] = a if a <= mark[0] <= b else mark[0] - (b - a) if mark[0] > b else mark[0]
+        self.top = a if a <= self.top <= b else self.top - (b - a) if self.top > b else self.top
+        for name, offsets in self.tags.items():
+            self.tags[name] = {o if o < a else o - (b - a) for o in offsets if not a <= o < b}
+
+    def tag_add(self, name, *indices):
+        for a, b in zip(indices[::2], indices[1::2]):
+            self.tags.setdefault(name, set()).update(range(self._off(a), self._off(b)))
+
+    def tag_remove(self, name, a, b):
+        self.tags.get(name, set()).difference_update(range(self._off(a), self._off(b)))
+
+    def tagged(self, name):
+        offsets = sorted(self.tags.get(name, ()))
+        return "".join(self.text[o] for o in offsets)
+
+    def mark_set(self, name, index):
+        offset = self._off(index)
+        if name in self.marks:
+            self.marks[name][0] = offset
+        else:
+            self.order += 1
+            self.marks[name] = [offset, "right", self.order]
+
+    def mark_gravity(self, name, gravity=None):
+        if gravity is None:
+            return self.marks[name][1]
+        self.marks[name][1] = gravity
+
+    def mark_unset(self, *names):
+        for name in names:
+            del self.marks[name]
+
+    def mark_names(self):
+        return tuple(self.marks)
+
+    def _sorted_marks(self):
+        return sorted(self.marks, key=lambda name: (self.marks[name][0], self.marks[name][2]))
+
+    def mark_next(self, index):
+        names = self._sorted_marks()
+        if index in self.marks:
+            i = names.index(index) + 1
+            return names[i] if i < len(names) else None
+        offset = self._off(index)
+        return next((name for name in names if self.marks[name][0] >= offset), None)
+
+    def mark_previous(self, index):
+        names = self._sorted_marks()
+        if index in self.marks:
+            i = names.index(index)
+            return names[i - 1] if i else None
+        offset = self._off(index)
+        return next((name for name in reversed(names) if self.marks[name][0] < offset), None)
+
+    def _line(self, offset):
+        return self.text.count("\n", 0, offset)
+
+    def yview(self, index=None):
+        lines = self.text.count("\n") + 1
+        if index is None:
+            first = self._line(self.top)
+            return first / lines, min(1.0, (first + self.LINES) / lines)
+        self.top = self._line_start(self._line(self._off(index)) + 1)
+
+    def see(self, index):
+        line = self._line(self._off(index))
+        first = self._line(self.top)
+        if line < first:
+            self.top = self._line_start(line + 1)
+        elif line >= first + self.LINES:
+            self.top = self._line_start(line - self.LINES + 2)
+
+class App:
+    def __init__(self, settings):
+        self.settings = settings
+
+class ScrollbackTest(unittest.TestCase):
+    # The chat display keeps scrollback_turns turns; older ones are paged back
+    # in from the journal when the chat is scrolled to the top
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.open_tab()
+
+    def open_tab(self):
+        settings = dict(pursuer_core.DEFAULT_SETTINGS, scrollback_turns=4, history_page_turns=3, search_index=False)
+        self.session = pursuer_core.ChatSession(settings, history_file=os.path.join(self.dir.name, "history.jsonl"),
+                                                legacy_history_file=None)
+        tab = self.tab = pursuer_ai.ChatTab.__new__(pursuer_ai.ChatTab)
+        tab.app = App(settings)
+        tab.session = self.session
+        tab.closed = False
+        tab.current_metrics = None
+        tab.shown_turns = collections.deque()
+        tab.chat_display = FakeText()
+        tab.renderer = pursuer_ai.StreamingMarkdownRenderer(tab.chat_display)
+        tab.insert_history_page(self.session.open_history())
+
+    def tearDown(self):
+        self.session.close()
+        self.dir.cleanup()
+
+    def exchange(self, question):
+        # What sending a message does to the session and the display
+        number = self.session.record_count
+        self.session.record_turn("user", question)
+        self.tab.start_request(question, None, number)
+        self.tab.render(f"**answer** to {question}", 0)
+        self.tab.render("\n\n\n", 0)
+        self.session.record_turn("assistant", f"**answer** to {question}")
+        self.tab.chat_display.see("end")
+
+    def shown(self):
+        return re.findall(r"You: (\S+)", self.tab.chat_display.text)
+
+    def scroll_back(self):
+        while self.session.history_start > self.session.history_floor:
+            self.tab.page_in_history()
+
+    def test_trim_then_scroll_back_after_clear_history(self):
+        for i in range(3):
+            self.exchange(f"old{i}")
+        self.session.clear_history()
+        self.tab.clear_screen()
+        for i in range(5):
+            self.exchange(f"new{i}")
+        # 4 turns kept: the last two questions with their answers. Records
+        # 0-5 are the cleared turns and 6 the clear marker.
+        self.assertEqual(self.shown(), ["new3", "new4"])
+        self.assertEqual(list(self.tab.shown_turns), [13, 14, 15, 16])
+
+        self.scroll_back()
+        self.assertEqual(self.shown(), [f"new{i}" for i in range(5)])
+        self.assertEqual(list(self.tab.shown_turns), list(range(7, 17)))
+        display = self.tab.chat_display
+        for number in self.tab.shown_turns:
+            self.assertTrue(display.get(f"turn-{number}", f"turn-{number} lineend"))
+        self.assertEqual(display.get("turn-9", "turn-9 lineend"), "You: new1")
+        self.assertEqual(display.get("turn-10", "turn-10 lineend"), "answer to new1")
+        self.assertEqual(display.tagged("bold"), "answer" * 5)
+
+        # Trimmed again by the next exchange, and paged in again
+        self.exchange("new5")
+        self.assertEqual(self.shown(), ["new4", "new5"])
+        self.scroll_back()
+        self.assertEqual(self.shown(), [f"new{i}" for i in range(6)])
+
+    def test_trim_after_reopening_a_cleared_history(self):
+        for i in range(3):
+            self.exchange(f"old{i}")
+        self.session.clear_history()
+        self.exchange("new0")
+        # The journal is compacted when it is closed, which renumbers it
+        self.session.close()
+        self.open_tab()
+        for i in range(1, 4):
+            self.exchange(f"new{i}")
+        self.assertEqual(self.shown(), ["new2", "new3"])
+        self.scroll_back()
+        self.assertEqual(self.shown(), [f"new{i}" for i in range(4)])
+        self.assertEqual(list(self.tab.shown_turns), list(range(8)))
+
+if __name__ == "__main__":
+    unittest.main()
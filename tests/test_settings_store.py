@@ -0,0 +1,48 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pursuer_core import SettingsStore
+
+class SettingsStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "settings.txt")
+
+    def stored(self):
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_timer_writes_the_settings_as_they_were_when_changed(self):
+        # The owner keeps changing `data` while the timer thread writes
+        store = SettingsStore(self.path, delay=0.05)
+        written = threading.Event()
+        write = store._write
+        def _write():
+            store.data["window"] = object()
+            write()
+            written.set()
+        store._write = _write
+        store.set("model", "a")
+        self.assertTrue(written.wait(5))
+        self.assertEqual(self.stored(), {"model": "a"})
+        self.assertEqual(store.writes, 1)
+
+    def test_flush_writes_the_current_settings(self):
+        store = SettingsStore(self.path, delay=60)
+        store.set("model", "a")
+        store.data["temperature"] = 0.5
+        store.flush()
+        self.assertEqual(self.stored(), {"model": "a", "temperature": 0.5})
+        self.assertIsNone(store.timer)
+        store.flush()
+        self.assertEqual(store.writes, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pursuer_core import SSEParser
+
+def delta(content):
+    return b"data: " + json.dumps({"choices": [{"delta": {"content": content}}]}).encode() + b"\n\n"
+
+class SSEParserTest(unittest.TestCase):
+    def feed(self, parser, chunks):
+        out = []
+        for chunk in chunks:
+            out.extend(parser.contents(chunk))
+        return out
+
+    def test_events_split_across_chunks(self):
+        stream = delta("Hel") + delta("lo") + delta(" there") + b"data: [DONE]\n\n"
+        for size in (1, 2, 7, len(stream)):
+            parser = SSEParser()
+            chunks = [stream[i:i + size] for i in range(0, len(stream), size)]
+            self.assertEqual("".join(self.feed(parser, chunks)), "Hello there", size)
+            self.assertTrue(parser.done)
+
+    def test_crlf_split_between_chunks(self):
+        stream = (delta("a") + delta("b")).replace(b"\n", b"\r\n")
+        parser = SSEParser()
+        chunks = [stream[:stream.index(b"\r") + 1], stream[stream.index(b"\r") + 1:]]
+        self.assertEqual(self.feed(parser, chunks), ["a", "b"])
+        self.assertEqual(parser.partial, [])
+
+    def test_nothing_after_done(self):
+        parser = SSEParser()
+        self.assertEqual(parser.contents(delta("a") + b"data: [DONE]\n\n" + delta("b")), ["a"])
+
+    def test_multiline_data_comments_and_other_fields(self):
+        event = json.dumps({"choices": [{"delta": {"content": "joined"}}]}, indent=1).encode()
+        block = b": keep-alive\nevent: message\nid: 7\n" + b"\n".join(b"data: " + line for line in event.split(b"\n"))
+        parser = SSEParser()
+        self.assertEqual(parser.contents(block + b"\n\n"), ["joined"])
+        self.assertEqual(parser.errors, 0)
+
+    def test_escaped_content_takes_the_json_path(self):
+        parser = SSEParser()
+        self.assertEqual(parser.contents(delta('say "hi"\n') + delta("plain")), ['say "hi"\n', "plain"])
+        self.assertEqual((parser.fast, parser.slow), (1, 1))
+
+    def test_errors_are_counted_and_skipped(self):
+        parser = SSEParser(error_limit=2)
+        with self.assertLogs(level="ERROR") as logs:
+            out = parser.contents(b"data: {not json\n\n" + b'data: {"error": "overloaded"}\n\n' + b"garbage\n\n" + delta("ok"))
+        self.assertEqual(out, ["ok"])
+        self.assertEqual(parser.errors, 3)
+        # Two errors and the notice that the rest are only counted
+        self.assertEqual(len(logs.output), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+from email.utils import formatdate
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pursuer_core import NetworkError, RequestMetrics, StreamingEngine, parse_retry_after
+
+class Server:
+    # Reads the request line and headers of every connection on a thread of
+    # its own, then calls answer(conn); without one it never answers.
+    # `closed` is set when a client hangs up.
+    def __init__(self, answer=None):
+        self.socket = socket.create_server(("127.0.0.1", 0))
+        self.address = f"127.0.0.1:{self.socket.getsockname()[1]}"
+        self.url = f"http://{self.address}/v1/chat/completions"
+        self.answer = answer
+        self.requests = []
+        self.received = threading.Event()
+        self.closed = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        conn.settimeout(10)
+        with conn:
+            try:
+                data = b""
+                while b"\r\n\r\n" not in data:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        return
+                    data += chunk
+                self.requests.append(data.split(b"\r\n", 1)[0].decode("latin-1"))
+                self.received.set()
+                if self.answer is not None:
+                    self.answer(conn)
+                while conn.recv(65536):
+                    pass
+                self.closed.set()
+            except OSError:
+                pass
+
+    def close(self):
+        self.socket.close()
+
+def answer_ok(conn):
+    conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+
+def answer_and_close(data):
+    def answer(conn):
+        conn.sendall(data)
+        conn.shutdown(socket.SHUT_WR)
+    return answer
+
+class StreamingEngineTest(unittest.TestCase):
+    def setUp(self):
+        # The test servers are reached directly whatever proxy is set up here
+        environ = mock.patch.dict(os.environ, {"no_proxy": "127.0.0.1"})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.use_engine(retries=0)
+
+    def use_engine(self, **options):
+        self.engine = StreamingEngine(**options)
+        self.addCleanup(self.engine.close)
+
+    def server(self, answer=None):
+        server = Server(answer)
+        self.addCleanup(server.close)
+        return server
+
+    def post(self, url, metrics=None, timeout=10):
+        async def post():
+            response = await self.engine.post(url, {}, b"{}", metrics)
+            return response.status, await response.read()
+        return self.engine.submit(post()).result(timeout)
+
+    def fetch(self, url):
+        # The body, and whether the connection went back to the pool
+        async def fetch():
+            response = await self.engine.post(url, {}, b"{}")
+            try:
+                return await response.read()
+            finally:
+                await response.aclose()
+        body = self.engine.submit(fetch()).result(10)
+        return body, sum(len(idle) for idle in self.engine.pool.idle.values()) > 0
+
+    def test_chunked_body(self):
+        server = self.server(lambda conn: conn.sendall(
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"5;name=value\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: yes\r\n\r\n"))
+        self.assertEqual(self.fetch(server.url), (b"hello world", True))
+
+    def test_close_delimited_body(self):
+        server = self.server(answer_and_close(b"HTTP/1.1 200 OK\r\n\r\nhello world"))
+        self.assertEqual(self.fetch(server.url), (b"hello world", False))
+
+    def test_body_cut_short(self):
+        server = self.server(answer_and_close(b"HTTP/1.1 200 OK\r\nContent-Length: 20\r\n\r\nhello"))
+        with self.assertRaises(NetworkError):
+            self.fetch(server.url)
+
+    def test_invalid_chunk_header(self):
+        server = self.server(answer_and_close(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nhello\r\n"))
+        with self.assertRaises(NetworkError):
+            self.fetch(server.url)
+
+    def test_cancel_before_first_byte_closes_the_connection(self):
+        server = self.server()
+        future = self.engine.submit(self.engine.post(server.url, {}, b"{}"))
+        self.assertTrue(server.received.wait(5))
+        future.cancel()
+        self.assertTrue(server.closed.wait(5))
+        self.assertEqual(sum(len(idle) for idle in self.engine.pool.idle.values()), 0)
+
+    def test_timeout_after_sending_is_not_retried(self):
+        # The server may be working on the first request; a second one
+        # could run the same completion twice
+        self.use_engine(retries=3, backoff_factor=0.01, read_timeout=0.2)
+        server = self.server()
+        metrics = RequestMetrics("model")
+        with self.assertRaises(NetworkError) as raised:
+            self.post(server.url, metrics)
+        self.assertTrue(raised.exception.sent)
+        self.assertEqual(metrics.attempts, 1)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_connect_failure_is_retried(self):
+        self.use_engine(retries=2, backoff_factor=0.01)
+        unused = socket.create_server(("127.0.0.1", 0))
+        url = f"http://127.0.0.1:{unused.getsockname()[1]}/v1/chat/completions"
+        unused.close()
+        metrics = RequestMetrics("model")
+        with self.assertRaises(NetworkError) as raised:
+            self.post(url, metrics)
+        self.assertFalse(raised.exception.sent)
+        self.assertEqual(metrics.attempts, 3)
+
+    def test_http_request_through_proxy(self):
+        proxy = self.server(answer_ok)
+        environ = {"http_proxy": f"http://user:secret@{proxy.address}", "no_proxy": ""}
+        with mock.patch.dict(os.environ, environ):
+            self.assertEqual(self.post("http://api.example.invalid/v1/chat/completions"), (200, b"ok"))
+        self.assertEqual(proxy.requests, ["POST http://api.example.invalid/v1/chat/completions HTTP/1.1"])
+
+    def test_https_request_is_tunnelled_through_proxy(self):
+        # The proxy accepts the tunnel and then hangs up instead of speaking TLS
+        def answer(conn):
+            conn.sendall(b"HTTP/1.1 200 Connection established\r\n\r\n")
+            conn.shutdown(socket.SHUT_RDWR)
+
+        proxy = self.server(answer)
+        with mock.patch.dict(os.environ, {"https_proxy": f"http://{proxy.address}", "no_proxy": ""}):
+            with self.assertRaises(NetworkError):
+                self.post("https://api.example.invalid/v1/chat/completions")
+        self.assertEqual(proxy.requests, ["CONNECT api.example.invalid:443 HTTP/1.1"])
+
+    def test_no_proxy_connects_directly(self):
+        server = self.server(answer_ok)
+        environ = {"http_proxy": "http://127.0.0.1:9", "no_proxy": "127.0.0.1"}
+        with mock.patch.dict(os.environ, environ):
+            self.assertEqual(self.post(server.url), (200, b"ok"))
+        self.assertEqual(server.requests, ["POST /v1/chat/completions HTTP/1.1"])
+
+class ParseRetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after("5"), 5.0)
+        self.assertEqual(parse_retry_after("-3"), 0.0)
+
+    def test_http_date(self):
+        self.assertAlmostEqual(parse_retry_after(formatdate(time.time() + 60, usegmt=True)), 60, delta=2)
+        self.assertEqual(parse_retry_after(formatdate(time.time() - 60, usegmt=True)), 0.0)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("soon"))
+
+if __name__ == "__main__":
+    unittest.main()